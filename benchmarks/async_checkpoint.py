@@ -0,0 +1,126 @@
+"""Stall time and size of checkpoints saved during the training of a LoRA expert, e.g.:
+
+    python benchmarks/async_checkpoint.py --hidden_size 1024 --n_layers 8 --n_saves 10
+
+A checkpoint is saved after every optimizer step:
+
+- `trainer`: `trainer.save_checkpoint`, what `LossCallback` does, and `LiveCheckpointCallback`
+  with `save_weights_only=False`. The state dict is filtered by `on_save_checkpoint`.
+- `trainer_full`: the same for a module which does not filter its state dict.
+- `trainable_async`: the trainable parameters and their optimizer state are copied to CPU, and
+  written by an `AsyncCheckpointWriter`, as with `trainable_only=True`.
+
+The stall is the time the training loop waits for each save.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import pytorch_lightning as pl
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.models.lightning.checkpoint_writer import (
+    AsyncCheckpointWriter,
+    snapshot_trainable_checkpoint,
+)
+from mttl.models.lightning.expert_module import ExpertModule
+
+
+class BenchmarkModule(ExpertModule):
+    def configure_optimizers(self):
+        return torch.optim.AdamW([p for p in self.parameters() if p.requires_grad])
+
+
+class FullStateModule(BenchmarkModule):
+    def on_save_checkpoint(self, ckpt):
+        pass
+
+
+class SaveEveryStep(pl.Callback):
+    def __init__(self, dirpath, mode):
+        self.dirpath = dirpath
+        self.mode = mode
+        self.stalls = []
+        self.writer = AsyncCheckpointWriter(keep_best_k=1)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        path = os.path.join(self.dirpath, f"step_{trainer.global_step}.ckpt")
+        start = time.perf_counter()
+        if self.mode == "trainable_async":
+            checkpoint = snapshot_trainable_checkpoint(pl_module, trainer, False)
+            self.writer.save(checkpoint, path, score=-trainer.global_step)
+        else:
+            trainer.save_checkpoint(path)
+        self.stalls.append(time.perf_counter() - start)
+
+    def on_train_end(self, trainer, pl_module):
+        self.writer.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--n_layers", type=int, default=8)
+    parser.add_argument("--lora_rank", type=int, default=4)
+    parser.add_argument("--n_saves", type=int, default=10)
+    args = parser.parse_args()
+
+    config = LlamaConfig(
+        vocab_size=32000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+    input_ids = torch.randint(0, config.vocab_size, (2, 32))
+    batches = [{"input_ids": input_ids, "labels": input_ids}] * args.n_saves
+
+    print("mode\ttrainable_params\tckpt_mb\tstall_ms\ttotal_s")
+    for mode, module_cls in [
+        ("trainer", BenchmarkModule),
+        ("trainer_full", FullStateModule),
+        ("trainable_async", BenchmarkModule),
+    ]:
+        torch.manual_seed(0)
+        module = module_cls(
+            model_object=LlamaForCausalLM(config),
+            model="benchmark",
+            model_modifier="lora",
+            modify_layers="q_proj|v_proj",
+            lora_rank=args.lora_rank,
+            expert_name="benchmark",
+            precision="32",
+        )
+        n_trainable = sum(p.numel() for p in module.parameters() if p.requires_grad)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            callback = SaveEveryStep(tmp_dir, mode)
+            trainer = pl.Trainer(
+                max_steps=args.n_saves,
+                callbacks=[callback],
+                logger=False,
+                enable_checkpointing=False,
+                enable_progress_bar=False,
+                enable_model_summary=False,
+            )
+            start = time.perf_counter()
+            trainer.fit(
+                module,
+                train_dataloaders=torch.utils.data.DataLoader(batches, batch_size=None),
+            )
+            total = time.perf_counter() - start
+            size = max(
+                os.path.getsize(os.path.join(tmp_dir, f)) for f in os.listdir(tmp_dir)
+            )
+
+        stall = sum(callback.stalls) / len(callback.stalls)
+        print(
+            f"{mode}\t{n_trainable}\t{size / 2**20:.2f}\t{stall * 1000:.1f}\t{total:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
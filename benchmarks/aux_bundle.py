@@ -0,0 +1,108 @@
+"""Time to read the Arrow prototypes of every expert of a library, per-expert files against bundles.
+
+Writes one prototype per layer for each expert, as `ArrowTransform` does, once in the former
+layout with one file per expert and once in a bundle, then reads them all back, e.g.:
+
+    python benchmarks/aux_bundle.py --n_experts 1000 --n_layers 64 --dim 1024
+
+`--latency` adds a delay to every file read, to mimic a remote library.
+"""
+
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from huggingface_hub import CommitOperationAdd
+
+from mttl.models.library.backend_engine import LocalFSEngine
+from mttl.models.library.expert import Expert, ExpertInfo
+from mttl.models.library.expert_library import LocalExpertLibrary
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def build_library(path, protos, bundled):
+    library = LocalExpertLibrary(path, create=True)
+    with library.batched_commit():
+        for name in protos:
+            library.add_expert(
+                Expert(
+                    expert_info=ExpertInfo(name, expert_config=LoRAConfig()),
+                    expert_weights={"lora_a": torch.zeros(1)},
+                ),
+                update_readme=False,
+            )
+        if bundled:
+            for name, data in protos.items():
+                library.add_auxiliary_data("protos", name, {}, data)
+
+    if not bundled:
+        operations = []
+        for name, data in protos.items():
+            buffer = io.BytesIO()
+            torch.save({"data": data, "config": {}}, buffer)
+            buffer.seek(0)
+            operations.append(
+                CommitOperationAdd(
+                    path_in_repo=f"{name}.protos.bin", path_or_fileobj=buffer
+                )
+            )
+        library.create_commit(path, operations=operations, commit_message="")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_experts", type=int, default=1000)
+    parser.add_argument("--n_layers", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    protos = {
+        f"expert_{i}": {
+            f"layers.{j}.q_proj": rng.standard_normal(args.dim, dtype=np.float32)
+            for j in range(args.n_layers)
+        }
+        for i in range(args.n_experts)
+    }
+
+    hf_hub_download = LocalFSEngine.hf_hub_download
+
+    def download(self, repo_id, filename):
+        time.sleep(args.latency)
+        return hf_hub_download(self, repo_id, filename)
+
+    LocalFSEngine.hf_hub_download = download
+
+    print("layout\tfiles\twrite_s\tread_s")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for layout in ("per_expert", "bundle"):
+            path = os.path.join(tmp_dir, layout)
+            start = time.perf_counter()
+            build_library(path, protos, bundled=layout == "bundle")
+            write_seconds = time.perf_counter() - start
+            n_files = len(
+                [
+                    f
+                    for f in os.listdir(path)
+                    if f.startswith("protos") or ".protos" in f
+                ]
+            )
+
+            library = LocalExpertLibrary(path)
+            start = time.perf_counter()
+            loaded = library.get_auxiliary_data("protos")
+            # stack the prototypes of a layer, as the selectors do
+            stacked = np.stack([loaded[name]["layers.0.q_proj"] for name in protos])
+            read_seconds = time.perf_counter() - start
+            assert stacked.shape == (args.n_experts, args.dim)
+
+            print(f"{layout}\t{n_files}\t{write_seconds:.2f}\t{read_seconds:.2f}")
+
+
+if __name__ == "__main__":
+    main()
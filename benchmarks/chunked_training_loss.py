@@ -0,0 +1,105 @@
+"""Memory and throughput of a training step of a small Llama model against its vocabulary size, e.g.:
+
+    python benchmarks/chunked_training_loss.py --vocab_sizes 32000,64000 --batch_size 4
+
+The `full` mode computes the loss from the logits of the whole batch, as the transformers
+model does. The `chunked` mode uses `compute_chunked_loss`, as with `loss_chunk_size`. All
+tokens are labeled. Each run is made in a separate process, and the memory is the increase of
+its peak resident memory during training.
+"""
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.models.chunked_loss import compute_chunked_loss
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def run(mode, args):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+    model = ExpertModel(
+        ExpertModelConfig(modifier_config=LoRAConfig(modify_layers="q_proj|v_proj")),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad], lr=1e-4
+    )
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len))
+    batch = {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "labels": input_ids,
+    }
+
+    def train_step():
+        if mode == "full":
+            loss = model.forward(**batch).loss
+        else:
+            loss = compute_chunked_loss(model, batch, args.chunk_size)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        return loss.item()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(args.n_steps):
+        loss = train_step()
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    tokens_per_s = args.n_steps * args.batch_size * args.seq_len / elapsed
+    print(f"{tokens_per_s:.1f}\t{peak / 1024:.1f}\t{loss:.5f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_sizes", type=str, default="32000,64000")
+    parser.add_argument("--vocab_size", type=int, default=None)
+    parser.add_argument("--mode", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--chunk_size", type=int, default=256)
+    parser.add_argument("--n_steps", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run(args.mode, args)
+        return
+
+    print("vocab_size\tmode\ttokens_per_s\tpeak_mb\tloss")
+    for vocab_size in args.vocab_sizes.split(","):
+        for mode in ["full", "chunked"]:
+            argv = [
+                f"--{k}={getattr(args, k)}"
+                for k in ["batch_size", "seq_len", "hidden_size", "n_layers"]
+                + ["chunk_size", "n_steps"]
+            ]
+            output = subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--vocab_size", vocab_size]
+                + argv,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            print(f"{vocab_size}\t{mode}\t{output.strip().splitlines()[-1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Time to open a per-task `FlanModule` on a synthetic FLAN-like collection, e.g.:
+
+    python benchmarks/datamodule_index.py --n_examples 1000000 --n_tasks 1000 --n_open 10
+
+The former implementation filtered the whole collection by template type, task source, task and
+split every time a datamodule was set up. Datamodules now select their rows with a `DatasetIndex`
+of the collection, which is built by the first one.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy
+from datasets import Dataset, DatasetDict
+
+from mttl.datamodule.mt_seq_to_seq_module import FlanConfig, FlanModule
+from mttl.models.library.dataset_library import DatasetLibrary
+
+
+def reference_setup(dataset, task_name, n_proc):
+    dataset = dataset["train"]
+    dataset = dataset.filter(
+        lambda x: x["template_type"] in {"zs_opt"}, num_proc=n_proc
+    )
+    dataset = dataset.filter(
+        lambda x: x["task_source"] in {"P3", "Flan2021"}, num_proc=n_proc
+    )
+    # set of the tasks, to check the task name
+    assert task_name in set(dataset["task_name"])
+    dataset = dataset.filter(lambda x: x["task_name"] in [task_name], num_proc=n_proc)
+    return [
+        dataset.filter(lambda x: x["split"] == split, num_proc=n_proc)
+        for split in ["train", "validation", "test"]
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_examples", type=int, default=1_000_000)
+    parser.add_argument("--n_tasks", type=int, default=1000)
+    parser.add_argument("--n_open", type=int, default=10)
+    args = parser.parse_args()
+
+    n_proc = int(os.environ.get("MTTL_NUM_PROC_DATASETS", 16))
+    rng = numpy.random.RandomState(0)
+    tasks = rng.randint(args.n_tasks, size=args.n_examples)
+    dataset = DatasetDict(
+        {
+            "train": Dataset.from_dict(
+                {
+                    "source": [f"source {i}" for i in range(args.n_examples)],
+                    "target": [f"target {i}" for i in range(args.n_examples)],
+                    "task_name": [f"task_{t}" for t in tasks],
+                    "task_source": rng.choice(
+                        ["P3", "Flan2021", "CoT"], args.n_examples
+                    ).tolist(),
+                    "template_type": rng.choice(
+                        ["zs_opt", "fs_opt", "zs_noopt"], args.n_examples
+                    ).tolist(),
+                    "split": rng.choice(
+                        ["train", "validation", "test"],
+                        args.n_examples,
+                        p=[0.8, 0.1, 0.1],
+                    ).tolist(),
+                }
+            )
+        }
+    )
+    task_names = [f"task_{t}" for t in range(args.n_open)]
+
+    print("implementation\tfirst_open_s\tnext_opens_s\ttrain_examples")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["MTTL_DATASET_INDEX_DIR"] = os.path.join(tmp_dir, "index")
+        dataset_id = f"local://{os.path.join(tmp_dir, 'flan')}"
+        DatasetLibrary.push_dataset(dataset, dataset_id)
+        dataset = DatasetLibrary.pull_dataset(dataset_id)
+
+        times, n_train = [], 0
+        for task_name in task_names:
+            start = time.perf_counter()
+            train, _, _ = reference_setup(dataset, task_name, n_proc)
+            times.append(time.perf_counter() - start)
+            n_train += len(train)
+        print(f"reference\t{times[0]:.2f}\t{sum(times[1:]):.2f}\t{n_train}")
+
+        times, n_train = [], 0
+        for task_name in task_names:
+            module = object.__new__(FlanModule)
+            module.config = FlanConfig(
+                dataset=dataset_id,
+                finetune_task_name=task_name,
+                include_template_type="zs_opt",
+                include_task_source="P3,Flan2021",
+            )
+            start = time.perf_counter()
+            module.setup_dataset()
+            times.append(time.perf_counter() - start)
+            n_train += len(module.train_dataset)
+        print(f"index\t{times[0]:.2f}\t{sum(times[1:]):.2f}\t{n_train}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Evaluation overhead of `LossCallback` in a training loop of a small Llama model, e.g.:
+
+    python benchmarks/eval_callback.py --n_steps 50 --eval_every 5 --n_eval_examples 512
+
+Evaluation batches are tokenized by the collate function of the dataloader, as with the
+collators of the datamodules. Without `keep_batches`, they are tokenized again at every
+evaluation. The overhead is the time spent evaluating, as a fraction of the time spent training.
+"""
+
+import argparse
+import time
+
+import numpy
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from mttl.models.lightning.callbacks import LossCallback
+
+
+class Module(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def forward(self, input_ids, attention_mask, reduction="mean"):
+        return self.model(
+            input_ids=input_ids, attention_mask=attention_mask, labels=input_ids
+        ).loss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_steps", type=int, default=50)
+    parser.add_argument("--eval_every", type=int, default=5)
+    parser.add_argument("--n_eval_examples", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--time_budget", type=float, default=0.2)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(0)
+    words = [f"word{i}" for i in range(2000)]
+    texts = [
+        " ".join(rng.choice(words, rng.randint(200, 400)))
+        for _ in range(args.n_eval_examples)
+    ]
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.train_from_iterator(
+        texts, trainers.BpeTrainer(vocab_size=1000, special_tokens=["<unk>", "<pad>"])
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe, unk_token="<unk>", pad_token="<pad>"
+    )
+
+    def collate(batch):
+        return dict(
+            tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=64,
+                return_token_type_ids=False,
+                return_tensors="pt",
+            )
+        )
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=1000,
+        hidden_size=128,
+        intermediate_size=512,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    module = Module(LlamaForCausalLM(config))
+    optimizer = torch.optim.AdamW(module.parameters(), lr=1e-4)
+    train_batch = collate(texts[: args.batch_size])
+
+    print("keep_batches\ttime_budget\teval_s\ttrain_s\teval_overhead")
+    for keep_batches, time_budget in [
+        (False, None),
+        (True, None),
+        (True, args.time_budget),
+    ]:
+        callback = LossCallback(
+            torch.utils.data.DataLoader(
+                texts, batch_size=args.batch_size, collate_fn=collate
+            ),
+            output_dir=None,
+            checkpoint_oracle=False,
+            keep_batches=keep_batches,
+            time_budget=time_budget,
+        )
+        callback.on_train_start(None, module)
+        for step in range(args.n_steps):
+            loss = module(**train_batch)
+            loss.backward()
+            if step % args.eval_every == 0:
+                with callback.timed_evaluation():
+                    callback.test(module)
+            optimizer.step()
+            optimizer.zero_grad()
+
+        elapsed = time.perf_counter() - callback._train_start
+        print(
+            f"{keep_batches}\t{time_budget}\t{callback._eval_seconds:.2f}\t"
+            f"{elapsed - callback._eval_seconds:.2f}\t{callback.eval_overhead:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
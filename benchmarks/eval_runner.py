@@ -0,0 +1,116 @@
+"""End-to-end time of an `EvaluatorRunner` suite, for cold, warm and resumed runs.
+
+Each task of the suite scores a small Llama model on synthetic text, tokenized by the collator
+as the datamodules of the repository do, e.g.:
+
+    python benchmarks/eval_runner.py --n_tasks 8 --n_examples 256
+
+Cold runs evaluate every task, with and without prefetching of the next task. Warm runs find
+every task in the cache. Resumed runs follow a run interrupted half-way through the suite.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.evaluators.base import Evaluator, EvaluatorRunner
+
+
+class Interrupted(Exception):
+    pass
+
+
+def tokenize(texts, vocab_size, max_length):
+    ids = [[hash(word) % vocab_size for word in text.split()] for text in texts]
+    length = min(max_length, max(len(x) for x in ids))
+    return torch.tensor([(x + [0] * length)[:length] for x in ids])
+
+
+class SyntheticEvaluator(Evaluator):
+    def __init__(self, task, n_examples, batch_size, vocab_size, max_length):
+        texts = [
+            " ".join(f"{task}-word{(i * 31 + j) % 997}" for j in range(4 * max_length))
+            for i in range(n_examples)
+        ]
+        datamodule = SimpleNamespace(
+            config=SimpleNamespace(task=task),
+            test_dataloader=lambda subsample, shuffle: torch.utils.data.DataLoader(
+                texts,
+                batch_size=batch_size,
+                collate_fn=lambda batch: tokenize(batch, vocab_size, max_length),
+            ),
+        )
+        super().__init__(datamodule=datamodule)
+        self.interrupt = False
+
+    @torch.no_grad()
+    def evaluate(self, model, split="test", subsample=-1, shuffle=False, **_):
+        if self.interrupt:
+            raise Interrupted()
+        losses = []
+        for input_ids in self.get_dataloader(split, subsample, shuffle):
+            losses.append(model(input_ids, labels=input_ids).loss.item())
+        return sum(losses) / len(losses)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_tasks", type=int, default=8)
+    parser.add_argument("--n_examples", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_length", type=int, default=128)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--n_layers", type=int, default=4)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=8000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+    model = LlamaForCausalLM(config).eval()
+    evaluators = {
+        f"task{i}": SyntheticEvaluator(
+            f"task{i}",
+            args.n_examples,
+            args.batch_size,
+            config.vocab_size,
+            args.max_length,
+        )
+        for i in range(args.n_tasks)
+    }
+
+    def run(cache_path, prefetch=True, interrupt_at=None):
+        runner = EvaluatorRunner(cache_path=cache_path, prefetch=prefetch)
+        for i, (name, evaluator) in enumerate(evaluators.items()):
+            evaluator.interrupt = i == interrupt_at
+            runner.add_evaluator(name, evaluator)
+        start = time.perf_counter()
+        try:
+            runner.run(model)
+        except Interrupted:
+            pass
+        return time.perf_counter() - start
+
+    print("run\tseconds")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"cold_no_prefetch\t{run(None, prefetch=False):.2f}")
+        cache_path = os.path.join(tmp_dir, "cache.json")
+        print(f"cold\t{run(cache_path):.2f}")
+        print(f"warm\t{run(cache_path):.2f}")
+
+        cache_path = os.path.join(tmp_dir, "resumed.json")
+        run(cache_path, interrupt_at=args.n_tasks // 2)
+        print(f"resumed\t{run(cache_path):.2f}")
+
+
+if __name__ == "__main__":
+    main()
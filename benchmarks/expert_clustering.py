@@ -0,0 +1,108 @@
+"""Runtime, peak RSS and quality of the expert clustering in `MBCWithCosSimTransform`.
+
+Compares spherical k-means on the normalized embeddings with the default method, KMeans on
+the rows of the cosine similarity matrix, on synthetic clustered embeddings, e.g.:
+
+    python benchmarks/expert_clustering.py --n_experts 1000 4000 16000 --k 10
+
+Quality is the adjusted rand index against the generating clusters and the mean cosine
+similarity of each expert to the centroid of its cluster. Each configuration runs in a fresh
+process so that the peak RSS is not shared across runs.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def make_embeddings(n_experts, k, dim, noise, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(k, dim)
+    labels = rng.randint(k, size=n_experts)
+    embeddings = centers[labels] + noise * rng.randn(n_experts, dim)
+    embeddings /= np.linalg.norm(embeddings, 2, axis=1, keepdims=True)
+    return embeddings.astype(np.float32), labels
+
+
+def run(args):
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import adjusted_rand_score
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    from mttl.models.library.library_transforms import spherical_kmeans
+
+    embeddings, true_labels = make_embeddings(
+        args.n_experts[0], args.k, args.dim, args.noise
+    )
+
+    start = time.perf_counter()
+    if args.method == "cos_sim_kmeans":
+        kmeans = KMeans(n_clusters=args.k, init="k-means++", n_init=10, random_state=42)
+        labels = kmeans.fit(cosine_similarity(embeddings, embeddings)).labels_
+    else:
+        labels, _ = spherical_kmeans(
+            torch.from_numpy(embeddings), args.k, n_init=10, random_state=42
+        )
+        labels = labels.numpy()
+    seconds = time.perf_counter() - start
+
+    embeddings = torch.from_numpy(embeddings)
+    labels_t = torch.from_numpy(labels).long()
+    centroids = F.normalize(
+        torch.zeros(args.k, args.dim).index_add_(0, labels_t, embeddings), dim=1
+    )
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "ari": adjusted_rand_score(true_labels, labels),
+        "mean_cos": (embeddings * centroids[labels_t]).sum(1).mean().item(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_experts", type=int, nargs="+", default=[1000, 4000, 16000])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--max_legacy_experts", type=int, default=8000)
+    parser.add_argument("--method", choices=["cos_sim_kmeans", "spherical"])
+    args = parser.parse_args()
+
+    if args.method is not None:
+        # worker process, a single configuration
+        print(json.dumps(run(args)))
+        return
+
+    print("experts\tmethod\tseconds\tpeak_rss_mb\tari\tmean_cos")
+    for n_experts in args.n_experts:
+        for method in ["cos_sim_kmeans", "spherical"]:
+            if method == "cos_sim_kmeans" and n_experts > args.max_legacy_experts:
+                print(f"{n_experts}\t{method}\tskipped")
+                continue
+
+            cmd = [sys.executable, __file__, "--method", method]
+            cmd += ["--n_experts", str(n_experts), "--k", str(args.k)]
+            cmd += ["--dim", str(args.dim), "--noise", str(args.noise)]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"{n_experts}\t{method}\tfailed")
+                continue
+
+            result = json.loads(result.stdout.strip().splitlines()[-1])
+            print(
+                f"{n_experts}\t{method}\t{result['seconds']:.2f}\t"
+                f"{result['peak_rss_mb']:.0f}\t{result['ari']:.3f}\t"
+                f"{result['mean_cos']:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
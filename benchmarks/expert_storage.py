@@ -0,0 +1,110 @@
+"""Size on disk, load latency and output drift of the storage formats of `ExpertLibrary`.
+
+Builds a synthetic library of LoRA experts for a small Llama model in each format, e.g.:
+
+    python benchmarks/expert_storage.py --n_experts 64 --lora_rank 16
+
+Drift compares the logits of the model with an expert loaded from the quantized library to the
+ones with the fp32 expert: the relative error of the logits and the agreement of the top-1 token.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.models.expert_model import MultiExpertModel, MultiExpertModelConfig
+from mttl.models.library.expert_library import LocalExpertLibrary
+from mttl.models.library.quantization import STORAGE_DTYPES
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(path)
+        for file in files
+        if file.endswith(".ckpt")
+    )
+
+
+@torch.no_grad()
+def logits_with_expert(model, expert, input_ids):
+    model.delete_expert_container()
+    model.add_expert_instance(expert, is_default=True)
+    return model.model(input_ids).logits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_experts", type=int, default=64)
+    parser.add_argument("--lora_rank", type=int, default=16)
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--n_layers", type=int, default=8)
+    parser.add_argument("--n_drift_experts", type=int, default=4)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=32000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+    model = MultiExpertModel(
+        MultiExpertModelConfig(),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+    lora_config = LoRAConfig(
+        modify_layers="q_proj|k_proj|v_proj|o_proj",
+        lora_rank=args.lora_rank,
+        lora_init_b_random=True,
+    )
+    experts = []
+    for i in range(args.n_experts):
+        model.add_empty_expert(f"expert_{i}", lora_config)
+        experts.append(model.get_expert_instance(f"expert_{i}"))
+        model.delete_expert_container()
+
+    input_ids = torch.randint(0, config.vocab_size, (4, 64))
+    reference = [
+        logits_with_expert(model, expert, input_ids)
+        for expert in experts[: args.n_drift_experts]
+    ]
+
+    print("dtype\tsize_mb\tload_s\tlogits_rel_err\ttop1_agreement")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for storage_dtype in STORAGE_DTYPES:
+            path = os.path.join(tmp_dir, storage_dtype)
+            library = LocalExpertLibrary(path, create=True, storage_dtype=storage_dtype)
+            with library.batched_commit():
+                for expert in experts:
+                    library.add_expert(expert, update_readme=False)
+
+            library = LocalExpertLibrary(path)
+            start = time.perf_counter()
+            loaded = dict(library.items())
+            load_seconds = time.perf_counter() - start
+
+            errors, agreements = [], []
+            for ref, expert in zip(reference, experts):
+                logits = logits_with_expert(model, loaded[expert.name], input_ids)
+                errors.append(((logits - ref).norm() / ref.norm()).item())
+                agreements.append(
+                    (logits.argmax(-1) == ref.argmax(-1)).float().mean().item()
+                )
+
+            print(
+                f"{storage_dtype}\t{directory_size(path) / 2**20:.1f}\t"
+                f"{load_seconds:.2f}\t{sum(errors) / len(errors):.2e}\t"
+                f"{sum(agreements) / len(agreements):.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Time of `augment_few_shot` on a synthetic multi-task dataset, against the former implementation.
+
+The former implementation filtered the dataset once per task, built the list of candidate shots
+for every example, and tokenized every prompt while removing shots, e.g.:
+
+    python benchmarks/few_shot_augmentation.py --n_examples 20000 --n_tasks 20
+
+With `--skip_reference`, only the current implementation runs, e.g. at FLAN scale:
+
+    python benchmarks/few_shot_augmentation.py --n_examples 1000000 --n_tasks 1000 --skip_reference
+"""
+
+import argparse
+import time
+
+import numpy
+from datasets import Dataset, concatenate_datasets
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from mttl.datamodule.mt_seq_to_seq_module import augment_few_shot
+
+
+def reference_augment_few_shot_task(
+    dataset, num_samples, tokenizer, max_input_length, seed
+):
+    rng = numpy.random.RandomState(seed)
+    split = dataset["split"]
+    train_indices = set(i for i in range(len(dataset)) if split[i] == "train")
+
+    def map_to_few_shot(_, index):
+        index_range = list(train_indices - {index})
+        index_chosen = rng.choice(index_range, size=num_samples, replace=False)
+        index_chosen = list(map(int, index_chosen))
+        sources = [dataset[i]["source"] for i in index_chosen]
+        targets = [dataset[i]["target"] for i in index_chosen]
+        context = "\n\n".join([" ".join(x) for x in zip(sources, targets)]) + "\n\n"
+        prompt = context + dataset[index]["source"]
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        while input_ids.shape[-1] > max_input_length and len(context.split("\n\n")) > 2:
+            context = "\n\n".join(context.split("\n\n")[:-2]) + "\n\n"
+            prompt = context + dataset[index]["source"]
+            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        return {
+            "source": prompt,
+            "task_source": "few_shot_{}".format(dataset[index]["task_source"]),
+        }
+
+    return dataset.map(map_to_few_shot, with_indices=True)
+
+
+def reference_augment_few_shot(dataset, num_samples, tokenizer, max_input_length):
+    augmented = []
+    for task in dataset.unique("task_name"):
+        augmented.append(
+            reference_augment_few_shot_task(
+                dataset.filter(lambda x: x["task_name"] == task),
+                num_samples,
+                tokenizer,
+                max_input_length,
+                seed=42,
+            )
+        )
+    return concatenate_datasets([dataset] + augmented)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_examples", type=int, default=20000)
+    parser.add_argument("--n_tasks", type=int, default=20)
+    parser.add_argument("--num_samples", type=int, default=5)
+    parser.add_argument("--max_input_length", type=int, default=256)
+    parser.add_argument("--skip_reference", action="store_true")
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(0)
+    words = numpy.array([f"word{i}" for i in range(5000)])
+    lengths = rng.randint(5, 120, args.n_examples)
+    dataset = Dataset.from_dict(
+        {
+            "source": [" ".join(rng.choice(words, n)) for n in lengths],
+            "target": [" ".join(rng.choice(words, 5)) for _ in lengths],
+            "task_name": [f"task{i % args.n_tasks}" for i in range(args.n_examples)],
+            "task_source": ["synthetic"] * args.n_examples,
+            "split": rng.choice(["train", "validation"], args.n_examples, p=[0.9, 0.1]),
+        }
+    )
+
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.train_from_iterator(
+        dataset["source"][:10000],
+        trainers.BpeTrainer(vocab_size=8000, special_tokens=["<unk>"]),
+    )
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, unk_token="<unk>")
+
+    print("impl\texamples\ttasks\tseconds")
+    if not args.skip_reference:
+        start = time.perf_counter()
+        reference_augment_few_shot(
+            dataset, args.num_samples, tokenizer, args.max_input_length
+        )
+        print(
+            f"reference\t{args.n_examples}\t{args.n_tasks}\t"
+            f"{time.perf_counter() - start:.1f}"
+        )
+
+    start = time.perf_counter()
+    augment_few_shot(
+        dataset,
+        args.num_samples,
+        tokenizer=tokenizer,
+        max_input_length=args.max_input_length,
+    )
+    print(
+        f"current\t{args.n_examples}\t{args.n_tasks}\t{time.perf_counter() - start:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Time of the optimizer updates of the LoRA parameters of a Llama model, e.g.:
+
+    python benchmarks/flat_optimizer.py --n_layers 32 --n_steps 50
+
+Each update clips the gradients, steps the optimizer and zeroes the gradients, as in
+`train_model`. Gradients are random, the forward and backward passes are not timed. With
+`optimizer_flat_buffers`, the parameters of each param group are packed in one flat buffer.
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.arguments import ExpertConfig
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.get_optimizer import get_optimizer
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--n_layers", type=int, default=32)
+    parser.add_argument("--lora_rank", type=int, default=4)
+    parser.add_argument("--n_steps", type=int, default=50)
+    args = parser.parse_args()
+
+    config = LlamaConfig(
+        vocab_size=1000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+
+    print("optimizer\tflat_buffers\tn_params\tn_tensors\tms_per_update")
+    for optimizer in ["adamw", "sgd"]:
+        for flat_buffers in [False, True]:
+            torch.manual_seed(0)
+            model = ExpertModel(
+                ExpertModelConfig(
+                    modifier_config=LoRAConfig(
+                        modify_layers="q_proj|k_proj|v_proj|o_proj|gate_proj|up_proj|down_proj",
+                        lora_rank=args.lora_rank,
+                    )
+                ),
+                model_object=LlamaForCausalLM(config),
+                device_map="cpu",
+            )
+            training_args = ExpertConfig(
+                optimizer=optimizer,
+                trainable_param_names=".*lora.*",
+                learning_rate=1e-3,
+                weight_decay=0.01,
+                optimizer_flat_buffers=flat_buffers,
+            )
+            optim, _ = get_optimizer(model, training_args, no_decay=["lora_b"])
+            params = [p for p in model.parameters() if p.requires_grad]
+            grads = [torch.randn_like(p) for p in params]
+
+            elapsed = 0.0
+            for step in range(args.n_steps + 1):
+                optim.zero_grad()
+                for param, grad in zip(params, grads):
+                    # accumulated in place, as by backward
+                    if param.grad is None:
+                        param.grad = grad.clone()
+                    else:
+                        param.grad.add_(grad)
+                start = time.perf_counter()
+                torch.nn.utils.clip_grad_norm_(
+                    [p for g in optim.param_groups for p in g["params"]], 1.0
+                )
+                optim.step()
+                optim.zero_grad()
+                # the first update allocates the optimizer state
+                if step > 0:
+                    elapsed += time.perf_counter() - start
+
+            n_tensors = sum(len(g["params"]) for g in optim.param_groups)
+            print(
+                f"{optimizer}\t{flat_buffers}\t{sum(p.numel() for p in params)}\t"
+                f"{n_tensors}\t{elapsed / args.n_steps * 1000:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
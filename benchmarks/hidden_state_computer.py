@@ -0,0 +1,82 @@
+"""Wall-clock and peak RSS of `HiddenStateComputer.transform` against library size.
+
+Runs the transform on the first N experts of a library, e.g.:
+
+    python benchmarks/hidden_state_computer.py --library_id local://path/to/library \
+        --n_experts 8 32 128 --use_base_model_only
+
+Each library size runs in a fresh process so that the peak RSS is not shared across runs.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def run(args):
+    from mttl.models.library.expert_library import ExpertLibrary
+    from mttl.models.library.library_transforms import (
+        HiddenStateComputer,
+        HiddenStateComputerConfig,
+    )
+
+    library = ExpertLibrary.get_expert_library(args.library_id)
+    library = ExpertLibrary.get_expert_library(
+        args.library_id, selection=list(library.keys())[: args.n_experts[0]]
+    )
+
+    start = time.perf_counter()
+    HiddenStateComputer(
+        HiddenStateComputerConfig(
+            use_base_model_only=args.use_base_model_only,
+            max_samples_per_task=args.max_samples_per_task,
+            track=args.track,
+            pool=args.pool,
+        )
+    ).transform(library, persist=False, recompute=True, device=args.device)
+
+    return {
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--library_id", type=str, required=True)
+    parser.add_argument("--n_experts", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--use_base_model_only", action="store_true")
+    parser.add_argument("--max_samples_per_task", type=int, default=10)
+    parser.add_argument("--track", type=str, default="each_layer")
+    parser.add_argument("--pool", type=str, default="last")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--worker", action="store_true")
+    args = parser.parse_args()
+
+    if args.worker:
+        # worker process, a single library size
+        print(json.dumps(run(args)))
+        return
+
+    print("experts\tseconds\tpeak_rss_mb")
+    for n_experts in args.n_experts:
+        cmd = [sys.executable, __file__, "--worker"]
+        cmd += ["--library_id", args.library_id, "--n_experts", str(n_experts)]
+        cmd += ["--max_samples_per_task", str(args.max_samples_per_task)]
+        cmd += ["--track", args.track, "--pool", args.pool, "--device", args.device]
+        if args.use_base_model_only:
+            cmd += ["--use_base_model_only"]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"{n_experts}\tfailed")
+            continue
+
+        result = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f"{n_experts}\t{result['seconds']:.1f}\t{result['peak_rss_mb']:.0f}")
+
+
+if __name__ == "__main__":
+    main()
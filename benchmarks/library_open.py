@@ -0,0 +1,65 @@
+"""Time to open an `ExpertLibrary`, from the manifest against downloading every .meta file.
+
+Builds a local library and adds a simulated round trip to every read, e.g.:
+
+    python benchmarks/library_open.py --n_experts 100 1000 --latency 0.05
+"""
+
+import argparse
+import tempfile
+import time
+
+import torch
+
+from mttl.models.library.backend_engine import LocalFSEngine
+from mttl.models.library.expert import Expert, ExpertInfo
+from mttl.models.library.expert_library import LocalExpertLibrary
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_experts", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    hf_hub_download = LocalFSEngine.hf_hub_download
+
+    def slow_download(self, repo_id, filename):
+        time.sleep(args.latency)
+        return hf_hub_download(self, repo_id, filename)
+
+    print("experts\tmeta_files_s\tmanifest_s")
+    for n_experts in args.n_experts:
+        with tempfile.TemporaryDirectory() as repo_id:
+            library = LocalExpertLibrary(repo_id, create=True)
+            with library.batched_commit():
+                for i in range(n_experts):
+                    library.add_expert(
+                        Expert(
+                            expert_info=ExpertInfo(f"e{i}", expert_config=LoRAConfig()),
+                            expert_weights={"lora_a": torch.zeros(1)},
+                        ),
+                        update_readme=False,
+                    )
+
+            LocalFSEngine.hf_hub_download = slow_download
+            try:
+                start = time.perf_counter()
+                LocalExpertLibrary(repo_id)
+                manifest_seconds = time.perf_counter() - start
+
+                # what opening cost before the manifest, the library is listed from .meta files
+                start = time.perf_counter()
+                library._download_metadata(
+                    [f for f in library.list_repo_files(repo_id) if f.endswith(".meta")]
+                )
+                meta_seconds = time.perf_counter() - start
+            finally:
+                LocalFSEngine.hf_hub_download = hf_hub_download
+
+            print(f"{n_experts}\t{meta_seconds:.2f}\t{manifest_seconds:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Time and memory of a loss evaluation of a small Llama model against its vocabulary size, e.g.:
+
+    python benchmarks/loss_eval.py --vocab_sizes 32000,128000 --batch_size 8 --seq_len 512
+
+The `forward` mode runs the model with its labels, as `evaluate_model` and `LossCallback` do
+by default. The `loss_only` mode uses `compute_loss_sums`. Half of the tokens of each example
+are labeled, as for instructions followed by their answers. Each run is made in a separate
+process, and the memory is the increase of its peak resident memory during the evaluation.
+"""
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.models.chunked_loss import compute_loss_sums
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def run(mode, args):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+    model = ExpertModel(
+        ExpertModelConfig(modifier_config=LoRAConfig(modify_layers="q_proj|v_proj")),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+    model.eval()
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len))
+    labels = input_ids.clone()
+    labels[:, : args.seq_len // 2] = -100
+    batch = {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "labels": labels,
+    }
+
+    def evaluate():
+        with torch.no_grad():
+            if mode == "forward":
+                return model.forward(**batch).loss.item()
+            loss_sums, num_tokens = compute_loss_sums(model, batch, args.chunk_size)
+            return (loss_sums.sum() / num_tokens.sum()).item()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for _ in range(args.n_repeats):
+        loss = evaluate()
+    elapsed = (time.perf_counter() - start) / args.n_repeats
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print(f"{elapsed * 1000:.1f}\t{peak / 1024:.1f}\t{loss:.5f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_sizes", type=str, default="32000,128000")
+    parser.add_argument("--vocab_size", type=int, default=None)
+    parser.add_argument("--mode", type=str, default=None)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--chunk_size", type=int, default=1024)
+    parser.add_argument("--n_repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run(args.mode, args)
+        return
+
+    print("vocab_size\tmode\tms_per_batch\tpeak_mb\tloss")
+    for vocab_size in args.vocab_sizes.split(","):
+        for mode in ["forward", "loss_only"]:
+            argv = [
+                f"--{k}={getattr(args, k)}"
+                for k in ["batch_size", "seq_len", "hidden_size", "n_layers"]
+                + ["chunk_size", "n_repeats"]
+            ]
+            output = subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--vocab_size", vocab_size]
+                + argv,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            print(f"{vocab_size}\t{mode}\t{output.strip().splitlines()[-1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Step-time overhead of the loss plugins on a many-layer toy model, e.g.:
+
+    python benchmarks/loss_plugins.py --n_layers 64 --n_steps 50
+
+Each adapter has skilled LoRA parameters `lora_a` of shape (n_skills, n_splits, d, rank) and
+`lora_b` of shape (n_skills, n_splits, rank, d), and each selector `module_logits` of shape
+(n_tasks, n_skills). The `loop` mode computes the losses one parameter or selector at a time,
+as before they were batched. Times include the backward pass.
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from mttl.models.loss_plugins import (
+    ModuleSparsityPlugin,
+    OrthoRegularizationPlugin,
+    TaskPredictionPlugin,
+)
+
+
+def loop_ortho_loss(plugin):
+    loss = 0.0
+    for param in plugin.params:
+        loss += plugin.orthogonal_loss_fn(param)
+    return loss / len(plugin.params)
+
+
+def loop_task_prediction_loss(plugin, model, batch):
+    loss = 0.0
+    for selector in model.get_selectors().values():
+        logits = torch.sigmoid(selector.module_logits[batch["task_ids"]])
+        loss += plugin.loss_fn(plugin.predictor(logits), batch["task_ids"])
+    return loss / len(model.get_selectors())
+
+
+def loop_sparsity_loss(plugin, model, batch):
+    loss = 0.0
+    for selector in model.get_selectors().values():
+        probs = torch.sigmoid(selector.module_logits[batch["task_ids"]])
+        loss += torch.nn.functional.relu(
+            probs.abs().mean(-1) - (plugin.num_free_bits / probs.size(-1))
+        ).mean()
+    return loss / len(model.get_selectors())
+
+
+def time_loss(compute_loss, params, n_steps):
+    for step in range(n_steps + 1):
+        if step == 1:
+            start = time.perf_counter()
+        loss = compute_loss()
+        torch.autograd.grad(loss, params)
+    return (time.perf_counter() - start) / n_steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layers", type=int, default=64)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--n_skills", type=int, default=8)
+    parser.add_argument("--n_splits", type=int, default=1)
+    parser.add_argument("--lora_rank", type=int, default=4)
+    parser.add_argument("--n_tasks", type=int, default=64)
+    parser.add_argument("--n_steps", type=int, default=50)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    s, k, d, r = args.n_skills, args.n_splits, args.hidden_size, args.lora_rank
+    adapters = {
+        f"layer{i}": SimpleNamespace(
+            lora_a=nn.Parameter(torch.randn(s, k, d, r)),
+            lora_b=nn.Parameter(torch.randn(s, k, r, d)),
+        )
+        for i in range(args.n_layers)
+    }
+    selectors = {
+        f"layer{i}": SimpleNamespace(
+            module_logits=nn.Parameter(torch.randn(args.n_tasks, s))
+        )
+        for i in range(args.n_layers)
+    }
+    model = SimpleNamespace(
+        model=SimpleNamespace(
+            get_adapters=lambda: adapters, get_selectors=lambda: selectors
+        ),
+        get_selectors=lambda: selectors,
+    )
+    batch = {"task_ids": torch.randint(0, args.n_tasks, (16,))}
+
+    ortho = OrthoRegularizationPlugin(model)
+    task_prediction = TaskPredictionPlugin(model, detach=False)
+    sparsity = ModuleSparsityPlugin(model)
+    ortho_params = [p for _, p in ortho.params]
+    selector_params = [s.module_logits for s in selectors.values()]
+
+    print("plugin\tn_tensors\tloop_ms\tbatched_ms\tspeedup")
+    for name, params, loop_fn, batched_fn in [
+        ("ortho_reg", ortho_params, lambda: loop_ortho_loss(ortho), ortho.compute_loss),
+        (
+            "task_pred",
+            selector_params,
+            lambda: loop_task_prediction_loss(task_prediction, model, batch),
+            lambda: task_prediction.compute_loss(model, batch),
+        ),
+        (
+            "mod_l1",
+            selector_params,
+            lambda: loop_sparsity_loss(sparsity, model, batch),
+            lambda: sparsity.compute_loss(model, batch),
+        ),
+    ]:
+        loop = time_loss(loop_fn, params, args.n_steps)
+        batched = time_loss(batched_fn, params, args.n_steps)
+        print(
+            f"{name}\t{len(params)}\t{loop * 1000:.2f}\t{batched * 1000:.2f}\t"
+            f"{loop / batched:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""CPU benchmark of the PEER container forward / backward.
+
+Compares the fused forward of `PEERMLPContainer` with the previous implementation that
+gathers the expert weights of every token before contracting them, e.g.:
+
+    python benchmarks/peer_forward.py --moe_num_experts 1024 65536 --n_heads 8 --top_k 16
+
+Each configuration runs in a fresh process so that the peak RSS is not shared across runs.
+"""
+
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from torch import nn
+
+
+class MLP(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.fc1 = nn.Linear(dim, 4 * dim)
+        self.fc2 = nn.Linear(4 * dim, dim)
+        self.act = nn.GELU()
+
+
+def materialized_forward(container, input):
+    routing = container.selector(input)
+    w_down = container.peer_weight_down_embed(routing.experts)
+    w_up = container.peer_weight_up_embed(routing.experts)
+
+    x = torch.einsum("bsd,bshed->bshe", input, w_down)
+    x = container.activation(x) * routing.weights
+    return torch.einsum("bshe,bshed->bsd", x, w_up)
+
+
+def run(args):
+    from mttl.models.containers.peer_container import PEERMLPContainer
+    from mttl.models.containers.selectors.product_key import PKSelectorConfig
+    from mttl.models.modifiers.mlp import PEERConfig
+
+    torch.manual_seed(0)
+    config = PEERConfig(
+        moe_num_experts=args.moe_num_experts,
+        n_heads=args.n_heads,
+        peer_chunk_size=args.peer_chunk_size,
+    )
+    container = PEERMLPContainer(
+        config,
+        MLP(args.dim),
+        selector_config=PKSelectorConfig(
+            moe_num_experts=args.moe_num_experts,
+            num_heads=args.n_heads,
+            top_k=args.top_k,
+        ),
+    )
+    container.initialize_experts(config)
+    if args.impl == "fused":
+        forward = container.container_forward
+    else:
+        forward = lambda input: materialized_forward(container, input)
+
+    input = torch.randn(args.batch_size, args.seq_len, args.dim, requires_grad=True)
+    times = []
+    for step in range(args.steps + 1):
+        start = time.perf_counter()
+        forward(input).sum().backward()
+        if step > 0:
+            times.append(time.perf_counter() - start)
+
+    n_tokens = args.batch_size * args.seq_len
+    return {
+        "tokens/s": n_tokens * len(times) / sum(times),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--moe_num_experts", type=int, nargs="+", default=[1024, 16384])
+    parser.add_argument("--n_heads", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--top_k", type=int, nargs="+", default=[8, 16])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=256)
+    parser.add_argument("--peer_chunk_size", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--impl", choices=["fused", "materialized"], default=None)
+    args = parser.parse_args()
+
+    if args.impl is not None:
+        # worker process, a single configuration
+        args.moe_num_experts, args.n_heads, args.top_k = (
+            args.moe_num_experts[0],
+            args.n_heads[0],
+            args.top_k[0],
+        )
+        print(json.dumps(run(args)))
+        return
+
+    print("experts\theads\ttop_k\timpl\ttokens/s\tpeak_rss_mb")
+    for n_experts, n_heads, top_k in itertools.product(
+        args.moe_num_experts, args.n_heads, args.top_k
+    ):
+        for impl in ["materialized", "fused"]:
+            cmd = [sys.executable, __file__, "--impl", impl]
+            cmd += ["--moe_num_experts", str(n_experts), "--n_heads", str(n_heads)]
+            cmd += ["--top_k", str(top_k), "--dim", str(args.dim)]
+            cmd += [
+                "--batch_size",
+                str(args.batch_size),
+                "--seq_len",
+                str(args.seq_len),
+            ]
+            cmd += ["--peer_chunk_size", str(args.peer_chunk_size)]
+            cmd += ["--steps", str(args.steps)]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"{n_experts}\t{n_heads}\t{top_k}\t{impl}\tfailed")
+                continue
+
+            result = json.loads(result.stdout.strip().splitlines()[-1])
+            print(
+                f"{n_experts}\t{n_heads}\t{top_k}\t{impl}\t"
+                f"{result['tokens/s']:.0f}\t{result['peak_rss_mb']:.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Per-step time and memory of the soft prompt embedding and LM head extensions.
+
+Compares `ExtendedEmbedding` and `ExtendedLinear` to the former implementation, which
+concatenated the base table with the new rows at every forward, for growing vocabularies, e.g.:
+
+    python benchmarks/prompt_tuning_extension.py --vocab_sizes 32000,128000 --hidden_size 1024
+
+A training step runs the embedding and the head forward and backward on a batch of sequences
+starting with the soft prompt. A decode step runs them on a single new token, as in `generate`.
+Memory is the peak allocation on GPU, and the bytes allocated during the step on CPU.
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+from mttl.models.modifiers.prompt_tuning import ExtendedEmbedding, ExtendedLinear
+
+
+class ConcatEmbedding(ExtendedEmbedding):
+    def forward(self, input_ids):
+        all_embeds = torch.cat((self.input_embeds, self.new_embeds), dim=0)
+        return F.embedding(input_ids, all_embeds, sparse=self.sparse)
+
+
+class ConcatLinear(ExtendedLinear):
+    def forward(self, x):
+        weights = torch.cat((self.lm_head.weight, self.ext_weight), dim=0)
+        bias = None
+        if self.lm_head.bias is not None:
+            bias = torch.cat((self.lm_head.bias, self.ext_bias), dim=0)
+        return F.linear(x, weights, bias)
+
+
+def measure(fn, device, n_steps):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            fn()
+        torch.cuda.synchronize()
+        seconds = (time.perf_counter() - start) / n_steps
+        return seconds, torch.cuda.max_memory_allocated() / 2**20
+
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        fn()
+    seconds = (time.perf_counter() - start) / n_steps
+    with torch.profiler.profile(profile_memory=True) as prof:
+        fn()
+    allocated = sum(
+        e.self_cpu_memory_usage
+        for e in prof.profiler.function_events
+        if e.self_cpu_memory_usage > 0
+    )
+    return seconds, allocated / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_sizes", type=str, default="32000,64000,128000")
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--soft_prompt_length", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seq_len", type=int, default=64)
+    parser.add_argument("--n_steps", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    config = SimpleNamespace(
+        soft_prompt_length=args.soft_prompt_length, n_skills=args.soft_prompt_length
+    )
+
+    print("vocab\timpl\ttrain_ms\ttrain_mb\tdecode_ms\tdecode_mb")
+    for vocab_size in map(int, args.vocab_sizes.split(",")):
+        embedding = torch.nn.Embedding(vocab_size, args.hidden_size).to(device)
+        lm_head = torch.nn.Linear(args.hidden_size, vocab_size, bias=False).to(device)
+        embedding.weight.requires_grad = False
+        lm_head.weight.requires_grad = False
+
+        input_ids = torch.randint(
+            0, vocab_size, (args.batch_size, args.seq_len), device=device
+        )
+        input_ids[:, : args.soft_prompt_length] = vocab_size + torch.arange(
+            args.soft_prompt_length, device=device
+        )
+        next_ids = input_ids[:, -1:]
+
+        for impl, embed_cls, head_cls in [
+            ("concat", ConcatEmbedding, ConcatLinear),
+            ("split", ExtendedEmbedding, ExtendedLinear),
+        ]:
+            embed = embed_cls(config, embedding)
+            head = head_cls(config, lm_head)
+
+            def train_step():
+                head(embed(input_ids)).float().logsumexp(-1).mean().backward()
+
+            @torch.no_grad()
+            def decode_step():
+                head(embed(next_ids))
+
+            train_s, train_mb = measure(train_step, device, args.n_steps)
+            decode_s, decode_mb = measure(decode_step, device, args.n_steps)
+            print(
+                f"{vocab_size}\t{impl}\t{train_s * 1000:.1f}\t{train_mb:.0f}\t"
+                f"{decode_s * 1000:.2f}\t{decode_mb:.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Size and load time of the sparse mask files, legacy `nonzero()` indices against `encode_mask`.
+
+Saves random masks of a few layers with `save_mask`, and times how long the merge methods take
+to get the flat indices of every layer back, e.g.:
+
+    python benchmarks/sparse_mask_format.py --n_layers 8 --dim 4096 --keep_ratio 0.01 0.05 0.2
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+from mttl.models.library.merging_methods.utils import convert_idx_2_mask
+from mttl.models.modifiers.sparse_mask import SparseMaskFile, save_mask
+
+
+def make_module(n_layers, dim, keep_ratio, block_size=None):
+    module = nn.Module()
+    for i in range(n_layers):
+        adapter = nn.Module()
+        adapter.sparse_layer = nn.Module()
+        if block_size:
+            adapter.sparse_cat, adapter.BLOCK_SIZE = "block_sparse", block_size
+            n_blocks = dim // block_size
+            blocks = (torch.rand(n_blocks, n_blocks) < keep_ratio).float()
+            mask = blocks.repeat_interleave(block_size, 0)
+            mask = mask.repeat_interleave(block_size, 1)
+        else:
+            mask = (torch.rand(dim, dim) < keep_ratio).float()
+        adapter.sparse_layer.weight_mask = nn.Parameter(mask, requires_grad=False)
+        module.add_module(f"layer_{i}", adapter)
+    return module
+
+
+def save_legacy(module, path):
+    mask_dict = {"mask": {}, "mask_shape": {}}
+    for m_name, m in dict(module.named_modules()).items():
+        if "sparse_layer" in m_name:
+            mask_dict["mask"][m_name] = torch.nonzero(m.weight_mask.data).numpy()
+            mask_dict["mask_shape"][m_name] = m.weight_mask.shape
+    np.savez_compressed(path, arr=mask_dict)
+
+
+def load_legacy(path):
+    mask = np.load(path, allow_pickle=True)["arr"].item()
+    return [
+        torch.where(
+            convert_idx_2_mask(mask["mask"][k], mask["mask_shape"][k]).flatten() == 1
+        )[0]
+        for k in mask["mask"]
+    ]
+
+
+def load_compact(path):
+    mask = SparseMaskFile(path)
+    return [mask.indices(k) for k in mask.keys()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_layers", type=int, default=8)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument(
+        "--keep_ratio", type=float, nargs="+", default=[0.01, 0.05, 0.2]
+    )
+    parser.add_argument("--block_size", type=int, default=16)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print(
+        "sparsity\tkeep\traw_mb\tlegacy_mb\tcompact_mb\tlegacy_load_s\tcompact_load_s"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for block_size in [None, args.block_size]:
+            for keep_ratio in args.keep_ratio:
+                module = make_module(args.n_layers, args.dim, keep_ratio, block_size)
+                n_kept = sum(p.sum().item() for p in module.parameters())
+                legacy_path = os.path.join(tmp_dir, "legacy.npz")
+                save_legacy(module, legacy_path)
+                save_mask(module, os.path.join(tmp_dir, "compact"))
+                compact_path = os.path.join(tmp_dir, "compact.npz")
+
+                start = time.perf_counter()
+                legacy = load_legacy(legacy_path)
+                legacy_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                compact = load_compact(compact_path)
+                compact_seconds = time.perf_counter() - start
+                assert all(torch.equal(a, b) for a, b in zip(legacy, compact))
+
+                print(
+                    f"{'block' if block_size else 'regular'}\t{keep_ratio}\t"
+                    f"{n_kept * 16 / 2**20:.2f}\t"
+                    f"{os.path.getsize(legacy_path) / 2**20:.2f}\t"
+                    f"{os.path.getsize(compact_path) / 2**20:.2f}\t"
+                    f"{legacy_seconds:.2f}\t{compact_seconds:.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Throughput of `train_model` on a small Llama model with a slow dataloader, e.g.:
+
+    python benchmarks/training_loop.py --n_steps 50 --load_ms 20
+
+Loading a batch takes `--load_ms` milliseconds, e.g. to read examples from a remote dataset,
+on top of its tokenization by the collate function. The `sync` loop is `train_model` before
+batches were prefetched: it loads each batch when it needs it, and reads the loss after every
+step. The `prefetch` loop is `train_model`.
+"""
+
+import argparse
+import logging
+import re
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from mttl.arguments import ExpertConfig
+from mttl.logging import logger
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.get_optimizer import get_optimizer_and_scheduler
+from mttl.models.modifiers.lora import LoRAConfig
+from mttl.models.train_utils import train_model
+from mttl.models.utils import transfer_batch_to_device
+
+
+def sync_train_model(args, model, datamodule):
+    (optimizer, scheduler), _ = get_optimizer_and_scheduler(
+        model, args, num_train_examples=len(datamodule.train_dataset)
+    )
+    dataloader = datamodule.train_dataloader()
+    iter_train = iter(dataloader)
+    running_loss = 0.0
+    step_seconds, wait_seconds, num_tokens = [], 0.0, 0
+    for step in range(args.total_steps):
+        step_start = time.perf_counter()
+        loss_accum = 0.0
+        model.train()
+        optimizer.zero_grad()
+        for micro_step in range(args.gradient_accumulation_steps):
+            start = time.perf_counter()
+            try:
+                batch = next(iter_train)
+            except StopIteration:
+                iter_train = iter(dataloader)
+                batch = next(iter_train)
+            wait_seconds += time.perf_counter() - start
+            num_tokens += int(batch["attention_mask"].sum())
+
+            batch = transfer_batch_to_device(batch, model.device)
+            loss = model.forward(**batch).loss
+            loss = loss / args.gradient_accumulation_steps
+            loss_accum += loss.detach()
+            loss.backward()
+
+        if loss_accum:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            running_loss += loss_accum.item()
+            optimizer.step()
+            scheduler.step()
+            if model.device.type == "cuda":
+                torch.cuda.synchronize()
+        step_seconds.append(time.perf_counter() - step_start)
+
+    total_seconds = sum(step_seconds)
+    return (
+        num_tokens / total_seconds,
+        wait_seconds / total_seconds,
+        *np.percentile(np.array(step_seconds) * 1000, [50, 90, 99]),
+    )
+
+
+class StatsHandler(logging.Handler):
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Training:"):
+            self.stats = [float(x) for x in re.findall(r"\d+\.\d+", message)]
+            self.stats[1] /= 100
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_steps", type=int, default=50)
+    parser.add_argument("--load_ms", type=float, default=20)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--n_layers", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    words = [f"word{i}" for i in range(2000)]
+    texts = [" ".join(rng.choice(words, rng.randint(50, 150))) for _ in range(512)]
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.train_from_iterator(
+        texts, trainers.BpeTrainer(vocab_size=1000, special_tokens=["<unk>", "<pad>"])
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe, unk_token="<unk>", pad_token="<pad>"
+    )
+
+    def collate(batch):
+        time.sleep(args.load_ms / 1000)
+        batch = dict(
+            tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=128,
+                return_token_type_ids=False,
+                return_tensors="pt",
+            )
+        )
+        batch["labels"] = batch["input_ids"]
+        return batch
+
+    datamodule = SimpleNamespace(
+        train_dataset=texts,
+        train_dataloader=lambda: torch.utils.data.DataLoader(
+            texts, batch_size=args.batch_size, shuffle=True, collate_fn=collate
+        ),
+        dev_dataset=None,
+        test_dataset=None,
+    )
+    config = LlamaConfig(
+        vocab_size=1000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+
+    handler = StatsHandler()
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    print("loop\ttokens_per_s\tdata_wait\tp50_ms\tp90_ms\tp99_ms")
+    for loop in ["sync", "prefetch"]:
+        torch.manual_seed(0)
+        model = ExpertModel(
+            ExpertModelConfig(
+                modifier_config=LoRAConfig(modify_layers="q_proj|v_proj")
+            ),
+            model_object=LlamaForCausalLM(config),
+            device_map="cpu",
+        )
+        training_args = ExpertConfig(
+            trainable_param_names=".*lora.*",
+            total_steps=args.n_steps,
+            train_batch_size=args.batch_size,
+            eval_every=-1,
+            eval_every_n_epoch=-1,
+        )
+        if loop == "sync":
+            stats = sync_train_model(training_args, model, datamodule)
+        else:
+            train_model(training_args, model, datamodule)
+            stats = handler.stats
+        print(
+            f"{loop}\t{stats[0]:.1f}\t{stats[1]:.3f}\t"
+            + "\t".join(f"{s:.1f}" for s in stats[2:])
+        )
+
+
+if __name__ == "__main__":
+    main()
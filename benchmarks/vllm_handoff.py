@@ -0,0 +1,101 @@
+"""Time to first token after switching expert mixes, disk round trip against in-memory handoff.
+
+Before each generation the engine receives the base model merged with a different expert. With
+the disk round trip, the merged checkpoint is written and the engine is rebuilt from it; with the
+handoff, the engine is kept and only the changed tensors are copied into it, e.g.:
+
+    python benchmarks/vllm_handoff.py --n_mixes 5 --n_layers 8
+
+The engine is a CPU stand-in loading the weights by name, as vLLM models do, so the numbers
+measure the transfer of the weights and not the vLLM startup.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from mttl.models.expert_model import MultiExpertModel, MultiExpertModelConfig
+from mttl.models.modifiers.lora import LoRAConfig
+from mttl.models.utils import save_merged_checkpoint
+from mttl.vllm_engines.engines import WeightHandoff
+
+
+class StandInEngine:
+    def __init__(self, model):
+        self.model = model.eval()
+        self.state_dict = model.state_dict()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(LlamaForCausalLM(config))
+
+    @classmethod
+    def from_pretrained(cls, path):
+        return cls(AutoModelForCausalLM.from_pretrained(path))
+
+    @torch.no_grad()
+    def load_weights(self, weights):
+        for name, tensor in weights:
+            self.state_dict[name].copy_(tensor)
+
+    @torch.no_grad()
+    def first_token(self, input_ids):
+        return self.model(input_ids).logits[:, -1].argmax(-1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_mixes", type=int, default=5)
+    parser.add_argument("--n_layers", type=int, default=8)
+    parser.add_argument("--hidden_size", type=int, default=1024)
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    args = parser.parse_args()
+
+    config = LlamaConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.n_layers,
+        num_attention_heads=args.hidden_size // 64,
+    )
+    model = MultiExpertModel(
+        MultiExpertModelConfig(),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+    experts = [f"expert_{i}" for i in range(args.n_mixes)]
+    for expert_name in experts:
+        model.add_empty_expert(
+            expert_name,
+            LoRAConfig(modify_layers="q_proj|v_proj", lora_init_b_random=True),
+        )
+    input_ids = torch.randint(0, args.vocab_size, (1, 32))
+
+    print("mix\tdisk_s\thandoff_s\thanded_over")
+    handoff_engine = StandInEngine.from_config(config)
+    handoff = WeightHandoff(handoff_engine.load_weights)
+    for expert_name in experts:
+        path = tempfile.mkdtemp()
+        start = time.perf_counter()
+        save_merged_checkpoint(model.model, path, expert_name=expert_name)
+        disk_engine = StandInEngine.from_pretrained(path)
+        disk_engine.first_token(input_ids)
+        disk_seconds = time.perf_counter() - start
+        shutil.rmtree(path)
+
+        start = time.perf_counter()
+        updated = handoff.push(model.model, expert_name=expert_name)
+        handoff_engine.first_token(input_ids)
+        handoff_seconds = time.perf_counter() - start
+
+        print(
+            f"{expert_name}\t{disk_seconds:.2f}\t{handoff_seconds:.2f}\t{len(updated)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -367,6 +367,10 @@ class TrainingArgs(DataArgs):
     adafactor_scale_parameter: bool = True
     adafactor_warmup_init: bool = False
     adafactor_relative_step: bool = False
+    # pack the trainable parameters of each param group in a flat buffer
+    optimizer_flat_buffers: bool = False
+    # compute the training loss in chunks of tokens, without the logits of the whole batch
+    loss_chunk_size: int = None
     num_train_epochs: int = -1
     warmup_steps: int = -1
     total_steps: int = -1
@@ -375,6 +379,9 @@ class TrainingArgs(DataArgs):
     save_each_epoch: bool = False
     eval_every: int = None
     eval_every_n_epoch: int = 1
+    # compute the eval loss in chunks of tokens, without the logits of the whole batch
+    eval_loss_only: bool = False
+    eval_loss_chunk_size: int = 1024
     seed: int = 42
     debug: bool = False
 
@@ -389,6 +396,8 @@ class TrainingArgs(DataArgs):
     library_id: str = None
     destination_library_id: str = None
     logging_prefix: str = ""
+    log_every: int = 10  # steps between reads of the training loss
+    prefetch_batches: int = 2  # batches loaded ahead of the training loop
 
     router_weight_decay: float = None  # router weight decay
     router_learning_rate: float = None
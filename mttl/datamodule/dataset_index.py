@@ -0,0 +1,147 @@
+"""On-disk index of the rows of a dataset partitioned by the values of some of its columns.
+
+The rows are sorted by the values of the indexed columns, e.g. task name, split and template type,
+so that every combination of values, or group, is a contiguous range of row indices. Selecting a
+task then only reads the rows of its groups instead of filtering the whole dataset. The index is
+built once per dataset fingerprint and stored in `MTTL_DATASET_INDEX_DIR`, or
+`~/.cache/mttl/dataset_index` by default.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pyarrow.compute as pc
+
+from mttl.logging import logger
+
+INDEX_FORMAT = "1"
+
+
+def dataset_index_dir() -> Path:
+    if "MTTL_DATASET_INDEX_DIR" in os.environ:
+        return Path(os.environ["MTTL_DATASET_INDEX_DIR"])
+    return Path.home() / ".cache" / "mttl" / "dataset_index"
+
+
+class DatasetIndex:
+    """Groups of rows of a dataset sharing the same values of `columns`.
+
+    `groups` holds the codes of the values of every group, with shape (n_groups, n_columns), and
+    the rows of group `i` are `order[offsets[i] : offsets[i + 1]]`, in increasing order.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "meta.json") as f:
+            meta = json.load(f)
+
+        self.fingerprint = meta["fingerprint"]
+        self.num_rows = meta["num_rows"]
+        self.columns = meta["columns"]
+        self.vocab = meta["vocab"]
+        self.groups = np.load(self.path / "groups.npy")
+        self.offsets = np.load(self.path / "offsets.npy")
+        # only the rows of the selected groups are read
+        self.order = np.load(self.path / "order.npy", mmap_mode="r")
+
+    @staticmethod
+    def index_path(dataset, columns: List[str], cache_dir=None) -> Path:
+        key = hashlib.md5(json.dumps([INDEX_FORMAT, columns]).encode()).hexdigest()
+        return Path(cache_dir or dataset_index_dir()) / f"{dataset._fingerprint}-{key}"
+
+    @classmethod
+    def from_dataset(cls, dataset, columns: List[str], cache_dir=None):
+        """Loads the index of `dataset` over `columns`, building it if it does not exist yet."""
+        path = cls.index_path(dataset, columns, cache_dir)
+        if not (path / "meta.json").exists():
+            logger.info(
+                f"Building index of dataset {dataset._fingerprint} on {columns}."
+            )
+            cls.build(dataset, columns, path)
+        return cls(path)
+
+    @staticmethod
+    def build(dataset, columns: List[str], path):
+        table = dataset.with_format("arrow")[:]
+
+        codes, vocab = [], {}
+        for column in columns:
+            encoded = pc.dictionary_encode(
+                table.column(column), null_encoding="encode"
+            ).combine_chunks()
+            codes.append(encoded.indices.to_numpy(zero_copy_only=False))
+            vocab[column] = encoded.dictionary.to_pylist()
+
+        codes = np.stack(codes, axis=1).astype(np.int32)
+        # lexsort sorts by its last key first, and is stable
+        order = np.lexsort(codes.T[::-1])
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(
+            np.concatenate(
+                [[True], np.any(sorted_codes[1:] != sorted_codes[:-1], axis=1)]
+            )
+        )
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(dir=path.parent))
+        np.save(tmp_path / "groups.npy", sorted_codes[starts])
+        np.save(tmp_path / "offsets.npy", np.append(starts, len(order)))
+        np.save(tmp_path / "order.npy", order.astype(np.int64))
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump(
+                {
+                    "format": INDEX_FORMAT,
+                    "fingerprint": dataset._fingerprint,
+                    "num_rows": len(order),
+                    "columns": columns,
+                    "vocab": vocab,
+                },
+                f,
+            )
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # built concurrently by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _matching_groups(self, filters: Dict[str, Iterable]) -> np.ndarray:
+        mask = np.ones(len(self.groups), dtype=bool)
+        for column, values in filters.items():
+            values = set(values)
+            codes = [i for i, v in enumerate(self.vocab[column]) if v in values]
+            mask &= np.isin(self.groups[:, self.columns.index(column)], codes)
+        return np.flatnonzero(mask)
+
+    def values(self, column: str, **filters) -> List:
+        """Values of `column` in the rows matching `filters`, in order of first appearance."""
+        groups = self._matching_groups(filters)
+        codes = np.unique(self.groups[groups, self.columns.index(column)])
+        return [self.vocab[column][code] for code in codes]
+
+    def rows(self, **filters) -> np.ndarray:
+        """Increasing indices of the rows whose value of every column of `filters` is in the
+        given values, e.g. `rows(task_name=["task_a"], split=["train"])`."""
+        groups = self._matching_groups(filters)
+        if len(groups) == len(self.groups):
+            return np.arange(self.num_rows)
+
+        rows = [self.order[self.offsets[g] : self.offsets[g + 1]] for g in groups]
+        return np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+
+    def select(self, dataset, **filters):
+        """Selects the rows of `dataset` matching `filters`, see `rows`."""
+        if dataset._fingerprint != self.fingerprint:
+            raise ValueError("The dataset does not match the fingerprint of the index.")
+
+        rows = self.rows(**filters)
+        if len(rows) == self.num_rows:
+            return dataset
+        return dataset.select(rows)
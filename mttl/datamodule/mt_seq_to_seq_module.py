@@ -6,7 +6,8 @@ import numpy
 from datasets import Dataset, concatenate_datasets
 
 from mttl.datamodule.base import DataModule, DatasetConfig
-from mttl.datamodule.utils import maybe_filter_hf_dataset_by_task
+from mttl.datamodule.dataset_index import DatasetIndex
+from mttl.datamodule.utils import resolve_task_names
 from mttl.logging import logger
 from mttl.models.library.dataset_library import DatasetLibrary
 
@@ -24,6 +25,97 @@ def is_phi2_eval_task(task):
     return task in eval_tasks
 
 
+def _sample_shots(rng, is_train, num_samples):
+    """Samples `num_samples` distinct train examples for every example, other than itself.
+
+    Returns an array of indices of shape (n_examples, num_samples), padded with -1 for the
+    examples with fewer train examples to choose from.
+    """
+    train_indices = numpy.flatnonzero(is_train)
+    shots = numpy.full((len(is_train), num_samples), -1)
+    if len(train_indices) == 0:
+        return shots
+
+    # positions in the train examples, the example itself excluded
+    pool_size = len(train_indices) - is_train.astype(int)
+    rows = numpy.flatnonzero(pool_size >= num_samples)
+    # Floyd's sampling of distinct positions, for all rows at once: the i-th draw is in
+    # [0, pool_size - num_samples + i], and is replaced by its upper bound when already drawn
+    picks = numpy.empty((len(rows), num_samples), dtype=int)
+    for i in range(num_samples):
+        high = pool_size[rows] - num_samples + i
+        draws = (rng.random_sample(len(rows)) * (high + 1)).astype(int)
+        repeated = (picks[:, :i] == draws[:, None]).any(axis=1)
+        picks[:, i] = numpy.where(repeated, high, draws)
+    # the order of the shots is random as well
+    order = numpy.argsort(rng.random_sample(picks.shape), axis=1)
+    shots[rows] = numpy.take_along_axis(picks, order, axis=1)
+
+    for row in numpy.flatnonzero(pool_size < num_samples):
+        shots[row, : pool_size[row]] = rng.permutation(pool_size[row])
+
+    # positions past the example itself are shifted by one to skip it
+    rank = numpy.searchsorted(train_indices, numpy.arange(len(is_train)))
+    shots = shots + (is_train[:, None] & (shots >= rank[:, None]))
+    return numpy.where(shots >= 0, train_indices[numpy.maximum(shots, 0)], -1)
+
+
+def _token_counts(tokenizer, texts):
+    input_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+    return numpy.array([len(ids) for ids in input_ids], dtype=int)
+
+
+def _fit_shots(
+    tokenizer,
+    max_input_length,
+    shot_texts,
+    shot_counts,
+    shots,
+    n_shots,
+    sources,
+    source_counts,
+):
+    """Number of shots to keep for every example, so that its prompt fits in `max_input_length`.
+
+    Shots are removed from the end of the prompt, keeping at least one. The length of a prompt is
+    estimated from the token counts of the sources and of the shots followed by their separator,
+    and only the prompts whose estimate is close to the limit are tokenized.
+    """
+    # estimated prompt length with the first n shots, for n in 0..num_samples
+    lengths = numpy.cumsum(
+        numpy.where(shots >= 0, shot_counts[numpy.maximum(shots, 0)], 0), axis=1
+    )
+    lengths = numpy.concatenate([numpy.zeros((len(shots), 1), dtype=int), lengths], 1)
+    lengths += (source_counts + tokenizer.num_special_tokens_to_add())[:, None]
+    # tokens can merge or split at the boundaries between the pieces that were counted
+    n_range = numpy.arange(shots.shape[1] + 1)
+    margins = 8 * (n_range + 1)
+
+    # at most, the shots whose lower estimate fits
+    fits = (lengths - margins <= max_input_length) & (n_range <= n_shots[:, None])
+    keep = numpy.where(fits, n_range, 0).max(1)
+    keep = numpy.minimum(numpy.maximum(keep, 1), n_shots)
+
+    # the prompts close to the limit are tokenized, removing shots until they fit
+    rows = numpy.arange(len(shots))
+    rows = rows[(keep > 1) & (lengths[rows, keep] + margins[keep] > max_input_length)]
+    while len(rows):
+        prompts = [
+            "\n\n".join(shot_texts[i] for i in shots[row, : keep[row]])
+            + "\n\n"
+            + sources[row]
+            for row in rows
+        ]
+        too_long = numpy.array(
+            [len(ids) > max_input_length for ids in tokenizer(prompts)["input_ids"]],
+            dtype=bool,
+        )
+        rows = rows[too_long]
+        keep[rows] -= 1
+        rows = rows[keep[rows] > 1]
+    return keep
+
+
 def augment_few_shot_task(
     dataset,
     num_samples=None,
@@ -33,82 +125,86 @@ def augment_few_shot_task(
     seed=42,
     modify_task_source=True,
 ):
+    """Prepends few-shot examples to the source of every example of `dataset`.
+
+    The shots are either the given `few_shots`, or `num_samples` train examples of `dataset`
+    sampled for every example. Shots are removed from the end of the prompts that do not fit
+    in `max_input_length`, keeping at least one.
+    """
     if num_samples is None and few_shots is None:
         raise ValueError("Either num_samples or few_shots must be specified.")
 
-    len_dataset = len(dataset)
     rng = numpy.random.RandomState(seed)
+    sources = dataset["source"]
+    targets = dataset["target"]
 
     if few_shots is None:
-        split = dataset["split"]
-        train_indices = set(i for i in range(len_dataset) if split[i] == "train")
-
-    def map_to_few_shot(_, index):
+        is_train = numpy.array(dataset["split"]) == "train"
+        shots = _sample_shots(rng, is_train, num_samples)
+        shot_texts = [" ".join([s, t]) for s, t in zip(sources, targets)]
+    else:
+        shot_texts = [
+            " ".join([s, t]) for s, t in zip(few_shots["source"], few_shots["target"])
+        ]
+        shots = numpy.tile(numpy.arange(len(shot_texts)), (len(dataset), 1))
+
+    n_shots = (shots >= 0).sum(1)
+    if tokenizer is not None and max_input_length is not None and len(dataset):
+        source_counts = _token_counts(tokenizer, sources)
         if few_shots is None:
-            index_range = list(train_indices - {index})
-            index_chosen = rng.choice(index_range, size=num_samples, replace=False)
-            index_chosen = list(map(int, index_chosen))  # datasets complains otherwise
-
-            sources = [dataset[i]["source"] for i in index_chosen]
-            targets = [dataset[i]["target"] for i in index_chosen]
-        else:
-            sources = few_shots["source"]
-            targets = few_shots["target"]
-
-        context = (
-            "\n\n".join(
-                [" ".join([source, target]) for source, target in zip(sources, targets)]
+            # the shots start with the sources of the examples, counted once
+            shot_counts = source_counts + _token_counts(
+                tokenizer, [" " + target + "\n\n" for target in targets]
             )
-            + "\n\n"
+        else:
+            shot_counts = _token_counts(tokenizer, [t + "\n\n" for t in shot_texts])
+        n_shots = _fit_shots(
+            tokenizer,
+            max_input_length,
+            shot_texts,
+            shot_counts,
+            shots,
+            n_shots,
+            sources,
+            source_counts,
         )
-        prompt = context + dataset[index]["source"]
-
-        if tokenizer is not None and max_input_length is not None:
-            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
-
-            while (
-                input_ids.shape[-1] > max_input_length
-                and len(context.split("\n\n")) > 2
-            ):
-                context = "\n\n".join(context.split("\n\n")[:-2]) + "\n\n"
-                prompt = context + dataset[index]["source"]
-                input_ids = tokenizer(prompt, return_tensors="pt").input_ids
-
-        return {
-            "source": prompt,
-            "target": dataset[index]["target"],
-            "task_name": dataset[index]["task_name"],
-            "task_source": (
-                "few_shot_{}".format(dataset[index]["task_source"])
-                if modify_task_source
-                else dataset[index]["task_source"]
-            ),
-            "split": (
-                dataset[index]["split"] if "split" in dataset.column_names else None
-            ),
-        }
-
-    augmented_dataset = dataset.map(map_to_few_shot, with_indices=True, num_proc=16)
-    return augmented_dataset
+
+    columns = {name: dataset[name] for name in dataset.column_names}
+    columns["source"] = [
+        "\n\n".join(shot_texts[i] for i in row[:n]) + "\n\n" + source
+        for row, n, source in zip(shots, n_shots, sources)
+    ]
+    if modify_task_source:
+        columns["task_source"] = [
+            "few_shot_{}".format(task_source) for task_source in columns["task_source"]
+        ]
+    if "split" not in columns:
+        columns["split"] = [None] * len(dataset)
+        return Dataset.from_dict(columns)
+    return Dataset.from_dict(columns, features=dataset.features)
 
 
 def augment_few_shot(
     dataset, num_samples, tokenizer=None, max_input_length=None, seed=42
 ):
-    """Augment the dataset with few-shot examples."""
-    from tqdm.auto import tqdm
+    """Augment the dataset with few-shot examples, sampled among the examples of each task."""
+    task_names = numpy.array(dataset["task_name"])
+    # tasks in order of appearance, as `dataset.unique`
+    tasks, first_index, inverse = numpy.unique(
+        task_names, return_index=True, return_inverse=True
+    )
+    task_indices = numpy.argsort(inverse, kind="stable")
+    task_indices = numpy.split(task_indices, numpy.cumsum(numpy.bincount(inverse))[:-1])
 
     augmented_dataset = []
-    for source in tqdm(dataset.unique("task_name")):
+    for task in numpy.argsort(first_index):
         augmented_dataset.append(
-            Dataset.from_list(
-                augment_few_shot_task(
-                    dataset.filter(lambda x: x["task_name"] == source),
-                    num_samples,
-                    tokenizer,
-                    max_input_length,
-                    seed,
-                )
+            augment_few_shot_task(
+                dataset.select(task_indices[task]),
+                num_samples,
+                tokenizer=tokenizer,
+                max_input_length=max_input_length,
+                seed=seed,
             )
         )
     return concatenate_datasets([dataset] + augmented_dataset)
@@ -156,21 +252,23 @@ class FlatMultiTaskModule(DataModule):
                 desc="Creating split column.",
             )
 
-        (
-            self._task_names,
-            self._task_to_id,
-            train_dataset,
-            _,
-            _,
-        ) = maybe_filter_hf_dataset_by_task(
-            self.dataset, "task_name", self.config.finetune_task_name, n_proc=n_proc
-        )
-
-        train_dataset = apply_source_template(
-            train_dataset, self.config.source_template
+        dataset = self.dataset["train"]
+        index = DatasetIndex.from_dataset(dataset, ["task_name", "split"])
+        self._task_names, self._task_to_id = resolve_task_names(
+            index.values("task_name"), self.config.finetune_task_name
         )
+        filters = {}
+        if self.config.finetune_task_name:
+            filters["task_name"] = self._task_names
+
+        def select_split(*splits):
+            return apply_source_template(
+                index.select(dataset, split=splits, **filters),
+                self.config.source_template,
+            )
 
         if self.config.augment_few_shot > 0:
+            train_dataset = select_split(*index.values("split"))
             train_dataset_aug = augment_few_shot(
                 train_dataset,
                 self.config.augment_few_shot,
@@ -180,21 +278,25 @@ class FlatMultiTaskModule(DataModule):
             train_dataset_aug = train_dataset_aug.shuffle()
             train_dataset = train_dataset_aug.select(range(len(train_dataset)))
 
-        self.train_dataset = train_dataset.filter(
-            lambda x: x["split"] == "train",
-            num_proc=n_proc,
-            desc="Creating train set",
-        )
-        self.dev_dataset = train_dataset.filter(
-            lambda x: x["split"] in ["validation", "valid"],
-            num_proc=n_proc,
-            desc="Creating valid set",
-        )
-        self.test_dataset = train_dataset.filter(
-            lambda x: x["split"] == "test",
-            num_proc=n_proc,
-            desc="Creating test set",
-        )
+            self.train_dataset = train_dataset.filter(
+                lambda x: x["split"] == "train",
+                num_proc=n_proc,
+                desc="Creating train set",
+            )
+            self.dev_dataset = train_dataset.filter(
+                lambda x: x["split"] in ["validation", "valid"],
+                num_proc=n_proc,
+                desc="Creating valid set",
+            )
+            self.test_dataset = train_dataset.filter(
+                lambda x: x["split"] == "test",
+                num_proc=n_proc,
+                desc="Creating test set",
+            )
+        else:
+            self.train_dataset = select_split("train")
+            self.dev_dataset = select_split("validation", "valid")
+            self.test_dataset = select_split("test")
 
         if len(self.test_dataset) == 0:
             self.test_dataset = self.dev_dataset
@@ -230,75 +332,55 @@ class FlanModule(DataModule):
                 "Dataset must have a 'split' column, try removing the dataset manually from the cache."
             )
 
-        if self.config.include_template_type != "*":
-            dataset = dataset.filter(
-                partial(
-                    filter_template_type,
-                    set(self.config.include_template_type.split(",")),
-                ),
-                num_proc=n_proc,
-                desc="Filtering template types",
-            )
+        # template types, task sources, tasks and splits are selected with an index of the
+        # dataset, which is only built once, so only the selected rows are read
+        columns = ["task_name", "split", "template_type", "task_source"]
+        dataset = dataset["train"]
+        index = DatasetIndex.from_dataset(
+            dataset, [c for c in columns if c in dataset.column_names]
+        )
 
+        filters = {}
+        if self.config.include_template_type != "*":
+            filters["template_type"] = self.config.include_template_type.split(",")
         if self.config.include_task_source != "*":
-            dataset = dataset.filter(
-                partial(
-                    filter_task_source, set(self.config.include_task_source.split(","))
-                ),
-                num_proc=n_proc,
-                desc="Filtering task sources",
-            )
-
-        (
-            self._task_names,
-            self._task_to_id,
-            train_dataset,
-            _,
-            _,
-        ) = maybe_filter_hf_dataset_by_task(
-            dataset, "task_name", self.config.finetune_task_name, n_proc=n_proc
-        )
+            filters["task_source"] = self.config.include_task_source.split(",")
 
-        train_dataset = apply_source_template(
-            train_dataset, self.config.source_template
+        self._task_names, self._task_to_id = resolve_task_names(
+            index.values("task_name", **filters), self.config.finetune_task_name
         )
+        if self.config.finetune_task_name:
+            filters["task_name"] = self._task_names
 
-        if "split" in dataset.column_names["train"]:
-            self.train_dataset = train_dataset.filter(
-                lambda x: x["split"] == "train",
-                num_proc=n_proc,
-                desc="Creating train set",
-            )
-            self.dev_dataset = train_dataset.filter(
-                lambda x: x["split"] == "validation",
-                num_proc=n_proc,
-                desc="Creating valid set",
-            )
-            self.test_dataset = train_dataset.filter(
-                lambda x: x["split"] == "test",
-                num_proc=n_proc,
-                desc="Creating test set",
-            )
-        else:
-            self.train_dataset, self.dev_dataset = self.create_train_valid_split(
-                train_dataset
-            )
-            self.test_dataset = self.dev_dataset
-
+        train_filters = filters
         if self.config.remove_phi_eval_tasks:
             assert not any(
                 name in self.config.include_task_source.lower()
                 for name in ["niv2", "*"]
             ), "niv2 not currently supported for phi-2 eval exclusion"
 
-            self.train_dataset = self.train_dataset.filter(
-                lambda x: not is_phi2_eval_task(x["task_name"]),
-                num_proc=n_proc,
-                desc="Filtering phi-2 eval tasks from training mixture.",
+            train_filters = dict(
+                filters,
+                task_name=[
+                    task
+                    for task in index.values("task_name", **filters)
+                    if not is_phi2_eval_task(task)
+                ],
+            )
+
+        def select_split(split, filters):
+            return apply_source_template(
+                index.select(dataset, split=[split], **filters),
+                self.config.source_template,
+            )
+
+        self.train_dataset = select_split("train", train_filters)
+        self.dev_dataset = select_split("validation", filters)
+        self.test_dataset = select_split("test", filters)
+
+        if self.config.remove_phi_eval_tasks and not self.train_dataset.num_rows:
+            logger.warning(
+                "No training examples left after filtering. "
+                "Please set `remove_phi_eval_tasks=False` "
+                "if you want to train on phi-2 eval tasks."
             )
-            if not self.train_dataset.num_rows:
-                logger.warning(
-                    "No training examples left after filtering. "
-                    "Please set `remove_phi_eval_tasks=False` "
-                    "if you want to train on phi-2 eval tasks."
-                )
@@ -20,17 +20,7 @@ def maybe_filter_hf_dataset_by_task(
         all_tasks = all_tasks.union(set(dataset["test"][task_field]))
 
     if task_names:
-        task_names = (
-            sorted(task_names.split(","))
-            if isinstance(task_names, str)
-            else sorted(task_names)
-        )
-        if not set(task_names).issubset(all_tasks):
-            raise ValueError(
-                "task_names must be a subset of the available tasks. Got {} and {}".format(
-                    task_names, all_tasks
-                )
-            )
+        task_names, _ = resolve_task_names(all_tasks, task_names)
 
     train_dataset, dev_dataset, test_dataset = None, None, None
 
@@ -61,11 +51,29 @@ def maybe_filter_hf_dataset_by_task(
         if "test" in dataset:
             test_dataset = dataset["test"]
 
-    if task_names is None:
+    task_names, task_to_id = resolve_task_names(all_tasks, task_names)
+    return task_names, task_to_id, train_dataset, dev_dataset, test_dataset
+
+
+def resolve_task_names(all_tasks, task_names: str = None):
+    """Returns the sorted task names to keep, all the tasks if None, and their ids."""
+    if task_names:
+        task_names = (
+            sorted(task_names.split(","))
+            if isinstance(task_names, str)
+            else sorted(task_names)
+        )
+        if not set(task_names).issubset(all_tasks):
+            raise ValueError(
+                "task_names must be a subset of the available tasks. Got {} and {}".format(
+                    task_names, all_tasks
+                )
+            )
+    else:
         task_names = list(all_tasks)
 
     task_to_id = {task: i for i, task in enumerate(task_names)}
-    return task_names, task_to_id, train_dataset, dev_dataset, test_dataset
+    return task_names, task_to_id
 
 
 def tokenizer_merges_space(tokenizer):
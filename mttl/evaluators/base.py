@@ -1,9 +1,13 @@
+import hashlib
+import json
 import math
 import os
+import re
+import time
 from abc import ABC, abstractmethod
 from collections import defaultdict
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import dataclass, is_dataclass, replace
 from typing import List
 
 import numpy as np
@@ -61,6 +65,65 @@ def compute_task_aggregation(task_names, metric_values):
     return aggregation
 
 
+def _tensor_checksum(tensor, chunk_size=2**24):
+    """Position-sensitive sum of the bits of `tensor`, computed on its device."""
+    flat = tensor.detach().reshape(-1)
+    if flat.dtype == torch.bool:
+        flat = flat.to(torch.uint8)
+    bits = flat.view(
+        {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}[
+            flat.element_size()
+        ]
+    )
+
+    checksum = torch.zeros((), dtype=torch.int64, device=flat.device)
+    for start in range(0, bits.numel(), chunk_size):
+        chunk = bits[start : start + chunk_size].long()
+        positions = torch.arange(
+            start, start + chunk.numel(), dtype=torch.int64, device=flat.device
+        )
+        # odd pseudo-random multipliers, integer overflow wraps around
+        checksum += (chunk * ((positions * 2654435761) | 1)).sum()
+    return checksum
+
+
+@torch.no_grad()
+def weights_fingerprint(model) -> str:
+    """Fingerprint of the weights of `model`, e.g. to cache evaluation results.
+
+    Checksums are computed on the device of the weights, only one integer per tensor is copied
+    to the host.
+    """
+    digest = hashlib.sha256()
+    checksums = []
+    for name, tensor in model.state_dict().items():
+        digest.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype};".encode())
+        if tensor.numel() > 0:
+            checksums.append(_tensor_checksum(tensor))
+    for checksum in checksums:
+        digest.update(str(checksum.item()).encode())
+    return digest.hexdigest()
+
+
+def model_settings(model) -> str:
+    """Settings of `model` which change its outputs but not its weights, e.g. its routing, to
+    cache evaluation results together with `weights_fingerprint`."""
+    settings = {"class": type(model).__name__}
+    for name in ["hparams", "config", "selector_config", "modifier_config"]:
+        settings[name] = repr(getattr(model, name, None))
+
+    # selectors are configured when they are created, and can be changed afterwards
+    selectors = getattr(model, "selectors", None)
+    if isinstance(selectors, dict):
+        settings["selectors"] = {
+            key: [repr(getattr(selector, "config", None)) for selector in values]
+            for key, values in selectors.items()
+        }
+
+    # default object reprs hold memory addresses, which change between runs
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", json.dumps(settings, sort_keys=True))
+
+
 def switch_to_eval_mode(fn):
     def _switch_to_eval_mode(*args, **kwargs):
         if not hasattr(args[1], "training"):
@@ -78,6 +141,81 @@ def switch_to_eval_mode(fn):
     return _switch_to_eval_mode
 
 
+class CollatedBatches:
+    """Batches collated ahead of time from `dataloader`, which stand in for it.
+
+    Iterating yields the collated batches, other attributes, e.g. `dataset` or `batch_size`,
+    are the ones of `dataloader`.
+    """
+
+    def __init__(self, dataloader, batches):
+        self.dataloader = dataloader
+        self.batches = batches
+
+    def __getattr__(self, name):
+        if name in ("dataloader", "batches"):
+            raise AttributeError(name)
+        return getattr(self.dataloader, name)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for batch in self.batches:
+            # evaluators pop keys from the batches
+            yield dict(batch) if isinstance(batch, dict) else batch
+
+
+class KeptBatches:
+    """Batches that can be iterated many times, e.g. collated once for repeated evaluations.
+
+    With `time_budget`, the first iteration stops once it has run for `time_budget` seconds,
+    after at least one batch, and every following iteration yields the same number of batches,
+    so that the evaluations stay comparable whatever the load of the machine. Other attributes
+    are the ones of `batches`.
+    """
+
+    def __init__(self, batches, time_budget=None):
+        self.batches = batches
+        self.num_batches = None
+        self.time_budget = time_budget
+
+    def __getattr__(self, name):
+        if name in ("batches", "_time_budget"):
+            raise AttributeError(name)
+        return getattr(self.batches, name)
+
+    @property
+    def time_budget(self):
+        return self._time_budget
+
+    @time_budget.setter
+    def time_budget(self, value):
+        if value != getattr(self, "_time_budget", None):
+            # measured again at the next iteration
+            self.num_batches = None
+        self._time_budget = value
+
+    def __len__(self):
+        if self.num_batches is not None:
+            return self.num_batches
+        return len(self.batches)
+
+    def __iter__(self):
+        measure = self.time_budget is not None and self.num_batches is None
+        start, i = time.perf_counter(), -1
+        for i, batch in enumerate(self.batches):
+            if measure and i > 0 and time.perf_counter() - start > self.time_budget:
+                self.num_batches = i
+                return
+            if self.num_batches is not None and i >= self.num_batches:
+                return
+            # evaluators pop keys from the batches
+            yield dict(batch) if isinstance(batch, dict) else batch
+        if measure:
+            self.num_batches = i + 1
+
+
 class Evaluator(ABC):
     def __init__(
         self,
@@ -96,8 +234,80 @@ class Evaluator(ABC):
         self.config = deepcopy(config)
         self.use_vllm = use_vllm
         self._last_metrics = None
+        # batches collated ahead of time, by (split, subsample, shuffle)
+        self._prefetched = {}
+        # batches collated once and reused by every evaluation, by (split, subsample, shuffle)
+        self._kept = {}
+        # tokenizer of the collations running in the background, and the one it copies
+        self._background_tokenizer = (None, None)
+
+    def _collate_batches(self, split, subsample, shuffle, background=False):
+        dataloader = self._get_dataloader(split, subsample, shuffle)
+        collate_fn = dataloader.collate_fn
+        if background:
+            collate_fn = self._background_collate_fn(collate_fn)
+        batches = list(
+            torch.utils.data.DataLoader(
+                dataloader.dataset,
+                batch_sampler=dataloader.batch_sampler,
+                collate_fn=collate_fn,
+            )
+        )
+        return CollatedBatches(dataloader, batches)
+
+    def _background_collate_fn(self, collate_fn):
+        """Returns `collate_fn` with a copy of its tokenizer, fast tokenizers can't be used by
+        two threads at once and the main thread keeps using the original one."""
+        tokenizer = getattr(collate_fn, "tokenizer", None)
+        if tokenizer is None or not is_dataclass(collate_fn):
+            return collate_fn
+
+        original, copy = self._background_tokenizer
+        if original is not tokenizer:
+            copy = deepcopy(tokenizer)
+            self._background_tokenizer = (tokenizer, copy)
+        return replace(collate_fn, tokenizer=copy)
+
+    def prefetch(self, executor, split, subsample=-1, shuffle=False):
+        """Collates the batches of a split in `executor`, for the next `get_dataloader` call.
+
+        Batches are collated in the calling process, and not in dataloader workers, so that the
+        tokenization of the next task can run while the model evaluates the current one. They
+        are tokenized with a copy of the tokenizer of the datamodule.
+        """
+        self._prefetched[(split, subsample, shuffle)] = executor.submit(
+            self._collate_batches, split, subsample, shuffle, background=True
+        )
+
+    def keep_batches(self, split, subsample=-1, shuffle=False, time_budget=None):
+        """Collates the batches of a split once, and returns them at every following
+        `get_dataloader` call, e.g. for evaluations repeated during training.
+
+        The subsample, and the order of the batches, are fixed at the first call. If `time_budget`
+        is given, evaluations use the number of batches that the first one ran in
+        `time_budget` seconds.
+        """
+        key = (split, subsample, shuffle)
+        if key not in self._kept:
+            self._kept[key] = KeptBatches(
+                self._collate_batches(split, subsample, shuffle)
+            )
+        self._kept[key].time_budget = time_budget
+        return self._kept[key]
 
     def get_dataloader(self, split, subsample, shuffle):
+        if (split, subsample, shuffle) in self._kept:
+            return self._kept[(split, subsample, shuffle)]
+
+        prefetched = self._prefetched.pop((split, subsample, shuffle), None)
+        if prefetched is not None:
+            try:
+                return prefetched.result()
+            except Exception as e:
+                logger.warning("Prefetching of the %s split failed: %s", split, e)
+        return self._get_dataloader(split, subsample, shuffle)
+
+    def _get_dataloader(self, split, subsample, shuffle):
         if self.datamodule is None:
             raise ValueError("No datamodule initialized!")
 
@@ -372,38 +582,117 @@ class GenerativeEvaluator(Evaluator):
 
 
 class EvaluatorRunner:
-    def __init__(self, output_path=None):
+    """Runs a set of evaluators and aggregates their scores.
+
+    If `cache_path` is given, the score of each task is stored there, keyed by a fingerprint of
+    the weights and the settings of the model, e.g. its routing, of the evaluator and of the
+    split, as soon as it is computed.
+    Cached tasks are skipped, which resumes interrupted runs and makes re-evaluating an
+    unchanged model free. With `prefetch`, the batches of the next task are collated while
+    the current one is evaluated.
+    """
+
+    def __init__(self, output_path=None, cache_path=None, prefetch=True):
         self.evaluators = {}
         self.output_path = output_path
+        self.cache_path = cache_path
+        self.prefetch = prefetch
 
     def add_evaluator(self, name, evaluator):
         self.evaluators[name] = evaluator
 
+    def _load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except json.JSONDecodeError as e:
+            logger.warning(
+                "Ignoring corrupted evaluation cache %s: %s", self.cache_path, e
+            )
+            return {}
+
+    def _save_cache(self, cache):
+        if os.path.dirname(self.cache_path):
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        # written to a temporary file first, an interrupted write keeps the previous cache
+        with open(self.cache_path + ".tmp", "w") as f:
+            json.dump(cache, f, indent=2, default=float)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    @staticmethod
+    def _cache_key(evaluator, fingerprint, settings, split):
+        key = {
+            "weights": fingerprint,
+            "model": settings,
+            "evaluator": type(evaluator).__name__,
+            "config": repr(evaluator.config),
+            "generation_kwargs": repr(getattr(evaluator, "generation_kwargs", None)),
+            "split": split,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
     def run(self, module, verbose=False):
-        import json
+        from concurrent.futures import ThreadPoolExecutor
 
         import prettytable
 
         if self.output_path:
             os.makedirs(self.output_path, exist_ok=True)
 
-        scores = {}
-        for name in sorted(self.evaluators.keys()):
-            logger.info("Evaluating %s", name)
-
-            if self.output_path:
-                task_output_path = os.path.join(self.output_path, name)
-                os.makedirs(self.output_path, exist_ok=True)
-            else:
-                task_output_path = None
-
-            scores[name] = self.evaluators[name].evaluate(
-                module, verbose=verbose, output_path=task_output_path, split="test"
-            )
+        names = sorted(self.evaluators.keys())
+        cache = self._load_cache()
+        keys = {}
+        if self.cache_path is not None:
+            fingerprint = weights_fingerprint(module)
+            settings = model_settings(module)
+            keys = {
+                name: self._cache_key(
+                    self.evaluators[name], fingerprint, settings, "test"
+                )
+                for name in names
+            }
+        to_evaluate = [name for name in names if keys.get(name) not in cache]
 
-            if self.output_path:
-                with open(self.output_path + "/metrics.json", "w") as f:
-                    json.dump(scores, f, indent=2)
+        scores = {}
+        executor = ThreadPoolExecutor(max_workers=1) if self.prefetch else None
+        try:
+            for name in names:
+                if name not in to_evaluate:
+                    logger.info("Using cached results for %s", name)
+                    scores[name] = cache[keys[name]]["score"]
+                    continue
+
+                logger.info("Evaluating %s", name)
+                next_index = to_evaluate.index(name) + 1
+                if executor is not None and next_index < len(to_evaluate):
+                    self._prefetch(executor, to_evaluate[next_index])
+
+                if self.output_path:
+                    task_output_path = os.path.join(self.output_path, name)
+                    os.makedirs(self.output_path, exist_ok=True)
+                else:
+                    task_output_path = None
+
+                scores[name] = self.evaluators[name].evaluate(
+                    module, verbose=verbose, output_path=task_output_path, split="test"
+                )
+                # batches prefetched but not used by the evaluator
+                getattr(self.evaluators[name], "_prefetched", {}).clear()
+
+                if self.cache_path is not None:
+                    cache[keys[name]] = {"task": name, "score": scores[name]}
+                    self._save_cache(cache)
+
+                if self.output_path:
+                    with open(self.output_path + "/metrics.json", "w") as f:
+                        json.dump(scores, f, indent=2)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+                for evaluator in self.evaluators.values():
+                    getattr(evaluator, "_prefetched", {}).clear()
 
         scores["mean"] = np.array(list(scores.values())).mean()
 
@@ -417,6 +706,11 @@ class EvaluatorRunner:
         logger.info("Results:\n" + str(table))
         return scores
 
+    def _prefetch(self, executor, name):
+        evaluator = self.evaluators[name]
+        if hasattr(evaluator, "prefetch") and evaluator.datamodule is not None:
+            evaluator.prefetch(executor, "test")
+
 
 def setup_evaluators(
     model_type,
@@ -429,6 +723,7 @@ def setup_evaluators(
     output_path=None,
     tasks=None,
     add_eos_to_targets=True,
+    cache_path=None,
 ) -> EvaluatorRunner:
     import copy
 
@@ -612,7 +907,7 @@ def setup_evaluators(
         else:
             raise ValueError("No active tasks")
 
-    runner = EvaluatorRunner(output_path)
+    runner = EvaluatorRunner(output_path, cache_path=cache_path)
     for name, evaluator in evaluators.items():
         runner.add_evaluator(name, evaluator)
     return runner
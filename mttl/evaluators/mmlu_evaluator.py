@@ -37,7 +37,12 @@ class MMLUEvaluator(GenerativeEvaluator):
         max_input_length=None,
         use_vllm=False,
         generation_kwargs=None,
+        keep_vllm_engine=False,
     ):
+        """With `keep_vllm_engine`, the vLLM engine stays loaded after an evaluation, and is only
+        updated with the weights that changed by the next one. It holds most of the GPU memory
+        until `free_vllm_engine` is called.
+        """
         from mttl.datamodule.mmlu_data_module import MMLUDataModule
 
         if datamodule is None:
@@ -54,6 +59,16 @@ class MMLUEvaluator(GenerativeEvaluator):
         super().__init__(
             datamodule, use_vllm=use_vllm, generation_kwargs=generation_kwargs
         )
+        self.keep_vllm_engine = keep_vllm_engine
+        self._vllm_engine = None
+        self._vllm_engine_hash = None
+
+    def free_vllm_engine(self):
+        """Releases the vLLM engine kept across evaluations, if any."""
+        if self._vllm_engine is not None:
+            self._vllm_engine = None
+            self._vllm_engine_hash = None
+            free_memory()
 
     def evaluate_with_vllm(self, model, generation_config, subsample, shuffle):
         model_hash = hashlib.sha256()
@@ -66,22 +81,32 @@ class MMLUEvaluator(GenerativeEvaluator):
         # move the model to CPU as VLLM loads its own version of the model
         state = swap_model(model)
 
-        vllm_model = LLMEngineMMLU(
-            model,
-            temp_path=f"{os.environ.get('MTTL_TEMP', '/tmp/merged')}/{model_hash.hexdigest()}/",
-        )
+        if (
+            self._vllm_engine is not None
+            and self._vllm_engine.handoff is not None
+            and self._vllm_engine_hash == model_hash.hexdigest()
+        ):
+            # the engine stays loaded, only the weights that changed are handed over
+            self._vllm_engine.update_weights(model)
+        else:
+            self.free_vllm_engine()
+            self._vllm_engine = LLMEngineMMLU(
+                model,
+                temp_path=f"{os.environ.get('MTTL_TEMP', '/tmp/merged')}/{model_hash.hexdigest()}/",
+            )
+            self._vllm_engine_hash = model_hash.hexdigest()
 
         if self.split == "test":
             dataloader = self.datamodule.test_dataloader(subsample, shuffle)
         else:
             dataloader = self.datamodule.val_dataloader()
 
-        all_predictions, all_references, all_task_names = vllm_model.eval(
+        all_predictions, all_references, all_task_names = self._vllm_engine.eval(
             dataloader, generation_config, self.tokenizer
         )
 
-        free_memory()
-        del vllm_model
+        if not self.keep_vllm_engine:
+            self.free_vllm_engine()
 
         # move the model back to GPU
         swap_model(model, state)
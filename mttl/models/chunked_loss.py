@@ -0,0 +1,161 @@
+"""Language modeling losses computed a few tokens at a time, without the logits of a batch.
+
+The `(batch, seq, vocab)` logits of a causal LM dominate the memory and time of a loss
+evaluation for large vocabularies. `lm_head_inputs` captures the inputs of the LM head of a
+model instead, and lets the head compute the logits of the last position only.
+`chunked_cross_entropy` then projects `chunk_size` labeled tokens at a time, skipping the
+positions whose label is -100, e.g. padding and prompts. With gradients, the logits of each chunk
+are recomputed in the backward pass instead of being kept, so that training never holds them
+either.
+
+Models whose forward transforms the logits, e.g. prompt tuning, or whose LM head is followed by
+a scaling or a softcapping of the logits are not supported.
+"""
+
+from contextlib import contextmanager
+
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def get_causal_lm(model):
+    """Returns the model which owns the LM head of `model`, e.g. the transformers model of an
+    expert model or of a lightning module."""
+    while not hasattr(model, "get_output_embeddings"):
+        # `module` for distributed wrappers
+        inner = getattr(model, "model", None) or getattr(model, "module", None)
+        if not isinstance(inner, torch.nn.Module):
+            raise ValueError(f"Can't find the LM head of {type(model).__name__}.")
+        model = inner
+    return model
+
+
+@contextmanager
+def lm_head_inputs(model):
+    """Captures the inputs of the LM head of `model` during a forward pass.
+
+    Yields a dict which receives the LM head and its inputs, as `lm_head` and `hidden_states`.
+    The LM head only computes the logits of the last position, and labels are not passed to the
+    transformers model, which would compute its loss with these logits. They are still seen by
+    the routing of expert models.
+    """
+    causal_lm = get_causal_lm(model)
+    lm_head = causal_lm.get_output_embeddings()
+    captured = {"lm_head": lm_head}
+
+    def capture_inputs(module, args):
+        captured["hidden_states"] = args[0]
+        return (args[0][:, -1:],) + args[1:]
+
+    # expert models call `forward` directly, which skips the forward hooks
+    had_forward = "forward" in vars(causal_lm)
+    forward = causal_lm.forward
+
+    def forward_without_labels(*args, **kwargs):
+        kwargs.pop("labels", None)
+        return forward(*args, **kwargs)
+
+    handle = lm_head.register_forward_pre_hook(capture_inputs)
+    causal_lm.forward = forward_without_labels
+    try:
+        yield captured
+    finally:
+        handle.remove()
+        if had_forward:
+            causal_lm.forward = forward
+        else:
+            del causal_lm.forward
+
+
+def chunked_cross_entropy(hidden_states, labels, lm_head, chunk_size=1024):
+    """Cross-entropy of the next-token predictions made from `hidden_states`, the inputs of
+    `lm_head`, computed `chunk_size` labeled tokens at a time.
+
+    Returns the sum of the token losses of each example and its number of labeled tokens.
+    """
+    if hidden_states.shape[:2] != labels.shape[:2]:
+        raise ValueError(
+            f"The inputs of the LM head, of shape {tuple(hidden_states.shape)}, are not"
+            f" aligned with the labels, of shape {tuple(labels.shape)}."
+        )
+
+    labels = labels.to(hidden_states.device)
+    shift_labels = labels[:, 1:]
+    mask = shift_labels != -100
+    example_ids = mask.nonzero()[:, 0]
+    hidden_states = hidden_states[:, :-1][mask]
+    targets = shift_labels[mask]
+
+    losses = []
+    for start in range(0, targets.size(0), chunk_size):
+        chunk = (
+            hidden_states[start : start + chunk_size],
+            targets[start : start + chunk_size],
+            lm_head,
+        )
+        if torch.is_grad_enabled():
+            losses.append(checkpoint(_token_losses, *chunk, use_reentrant=False))
+        else:
+            losses.append(_token_losses(*chunk))
+    losses = torch.cat(losses) if losses else hidden_states.new_zeros(0).float()
+
+    loss_sums = torch.zeros(labels.size(0), device=losses.device).index_add_(
+        0, example_ids, losses
+    )
+    return loss_sums, mask.sum(1)
+
+
+def _token_losses(hidden_states, targets, lm_head):
+    logits = lm_head(hidden_states).float()
+    return F.cross_entropy(logits, targets, reduction="none")
+
+
+@torch.no_grad()
+def compute_loss_sums(model, batch, chunk_size=1024):
+    """Runs `model` on `batch` and returns the sum of the token losses of each example and its
+    number of labeled tokens, without computing the logits of the whole batch."""
+    with lm_head_inputs(model) as captured:
+        model.forward(**batch)
+    return chunked_cross_entropy(
+        captured["hidden_states"], batch["labels"], captured["lm_head"], chunk_size
+    )
+
+
+def compute_chunked_loss(model, batch, chunk_size=1024):
+    """Runs `model` on `batch` and returns the mean loss over the labeled tokens, as computed by
+    transformers models, applying the LM head `chunk_size` tokens at a time."""
+    with lm_head_inputs(model) as captured:
+        model.forward(**batch)
+    loss_sums, num_tokens = chunked_cross_entropy(
+        captured["hidden_states"], batch["labels"], captured["lm_head"], chunk_size
+    )
+    return loss_sums.sum() / num_tokens.sum()
+
+
+class LossAccumulator:
+    """Accumulates per-example loss sums and token counts on their device.
+
+    `token_loss` is the mean of the losses of all tokens, `example_loss` the mean over examples
+    of their mean token loss. Examples without labeled tokens are not counted in the latter.
+    """
+
+    def __init__(self):
+        self.loss_sum = 0.0
+        self.num_tokens = 0
+        self.example_loss_sum = 0.0
+        self.num_examples = 0
+
+    def update(self, loss_sums, num_tokens):
+        self.loss_sum += loss_sums.sum()
+        self.num_tokens += num_tokens.sum()
+        self.example_loss_sum += (loss_sums / num_tokens.clamp(min=1)).sum()
+        self.num_examples += (num_tokens > 0).sum()
+
+    @property
+    def token_loss(self):
+        return float(self.loss_sum / self.num_tokens)
+
+    @property
+    def example_loss(self):
+        return float(self.example_loss_sum / self.num_examples)
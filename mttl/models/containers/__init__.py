@@ -154,4 +154,14 @@ def replace_selector_for_container(
         n_selectors += isinstance(selector, Selector)
         n_selectors_views += isinstance(selector, SelectorView)
 
+    if getattr(selector_config, "routing_groups", None):
+        from mttl.models.containers.selectors.per_token_selector import (
+            assign_routing_groups,
+        )
+
+        n_groups = assign_routing_groups(
+            expert_containers, selector_config.routing_groups
+        )
+        logger.debug("Created %s routing groups.", n_groups)
+
     return n_selectors, n_selectors_views
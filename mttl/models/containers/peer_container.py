@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+from torch.nn import functional as F
 
 from mttl.models.containers.base import ContainerFullException, ExpertContainer
 from mttl.models.containers.selectors.product_key import PKSelectorConfig, PKSSelector
@@ -14,6 +15,54 @@ DOWN_NAMES = ["fc1", "c_fc"]
 UP_NAMES = ["fc2", "c_proj"]
 
 
+class PEERDownProjection(torch.autograd.Function):
+    """Computes `x[t, k] = <input[t], weight[indices[t, k]]>` without materializing the
+    (tokens, k, input_dim) tensor of gathered expert weights.
+
+    Weights are gathered `chunk_size` tokens at a time, and only the inputs and indices are
+    saved for backward: the input gradient is an `embedding_bag` reduction and the weight
+    gradient is accumulated chunk by chunk with `index_add_`.
+    """
+
+    @staticmethod
+    def forward(ctx, input, indices, weight, chunk_size):
+        output = input.new_empty(indices.shape)
+        for start in range(0, input.size(0), chunk_size):
+            end = start + chunk_size
+            w_down = F.embedding(indices[start:end], weight)  # chunk, k, input_dim
+            output[start:end] = torch.bmm(w_down, input[start:end, :, None])[..., 0]
+
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(input, indices, weight)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, indices, weight = ctx.saved_tensors
+        grad_input = grad_weight = None
+
+        if ctx.needs_input_grad[0]:
+            grad_input = F.embedding_bag(
+                indices,
+                weight,
+                per_sample_weights=grad_output.to(weight.dtype),
+                mode="sum",
+            ).to(input.dtype)
+
+        if ctx.needs_input_grad[2]:
+            grad_weight = torch.zeros_like(weight)
+            for start in range(0, input.size(0), ctx.chunk_size):
+                end = start + ctx.chunk_size
+                # chunk, k, input_dim
+                grad_w_down = grad_output[start:end, :, None] * input[start:end, None]
+                grad_weight.index_add_(
+                    0,
+                    indices[start:end].flatten(),
+                    grad_w_down.flatten(0, 1).to(weight.dtype),
+                )
+        return grad_input, None, grad_weight, None
+
+
 class PEERMLPContainer(ExpertContainer):
     """
     PEER layer from Mixture of A Million Experts (https://arxiv.org/pdf/2407.04153)
@@ -89,14 +138,28 @@ class PEERMLPContainer(ExpertContainer):
             routing.weights,
         )  # both shape b, s, heads, experts
 
-        w_down = self.peer_weight_down_embed(indices)  # b, s, heads, experts, input_dim
-        w_up = self.peer_weight_up_embed(indices)  # b, s, heads, experts, output_dim
+        # expert weights are never gathered for all the tokens at once
+        # (b * s, heads * experts)
+        n_tokens = input.shape[0] * input.shape[1]
+        indices = indices.reshape(n_tokens, -1)
 
-        x = torch.einsum("bsd,bshed->bshe", input, w_down)  # b, s, heads, experts
+        x = PEERDownProjection.apply(
+            input.reshape(n_tokens, -1),
+            indices,
+            self.peer_weight_down_embed.weight,
+            self.config.peer_chunk_size,
+        )
         x = self.activation(x)
-        x *= scores
-        x = torch.einsum("bshe,bshed->bsd", x, w_up)
-        return x
+        x = x * scores.reshape(n_tokens, -1)
+
+        # weighted sum of the up projections of the selected experts
+        x = F.embedding_bag(
+            indices,
+            self.peer_weight_up_embed.weight,
+            per_sample_weights=x.to(self.peer_weight_up_embed.weight.dtype),
+            mode="sum",
+        )
+        return x.view(*input.shape[:-1], -1).to(input.dtype)
 
     def add_expert(self, expert: Expert, **kwargs) -> None:
         return self.on_add_expert(expert, **kwargs)
@@ -1,7 +1,7 @@
 import functools
 import threading
 from abc import ABC
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass, field
 from typing import Dict, Union
 
@@ -404,6 +404,8 @@ class TaskPredictorSelectorConfig(SelectorConfig):
     ranker_path: str = None
     ranker_model: str = None
     ranker_top_k: int = 1
+    # number of source texts whose predictions are kept across batches
+    ranker_cache_size: int = 1024
 
 
 @Selector.register("task_predictor_selector", TaskPredictorSelectorConfig)
@@ -421,6 +423,46 @@ class TaskPredictorSelector(Selector):
         if isinstance(self.expert_ranker, ClusterPredictor):
             self.expert_ranker.init_clusters(kwargs["training_config"].library_id)
 
+        # tasks currently made available to the ranker
+        self._available_tasks = None
+        # LRU of source text -> (predicted tasks, weights)
+        self._predictions_cache = OrderedDict()
+
+    def _update_available_tasks(self):
+        if self._available_tasks != self.expert_names:
+            self.expert_ranker.set_available_tasks(self.expert_names)
+            self._available_tasks = self.expert_names
+
+    def predict_tasks(self, sources_texts):
+        """Predicts the tasks for each source text, only the texts that were not seen
+        recently are passed through the ranker."""
+        predictions = {}
+        for text in sources_texts:
+            if text in self._predictions_cache:
+                self._predictions_cache.move_to_end(text)
+                predictions[text] = self._predictions_cache[text]
+
+        missing = [
+            text for text in dict.fromkeys(sources_texts) if text not in predictions
+        ]
+        if missing:
+            self._update_available_tasks()
+
+            experts, weights = self.expert_ranker.predict_task(
+                missing, n=self.ranker_top_k
+            )
+            for text, text_experts, text_weights in zip(missing, experts, weights):
+                predictions[text] = (text_experts, text_weights)
+
+                if self.config.ranker_cache_size > 0:
+                    self._predictions_cache[text] = (text_experts, text_weights)
+                    if len(self._predictions_cache) > self.config.ranker_cache_size:
+                        self._predictions_cache.popitem(last=False)
+
+        experts = [predictions[text][0] for text in sources_texts]
+        weights = [predictions[text][1] for text in sources_texts]
+        return experts, weights
+
     @forward_with_cache
     def forward(self, input, **kwargs) -> BatchExpertsAndWeightsSelectorOutput:
         # get the sources_texts from routing_infos
@@ -428,15 +470,28 @@ class TaskPredictorSelector(Selector):
 
         if hasattr(routing_infos, "sources_texts"):
             sources_texts = routing_infos.sources_texts
-            self.expert_ranker.set_available_tasks(self.expert_names)
 
-            experts, weights = self.expert_ranker.predict_task(
-                sources_texts, n=self.ranker_top_k
+            # predictions are shared by all layers and decoding steps of this forward / generate call
+            cache_key = (
+                "task_predictor",
+                self.config.ranker_model,
+                self.config.ranker_path,
+                self.ranker_top_k,
+                tuple(self.expert_names),
+                tuple(sources_texts),
             )
-            logger.debug(f"Predicted tasks: {experts} with weights {weights}")
+            routing_cache = self.info_container.routing_cache
+            if cache_key not in routing_cache:
+                experts, weights = self.predict_tasks(sources_texts)
+                logger.debug(f"Predicted tasks: {experts} with weights {weights}")
 
-            weights = torch.tensor(weights, device=input.device)
-            return BatchExpertsAndWeightsSelectorOutput(experts, weights)
+                routing_cache[cache_key] = (experts, torch.tensor(weights))
+
+            experts, weights = routing_cache[cache_key]
+            # containers convert expert names to indices in-place, return a fresh output
+            return BatchExpertsAndWeightsSelectorOutput(
+                [list(e) for e in experts], weights.to(input.device)
+            )
         else:
             raise ValueError(
                 "Routing infos does not contain sources_texts, cannot predict tasks."
@@ -450,7 +505,8 @@ class TaskPredictorSelector(Selector):
     def on_add_expert(
         self, expert_name: str, expert_info: ExpertInfo = None, is_default=False
     ):
-        pass
+        # predictions depend on the set of available experts
+        self._predictions_cache.clear()
 
 
 class LoadableLibraryMixin(ABC):
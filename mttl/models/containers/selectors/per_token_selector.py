@@ -1,3 +1,4 @@
+import re
 from dataclasses import dataclass
 
 import numpy as np
@@ -5,7 +6,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from mttl.logging import warn_once
+from mttl.logging import logger, warn_once
 from mttl.models.containers.selectors.base import (
     EPS,
     LoadableLibraryMixin,
@@ -30,6 +31,9 @@ class PerTokenSelectorConfig(LoadableSelectorConfig):
     proto_init: str = None
     input_norm_fn: str = None
     proto_norm_fn: str = None
+    # share routing across sibling containers receiving the same input,
+    # either "auto" or a regex on the layer names of the containers to group
+    routing_groups: str = None
 
 
 @Selector.register("per_token_router", PerTokenSelectorConfig)
@@ -79,6 +83,9 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
         self.input_norm = _get_norm_layer(self.config.input_norm_fn)
         self.proto_norm = _get_norm_layer(self.config.proto_norm_fn)
 
+        # set by `assign_routing_groups` when routing is shared with sibling layers
+        self.routing_group = None
+
         # init selector from library if needed
         if self.config.library_id is not None:
             self.library_artifacts = self.load_from_library(self.config)
@@ -172,38 +179,14 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
             )
             self.metric_logger.update(prefix=self.__layer_name__, value_dict=to_store)
 
-    @forward_with_cache
-    def forward(self, input, **kwargs) -> BatchSequenceExpertsAndWeightsSelectorOutput:
-        # do routing business on fp32
-        temp = (
-            self.config.router_temp
-            if self.config.router_temp > 0
-            else np.sqrt(input.shape[-1])
-        )
-        if self.prototypes.size(0) != len(self.expert_names):
-            raise ValueError("Prototypes not initialized correctly.")
-
-        input = input.to(dtype=self.prototypes.dtype)
-        input = self.input_norm(input)
-        prototypes = self.proto_norm(self.prototypes)
-
-        # logit computation
+    def _compute_router_logits(self, input, prototypes):
         router_logits = F.linear(input, prototypes)
         if self.config.proto_init == "arrow":
             router_logits = router_logits.abs()
+        return router_logits
 
-        # log angle between input and prototypes
-        angle = router_logits / input.norm(p=2, dim=-1, keepdim=True).clamp(min=EPS)
-        angle = angle / prototypes.norm(p=2, dim=-1).view(1, 1, -1).clamp(min=EPS)
-
-        task_names = self.routing_infos.task_names
-        in_dist = task_names is not None and all(
-            [t in self.task_to_expert_name for t in task_names]
-        )
-
-        # control entropy of distribution
-        router_logits /= temp
-
+    def _select_experts(self, router_logits):
+        """Top-k selection and normalization over the last dimension of the logits."""
         if self.config.top_k > 0:
             # For now, we always renormalize the routing weights for hard routing
             top_k_logits, experts = torch.topk(router_logits, self.config.top_k, dim=-1)
@@ -218,16 +201,58 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
         else:
             experts = ALL_EXPERTS
             router_probs = F.softmax(router_logits, dim=-1, dtype=torch.float)
+        return router_logits, experts, router_probs
+
+    def _log_routing(self, input, prototypes, raw_logits, router_logits):
+        task_names = self.routing_infos.task_names
+        in_dist = task_names is not None and all(
+            [t in self.task_to_expert_name for t in task_names]
+        )
 
         self._log_entropy(router_logits)
         if in_dist:
+            # log angle between input and prototypes
+            angle = raw_logits / input.norm(p=2, dim=-1, keepdim=True).clamp(min=EPS)
+            angle = angle / prototypes.norm(p=2, dim=-1).view(1, 1, -1).clamp(min=EPS)
+
             self._log_angle(angle)
             self._log_in_dist(router_logits)
 
+    def _temperature(self, input):
+        return (
+            self.config.router_temp
+            if self.config.router_temp > 0
+            else np.sqrt(input.shape[-1])
+        )
+
+    def route(self, input) -> BatchSequenceExpertsAndWeightsSelectorOutput:
+        """Computes the routing for this selector only."""
+        # do routing business on fp32
+        temp = self._temperature(input)
+        if self.prototypes.size(0) != len(self.expert_names):
+            raise ValueError("Prototypes not initialized correctly.")
+
+        input = input.to(dtype=self.prototypes.dtype)
+        input = self.input_norm(input)
+        prototypes = self.proto_norm(self.prototypes)
+
+        # logit computation
+        raw_logits = self._compute_router_logits(input, prototypes)
+
+        # control entropy of distribution
+        router_logits, experts, router_probs = self._select_experts(raw_logits / temp)
+        self._log_routing(input, prototypes, raw_logits, router_logits)
+
         return BatchSequenceExpertsAndWeightsSelectorOutput(
             experts=experts, weights=router_probs
         )
 
+    @forward_with_cache
+    def forward(self, input, **kwargs) -> BatchSequenceExpertsAndWeightsSelectorOutput:
+        if self.routing_group is not None:
+            return self.routing_group.route(self, input)
+        return self.route(input)
+
     def on_add_expert(
         self, expert_name: str, expert_info: ExpertInfo = None, is_default=False
     ):
@@ -248,3 +273,138 @@ class PerTokenSelector(Selector, LoadableLibraryMixin):
 
         dev = self.prototypes.device
         self.prototypes.data = torch.cat([self.prototypes.data, proto.to(dev)])
+
+
+class RoutingGroup:
+    """Per-token selectors of sibling containers that receive the same input tensor.
+
+    The first selector of the group called in a forward pass routes the input for all
+    the members at once: the input is normalized once and the prototypes of all the
+    members are stacked so that a single matmul, top-k and softmax are performed.
+    The remaining members then fetch their routing from the `InfoContainer` cache.
+
+    Members are only assumed to share their input: a member that is called with a
+    different tensor is removed from the group and routes on its own from then on.
+    """
+
+    def __init__(self, selectors):
+        self.selectors = list(selectors)
+
+    def __len__(self):
+        return len(self.selectors)
+
+    def __iter__(self):
+        return iter(self.selectors)
+
+    def remove(self, selector):
+        if selector in self.selectors:
+            self.selectors.remove(selector)
+        selector.routing_group = None
+
+    def _can_route_together(self):
+        n_experts = self.selectors[0].prototypes.size(0)
+        return len(self) > 1 and all(
+            selector.prototypes.size(0) == n_experts and selector.n_experts == n_experts
+            for selector in self.selectors
+        )
+
+    def _route_group(self, input):
+        leader = self.selectors[0]
+
+        temp = leader._temperature(input)
+        input = input.to(dtype=leader.prototypes.dtype)
+        input = leader.input_norm(input)
+
+        # prototypes are normalized per member, e.g. `norm_p` normalizes across experts
+        prototypes = [selector.proto_norm(selector.prototypes) for selector in self]
+        raw_logits = leader._compute_router_logits(input, torch.cat(prototypes))
+        # (batch, seq, n_members, n_experts)
+        raw_logits = raw_logits.unflatten(-1, (len(self), -1))
+
+        router_logits, experts, router_probs = leader._select_experts(raw_logits / temp)
+        # logging is done once per group, on behalf of the leader
+        leader._log_routing(
+            input, prototypes[0], raw_logits[..., 0, :], router_logits[..., 0, :]
+        )
+
+        return {
+            selector: BatchSequenceExpertsAndWeightsSelectorOutput(
+                experts=(experts if experts is ALL_EXPERTS else experts[..., i, :]),
+                weights=router_probs[..., i, :],
+            )
+            for i, selector in enumerate(self)
+        }
+
+    def route(self, selector, input) -> BatchSequenceExpertsAndWeightsSelectorOutput:
+        info_container = selector.info_container
+        if info_container is None:
+            return selector.route(input)
+
+        cache = info_container.routing_cache
+        key = ("routing_group", id(self))
+        entry = cache.get(key)
+
+        if entry is not None and selector in entry["pending"]:
+            if entry["input"] is input and entry["version"] == input._version:
+                entry["pending"].remove(selector)
+                return entry["outputs"][selector]
+
+            # the group was routed for another input that this selector did not receive
+            logger.debug(
+                "Removing %s from its routing group, its input differs from the group's.",
+                selector.layer_name,
+            )
+            entry["pending"].remove(selector)
+            self.remove(selector)
+
+        if selector not in self.selectors or not self._can_route_together():
+            return selector.route(input)
+
+        outputs = self._route_group(input)
+        cache[key] = {
+            "input": input,
+            "version": input._version,
+            "outputs": outputs,
+            "pending": [s for s in self.selectors if s is not selector],
+        }
+        return outputs[selector]
+
+
+def assign_routing_groups(containers, routing_groups: str) -> int:
+    """Groups the per-token selectors of sibling containers that share their input.
+
+    If `routing_groups` is "auto", all sibling containers with the same input dimension are
+    grouped, and members that turn out to receive a different input are dropped at the first
+    forward pass. Otherwise, `routing_groups` is a regex and only sibling containers whose
+    layer name matches it are grouped, e.g. "q_proj|k_proj|v_proj".
+
+    Returns the number of groups created.
+    """
+    candidates = {}
+
+    for container in containers:
+        selector = container.selector
+        # only selectors owning their prototypes can be grouped, views share a selector already
+        if not isinstance(selector, PerTokenSelector):
+            continue
+
+        selector.routing_group = None
+        if routing_groups != "auto" and not re.search(
+            routing_groups, container.layer_name
+        ):
+            continue
+
+        parent_name = container.layer_name.rpartition(".")[0]
+        group = candidates.setdefault((parent_name, selector.input_dim), {})
+        group[id(selector)] = selector
+
+    n_groups = 0
+    for selectors in candidates.values():
+        if len(selectors) < 2:
+            continue
+
+        group = RoutingGroup(selectors.values())
+        for selector in group:
+            selector.routing_group = group
+        n_groups += 1
+    return n_groups
@@ -13,6 +13,8 @@ class InfoContainer:
         self._routing_infos = routing_infos
         # stores the routing gates for each layer, if any
         self._routing_gates = []
+        # stores routing results that selectors share within this context
+        self._routing_cache = {}
 
     def __enter__(self):
         InfoContainer.local.context = self
@@ -34,6 +36,10 @@ class InfoContainer:
     def routing_gates(self):
         return self._routing_gates
 
+    @property
+    def routing_cache(self):
+        return self._routing_cache
+
     @routing_infos.setter
     def routing_infos(self, value: "RoutingInfo"):
         self._routing_infos = value
@@ -32,6 +32,7 @@ from mttl.models.modifiers.base import (
     Modifier,
 )
 from mttl.models.modifiers.modify_model import modify_transformer
+from mttl.models.utils import save_merged_checkpoint
 
 
 @contextlib.contextmanager
@@ -84,46 +85,28 @@ class ExpertModel(BaseExpertModel):
                 modifiers.append(module)
         return modifiers
 
-    def merge_and_save_base_model(self, output_dir, device="cpu"):
+    def merge_and_save_base_model(
+        self, output_dir, device="cpu", max_shard_size="5GB", dtype=None
+    ):
         """
         Merge loaded adapters and save the base model in the huggingface format
-        to the output directory. Moves the model to the specified device before merging.
+        to the output directory. Adapters are merged on the specified device, one layer
+        at a time, while the checkpoint is written shard by shard.
         """
-        import copy
-
         from transformers import AutoTokenizer
 
-        # move model to cpu to avoid memory issues
-        self.model.to(device)
-
-        merged = []
-        model_copy = copy.deepcopy(self.model)
-
-        for name, module in model_copy.named_modules():
-            for c_name, child in module.named_children():
-                if isinstance(child, Modifier):
-                    if isinstance(child, MergeableModifierMixin):
-                        # merge the adapter with the layer
-                        child.merge_with_layer()
-                        # remove the modifier and set the layer
-                        setattr(
-                            module,
-                            c_name,
-                            child.layer,
-                        )
-                        merged.append(name)
-                    else:
-                        raise ValueError(
-                            "Modifier {} is not mergeable!".format(child.__class__)
-                        )
-
-        logger.info("Merged layers: %s" % ", ".join(merged))
-        logger.info("Saving merged model to: %s" % output_dir)
-
-        model_copy.save_pretrained(output_dir)
-        tokenizer = AutoTokenizer.from_pretrained(
-            self.config.base_model
-        ).save_pretrained(output_dir)
+        save_merged_checkpoint(
+            self.model,
+            output_dir,
+            max_shard_size=max_shard_size,
+            dtype=dtype,
+            device=device,
+        )
+
+        if self.config.base_model is not None:
+            AutoTokenizer.from_pretrained(self.config.base_model).save_pretrained(
+                output_dir
+            )
 
     @classmethod
     def from_pretrained_peft(cls, path_in_repo: str, **kwargs):
@@ -609,49 +592,32 @@ class MultiExpertModel(BaseExpertModel, MultiExpertMixin):
 
         return selector_config
 
-    def merge_and_save_base_model(self, output_dir, expert_name, device="cpu"):
+    def merge_and_save_base_model(
+        self, output_dir, expert_name, device="cpu", max_shard_size="5GB", dtype=None
+    ):
         """
         Merge the specific expert and save the base model in the huggingface format
-        to the output directory. Moves the model to the specified device before merging.
+        to the output directory. The expert is merged on the specified device, one layer
+        at a time, while the checkpoint is written shard by shard.
         """
-        import copy
-
         from transformers import AutoTokenizer
 
-        from mttl.models.containers.base import clear_containers
-
         if expert_name not in self.experts_infos:
             raise ValueError(f"Expert {expert_name} not found in the model.")
 
-        # move model to cpu to avoid memory issues
-        self.model.to(device)
-
-        merged = []
-        model_copy = copy.deepcopy(self.model)
-
-        # get the modifier type of the expert name
-        modifier_name = self.experts_infos[expert_name].expert_config.modifier_name
-
-        for container in containers_iterator(model_copy):
-            if expert_name in container.expert_infos:
-                if not isinstance(container, MergeableContainer):
-                    raise ValueError(
-                        "Cannot merge expert loaded in a non-mergeable container. Either change container type or expert type."
-                    )
-
-                container.merge_expert(expert_name)
-                merged.append(container.layer_name)
-
-        # now clear all containers and save the model
-        clear_containers(model_copy)
-
-        logger.info("Merged layers: %s" % ", ".join(merged))
-        logger.info("Saving merged model to: %s" % output_dir)
+        save_merged_checkpoint(
+            self.model,
+            output_dir,
+            expert_name=expert_name,
+            max_shard_size=max_shard_size,
+            dtype=dtype,
+            device=device,
+        )
 
-        model_copy.save_pretrained(output_dir)
-        tokenizer = AutoTokenizer.from_pretrained(
-            self.config.base_model
-        ).save_pretrained(output_dir)
+        if self.config.base_model is not None:
+            AutoTokenizer.from_pretrained(self.config.base_model).save_pretrained(
+                output_dir
+            )
 
     def save_pretrained(self, save_directory, **kwargs):
         # need to make sure that config is in sync with the model before saving
@@ -1,7 +1,9 @@
 import math
 import re
+import types
 from collections import defaultdict
 
+import torch
 import torch.optim as optim
 from transformers import Adafactor
 
@@ -84,7 +86,15 @@ def get_optimizer(model, args, no_decay=None):
             )
             param_groups[key]["lr"] = args.learning_rate
 
-    param_groups = param_groups.values()
+    param_groups = list(param_groups.values())
+    flat_views = None
+    if args.optimizer_flat_buffers:
+        if optim_name.lower() == "adafactor":
+            # adafactor factors the second moment of matrices, it needs their shapes
+            logger.warning("Adafactor does not support flat buffers, ignoring.")
+        else:
+            param_groups, flat_views = flatten_param_groups(model, param_groups)
+
     if optim_name.lower() == "adam":
         optimizer = optim.Adam(param_groups)
     elif optim_name.lower() == "sgd":
@@ -104,6 +114,8 @@ def get_optimizer(model, args, no_decay=None):
     else:
         raise ValueError("Invalid Optimizer name %s" % optim_name)
 
+    if flat_views is not None:
+        attach_flat_buffers(optimizer, flat_views)
     return optimizer, trainable_param_names
 
 
@@ -143,3 +155,97 @@ def get_optimizer_and_scheduler(model, args, num_train_examples, no_decay=None):
     optimizer, trainable_param_names = get_optimizer(model, args, no_decay=no_decay)
     scheduler = get_scheduler(optimizer, args)
     return (optimizer, scheduler), trainable_param_names
+
+
+def flatten_param_groups(model, param_groups):
+    """Packs the parameters of each param group in one flat parameter per dtype and device.
+
+    The parameters of `model` become views of the flat parameters, and their gradients views of
+    the gradients of the flat parameters, so that the optimizer, gradient clipping and zeroing
+    work on a few large tensors instead of many small ones. Returns the new param groups and,
+    for every parameter, the flat parameter and the offset of its view.
+    """
+    flat_groups, flat_views = [], []
+    for group in param_groups:
+        params_by_key = defaultdict(list)
+        for param in group["params"]:
+            params_by_key[(param.dtype, param.device)].append(param)
+
+        flat_params = []
+        for (dtype, device), params in params_by_key.items():
+            flat = torch.nn.Parameter(
+                torch.empty(sum(p.numel() for p in params), dtype=dtype, device=device)
+            )
+            flat.grad = torch.zeros_like(flat)
+            offset = 0
+            for param in params:
+                flat.data[offset : offset + param.numel()].copy_(param.data.flatten())
+                _point_to_flat(param, flat, offset)
+                flat_views.append((param, flat, offset))
+                offset += param.numel()
+            flat_params.append(flat)
+
+        flat_groups.append({**group, "params": flat_params})
+
+    flat_storages = {
+        flat.untyped_storage().data_ptr()
+        for group in flat_groups
+        for flat in group["params"]
+    }
+
+    def clone_flat_views(module, state_dict, prefix, local_metadata):
+        # saving a view saves its whole storage, i.e. the parameters of the other modules
+        for key, value in state_dict.items():
+            if (
+                isinstance(value, torch.Tensor)
+                and value.untyped_storage().data_ptr() in flat_storages
+            ):
+                state_dict[key] = value.clone()
+
+    model._register_state_dict_hook(clone_flat_views)
+    return flat_groups, flat_views
+
+
+def _point_to_flat(param, flat, offset):
+    param.data = flat.data[offset : offset + param.numel()].view_as(param)
+    param.grad = flat.grad[offset : offset + param.numel()].view_as(param)
+
+
+def attach_flat_buffers(optimizer, flat_views):
+    """Keeps the parameters of the model views of the flat parameters of `optimizer`.
+
+    `optimizer.zero_grad` zeroes the flat gradients, which are never released. Parameters whose
+    data or gradient were replaced, e.g. by `module.zero_grad()`, are copied back into the flat
+    parameters and pointed to them again, by `zero_grad` and before each step.
+    """
+    views = [
+        (param, flat, offset, flat.data_ptr() + offset * flat.element_size())
+        for param, flat, offset in flat_views
+    ]
+
+    def repoint_views(copy_grads):
+        for param, flat, offset, data_ptr in views:
+            grad_ptr = flat.grad.data_ptr() + offset * flat.element_size()
+            data_moved = param.data_ptr() != data_ptr
+            grad_moved = param.grad is None or param.grad.data_ptr() != grad_ptr
+            if not (data_moved or grad_moved):
+                continue
+
+            size = param.numel()
+            if data_moved:
+                flat.data[offset : offset + size].copy_(param.data.flatten())
+            if grad_moved and copy_grads:
+                if param.grad is None:
+                    flat.grad[offset : offset + size].zero_()
+                else:
+                    flat.grad[offset : offset + size].copy_(param.grad.flatten())
+            _point_to_flat(param, flat, offset)
+
+    def zero_grad(self, set_to_none=True):
+        for group in self.param_groups:
+            for flat in group["params"]:
+                flat.grad.zero_()
+        repoint_views(copy_grads=False)
+
+    optimizer.zero_grad = types.MethodType(zero_grad, optimizer)
+    optimizer.register_step_pre_hook(lambda *_: repoint_views(copy_grads=True))
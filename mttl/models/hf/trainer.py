@@ -8,6 +8,7 @@ from transformers.trainer import TRAINING_ARGS_NAME, TrainingArguments
 from mttl.arguments import ExpertConfig
 from mttl.datamodule.base import get_datamodule
 from mttl.logging import logger
+from mttl.models.chunked_loss import compute_chunked_loss
 from mttl.models.get_optimizer import get_optimizer_and_scheduler
 
 MTTL_ARGS_NAME = "mttl_args.bin"
@@ -113,6 +114,10 @@ class ExpertModelTrainer(Trainer):
             )
 
     def compute_loss(self, model, batch, return_outputs=False):
+        loss_chunk_size = self.mttl_args.loss_chunk_size
+        if loss_chunk_size and model.training and not return_outputs:
+            return compute_chunked_loss(model, batch, loss_chunk_size)
+
         outputs = model(**batch)
         return (outputs.loss, outputs.logits) if return_outputs else outputs.loss
 
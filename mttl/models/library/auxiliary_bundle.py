@@ -0,0 +1,138 @@
+"""Columnar storage of the auxiliary data of many experts in a single safetensors file.
+
+A bundle holds one data type for a batch of experts. Each key of the per-expert data, e.g. a
+layer name, is stored as a single tensor of shape `(n_experts, *shape)` whose rows follow the
+order of the experts listed in the header, so that all the prototypes of a layer are read at once
+and contiguous across experts. Data that does not fit this layout is stored per expert instead.
+"""
+
+import io
+import json
+import struct
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import load as load_safetensors
+from safetensors.torch import save as save_safetensors
+
+BUNDLE_EXTENSION = ".bundle"
+BUNDLE_FORMAT = "1"
+# key of the data of experts whose data is a single array instead of a dict
+VALUE_KEY = "__value__"
+
+
+def bundle_file_name(data_type: str, index: int) -> str:
+    return f"{data_type}.{index:05d}{BUNDLE_EXTENSION}"
+
+
+def _kind(value):
+    if isinstance(value, torch.Tensor):
+        return "torch"
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return "numpy"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        # larger ints are kept exactly per expert
+        return "int" if -(2**63) <= value < 2**63 else None
+    if isinstance(value, float):
+        return "float"
+    return None
+
+
+def _columns(data):
+    if isinstance(data, dict):
+        if len(data) == 0 or not all(isinstance(k, str) for k in data):
+            return None
+        return data
+    return {VALUE_KEY: data}
+
+
+def encode_bundle(entries: Dict[str, Any], config: Dict) -> bytes:
+    """Serializes the data of several experts, raises ValueError if it cannot be bundled.
+
+    The data of every expert must be an array, or a dict of arrays and scalars, with the same
+    keys, kinds and shapes for all the experts.
+    """
+    expert_names = list(entries.keys())
+    columns = [_columns(entries[name]) for name in expert_names]
+    if not expert_names or any(c is None for c in columns):
+        raise ValueError("Data cannot be bundled.")
+
+    keys = list(columns[0].keys())
+    kinds = {key: _kind(columns[0][key]) for key in keys}
+    if None in kinds.values():
+        raise ValueError("Data cannot be bundled.")
+
+    tensors = {}
+    for key in keys:
+        values = []
+        for column in columns:
+            if column.keys() != columns[0].keys() or _kind(column[key]) != kinds[key]:
+                raise ValueError("Data cannot be bundled.")
+            try:
+                # floats are doubles, as when they are pickled
+                dtype = torch.float64 if kinds[key] == "float" else None
+                values.append(torch.as_tensor(column[key], dtype=dtype))
+            except (RuntimeError, TypeError, OverflowError) as e:
+                raise ValueError("Data cannot be bundled.") from e
+        if len({(v.shape, v.dtype) for v in values}) > 1:
+            raise ValueError("Data cannot be bundled.")
+        tensors[key] = torch.stack(values).contiguous()
+
+    metadata = {
+        "format": BUNDLE_FORMAT,
+        "experts": json.dumps(expert_names),
+        "kinds": json.dumps(kinds),
+        "config": json.dumps(config, default=repr),
+    }
+    return save_safetensors(tensors, metadata=metadata)
+
+
+def _read(path_or_bytes):
+    """Returns the tensors and the metadata of a bundle, from a path or a file object."""
+    if isinstance(path_or_bytes, (bytes, io.IOBase)):
+        data = (
+            path_or_bytes if isinstance(path_or_bytes, bytes) else path_or_bytes.read()
+        )
+        (header_size,) = struct.unpack("<Q", data[:8])
+        metadata = json.loads(data[8 : 8 + header_size]).get("__metadata__", {})
+        return load_safetensors(data), metadata
+
+    with safe_open(path_or_bytes, framework="pt") as f:
+        return {key: f.get_tensor(key) for key in f.keys()}, f.metadata()
+
+
+def read_bundle_header(path_or_bytes) -> Tuple[List[str], Dict]:
+    """Returns the names of the experts and the config stored in a bundle."""
+    if isinstance(path_or_bytes, (bytes, io.IOBase)):
+        _, metadata = _read(path_or_bytes)
+    else:
+        with safe_open(path_or_bytes, framework="pt") as f:
+            metadata = f.metadata()
+    return json.loads(metadata["experts"]), json.loads(metadata["config"])
+
+
+def decode_bundle(path_or_bytes) -> Tuple[Dict[str, Any], Dict]:
+    """Returns the data of every expert of a bundle, and its config.
+
+    Arrays of the experts are views on the rows of the stored `(n_experts, ...)` tensors.
+    """
+    tensors, metadata = _read(path_or_bytes)
+    expert_names = json.loads(metadata["experts"])
+    kinds = json.loads(metadata["kinds"])
+
+    def convert(value, kind):
+        if kind == "numpy":
+            return value.numpy()
+        if kind in ("bool", "int", "float"):
+            return {"bool": bool, "int": int, "float": float}[kind](value.item())
+        return value
+
+    data = {}
+    for i, name in enumerate(expert_names):
+        columns = {key: convert(tensors[key][i], kind) for key, kind in kinds.items()}
+        data[name] = columns[VALUE_KEY] if VALUE_KEY in columns else columns
+    return data, json.loads(metadata["config"])
@@ -3,6 +3,7 @@ import datetime
 import glob
 import logging
 import os
+import zlib
 from abc import ABC, abstractmethod
 from fnmatch import fnmatch
 from pathlib import Path
@@ -23,6 +24,7 @@ from huggingface_hub import (
     preupload_lfs_files,
     snapshot_download,
 )
+from huggingface_hub.hf_api import RepoFile
 
 from mttl.logging import logger
 from mttl.utils import remote_login
@@ -86,6 +88,12 @@ class BackendEngine(ABC):
     def list_repo_files(self, repo_id):
         raise NotImplementedError
 
+    def list_repo_file_revisions(self, repo_id):
+        """Returns {file: (size, revision)} for the files of the repository, where the revision
+        changes whenever the file is rewritten. Either is None if the backend doesn't know it.
+        """
+        return {file: (None, None) for file in self.list_repo_files(repo_id)}
+
 
 class HuggingfaceHubEngine(BackendEngine):
     def snapshot_download(self, repo_id, allow_patterns=None):
@@ -119,6 +127,13 @@ class HuggingfaceHubEngine(BackendEngine):
     def list_repo_files(self, repo_id):
         return HfApi().list_repo_files(repo_id)
 
+    def list_repo_file_revisions(self, repo_id):
+        return {
+            entry.path: (entry.size, entry.blob_id)
+            for entry in HfApi().list_repo_tree(repo_id, recursive=True)
+            if isinstance(entry, RepoFile)
+        }
+
 
 class BlobStorageEngine(BackendEngine):
     def __init__(self, token: Optional[str] = None, cache_dir: Optional[str] = None):
@@ -354,6 +369,13 @@ class BlobStorageEngine(BackendEngine):
         except ResourceNotFoundError as error:
             raise ValueError(f"Repository {repo_id} not found") from error
 
+    def list_repo_file_revisions(self, repo_id):
+        try:
+            container_client = self._get_container_client(repo_id)
+            return {b.name: (b.size, b.etag) for b in container_client.list_blobs()}
+        except ResourceNotFoundError as error:
+            raise ValueError(f"Repository {repo_id} not found") from error
+
     async def async_upload_folder(
         self,
         repo_id: str,
@@ -602,6 +624,13 @@ class LocalFSEngine(BackendEngine):
     def list_repo_files(self, repo_id):
         return os.listdir(repo_id)
 
+    def list_repo_file_revisions(self, repo_id):
+        revisions = {}
+        for file in os.listdir(repo_id):
+            stat = os.stat(os.path.join(repo_id, file))
+            revisions[file] = (stat.st_size, str(stat.st_mtime_ns))
+        return revisions
+
 
 class VirtualFSEngine(LocalFSEngine):
     repos = {}
@@ -621,6 +650,12 @@ class VirtualFSEngine(LocalFSEngine):
     def list_repo_files(self, repo_id):
         return list(VirtualFSEngine.repos[repo_id].keys())
 
+    def list_repo_file_revisions(self, repo_id):
+        return {
+            file: (len(content), str(zlib.crc32(content)))
+            for file, content in VirtualFSEngine.repos[repo_id].items()
+        }
+
     def create_commit(self, repo_id, operations, commit_message):
         for op in operations:
             if type(op) == CommitOperationAdd:
@@ -1,4 +1,5 @@
 import asyncio
+import copy
 import glob
 import io
 import os
@@ -19,6 +20,13 @@ from huggingface_hub import (
 from huggingface_hub.errors import RepositoryNotFoundError
 
 from mttl.logging import logger
+from mttl.models.library.auxiliary_bundle import (
+    BUNDLE_EXTENSION,
+    bundle_file_name,
+    decode_bundle,
+    encode_bundle,
+    read_bundle_header,
+)
 from mttl.models.library.backend_engine import (
     BlobStorageEngine,
     HuggingfaceHubEngine,
@@ -26,6 +34,11 @@ from mttl.models.library.backend_engine import (
     VirtualFSEngine,
 )
 from mttl.models.library.expert import Expert, ExpertInfo, load_expert
+from mttl.models.library.quantization import (
+    check_storage_dtype,
+    dequantize_weights,
+    quantize_weights,
+)
 
 
 @total_ordering
@@ -63,12 +76,22 @@ class Score:
         return self.value == other.value
 
 
+# single file listing the metadata of every expert and the auxiliary data of the library
+MANIFEST_FILE = "library.manifest"
+MANIFEST_VERSION = 2
+
+
 @dataclass
 class MetadataEntry(ExpertInfo):
     expert_deleted: bool = False
+    # format of the stored weights, see `mttl.models.library.quantization`, None is fp32
+    storage_dtype: str = None
 
 
 class ExpertLibrary:
+    # bundles of auxiliary data are rewritten to hold new data until they hold this many experts
+    _bundle_rewrite_max_experts = 32
+
     def __init__(
         self,
         repo_id: str,
@@ -78,6 +101,7 @@ class ExpertLibrary:
         exclude_selection: Optional[List[str]] = None,
         create: bool = False,
         ignore_sliced: bool = False,
+        storage_dtype: Optional[str] = None,
     ):
         super().__init__()
 
@@ -87,9 +111,14 @@ class ExpertLibrary:
         self.selection = selection
         self.exclude_selection = exclude_selection
         self.model_name = model_name
+        # default format of the weights of new experts
+        self.storage_dtype = storage_dtype
         self._in_transaction = False
         self._pending_operations = []
         self._pending_pre_uploads = []
+        # auxiliary data added in the current transaction, by data type and config
+        self._pending_auxiliary_data = {}
+        self._manifest = None
         self.data = {}
 
         self.ignore_sliced = ignore_sliced
@@ -128,20 +157,40 @@ class ExpertLibrary:
     def sliced(self):
         return self._sliced and not self.ignore_sliced
 
-    def _build_lib(self):
-        self._sliced = False
-        self.data = {}
+    def _load_manifest(self, repo_files):
+        """Reads the manifest of the library, None if it is missing or of another version."""
+        if MANIFEST_FILE not in repo_files:
+            return None
 
         try:
-            # Get the list of files in the repository
-            repo_files = self.list_repo_files(self.repo_id)
-            # Filter out the .meta files
-            meta_files = [file for file in repo_files if file.endswith(".meta")]
+            path_or_bytes = self.hf_hub_download(self.repo_id, MANIFEST_FILE)
+            manifest = torch.load(path_or_bytes, map_location="cpu", weights_only=False)
         except Exception as e:
-            if isinstance(e, RepositoryNotFoundError):
-                logger.error("Repository not found: %s", self.repo_id)
-            raise e
+            logger.warning("Could not read the library manifest: %s", e)
+            return None
 
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def _manifest_addition(self, operations=()):
+        """The manifest, written in the same commit as `operations`."""
+        for op in operations:
+            if not op.path_in_repo.endswith((".meta", ".bin")):
+                continue
+            if isinstance(op, CommitOperationAdd):
+                # the revision is only known once the file is written
+                size = op.path_or_fileobj.getbuffer().nbytes
+                self._manifest["files"][op.path_in_repo] = [size, None]
+            elif isinstance(op, CommitOperationDelete):
+                self._manifest["files"].pop(op.path_in_repo, None)
+
+        buffer = io.BytesIO()
+        torch.save(self._manifest, buffer)
+        buffer.flush()
+        return CommitOperationAdd(path_in_repo=MANIFEST_FILE, path_or_fileobj=buffer)
+
+    def _download_metadata(self, meta_files):
         if isinstance(self, BlobExpertLibrary):
             local_filenames = asyncio.run(
                 self.async_download_blobs(
@@ -185,6 +234,88 @@ class ExpertLibrary:
                         metadata.append(data)
                     except Exception as exc:
                         logger.error("%r generated an exception: %s" % (file, exc))
+        return metadata
+
+    def _build_lib(self):
+        """Lists the experts of the library.
+
+        The metadata is read from the manifest, only the .meta files it doesn't know or that
+        were rewritten since it was written are downloaded, e.g. by clients which don't write
+        the manifest. Files are compared by revision, or by size for the files written in the
+        same commit as the manifest. Opening a library never writes to it, the manifest is
+        brought up to date by the next write or by `rebuild_manifest`.
+        """
+        self._sliced = False
+        self.data = {}
+
+        try:
+            # Get the files in the repository, with their size and revision
+            repo_files = self.list_repo_file_revisions(self.repo_id)
+            # Filter out the .meta files
+            meta_files = [file for file in repo_files if file.endswith(".meta")]
+        except Exception as e:
+            if isinstance(e, RepositoryNotFoundError):
+                logger.error("Repository not found: %s", self.repo_id)
+            raise e
+
+        manifest = self._load_manifest(repo_files) or {
+            "version": MANIFEST_VERSION,
+            "experts": {},
+        }
+        known_files = manifest.get("files", {})
+
+        def unchanged(file):
+            if file not in known_files:
+                return False
+            size, revision = known_files[file]
+            current_size, current_revision = repo_files[file]
+            if revision is None:
+                return size == current_size
+            return revision == current_revision
+
+        # drop experts and auxiliary data whose files were removed or rewritten behind the manifest
+        experts = {
+            name: entry
+            for name, entry in manifest["experts"].items()
+            if f"{name}.meta" in repo_files and unchanged(f"{name}.meta")
+        }
+        aux_files = [file for file in repo_files if file.endswith(".bin")]
+        auxiliary_data = {
+            file: (
+                manifest.get("auxiliary_data", {}).get(file)
+                if unchanged(file)
+                else None
+            )
+            for file in aux_files
+        }
+        bundles = self._sync_bundles(
+            manifest.get("bundles", {}),
+            [file for file in repo_files if file.endswith(BUNDLE_EXTENSION)],
+            aux_files,
+        )
+
+        missing = [file for file in meta_files if file[: -len(".meta")] not in experts]
+        # `fromdict` consumes the dict it is given, the manifest keeps its own copy
+        metadata = [
+            MetadataEntry.fromdict(copy.deepcopy(entry)) for entry in experts.values()
+        ]
+        if missing:
+            for metadatum in self._download_metadata(missing):
+                experts[metadatum.expert_name] = metadatum.asdict()
+                metadata.append(metadatum)
+
+        self._manifest = {
+            "version": MANIFEST_VERSION,
+            "experts": experts,
+            "auxiliary_data": auxiliary_data,
+            "bundles": bundles,
+            # revisions as of this listing, for the files read or checked above
+            "files": {
+                file: list(repo_files[file])
+                for file in meta_files + aux_files
+                if file in missing or unchanged(file)
+            },
+        }
 
         for metadatum in metadata:
             if self.model_name is not None and metadatum.model != self.model_name:
@@ -211,6 +342,58 @@ class ExpertLibrary:
                 k: v for k, v in self.data.items() if k not in self.exclude_selection
             }
 
+    def rebuild_manifest(self):
+        """Lists the library again and writes its manifest, e.g. after files were added or
+        rewritten by clients which don't write it, so that the next openings only read it.
+        """
+        self._build_lib()
+        self.create_commit(
+            self.repo_id,
+            operations=[self._manifest_addition()],
+            commit_message="Update library manifest.",
+        )
+
+    def _sync_bundles(self, bundles, bundle_files, aux_files):
+        """Returns the index of the bundles of auxiliary data, for the bundles in `bundle_files`.
+
+        Bundles missing from the index are indexed from their header, the later bundles of a data
+        type replacing the data of the earlier ones. Writing a bundle deletes the files of the
+        data it replaces, so data also found in `aux_files` was written after the bundle.
+        """
+        synced = {}
+        for data_type, index in bundles.items():
+            segments = {
+                file: config
+                for file, config in index["segments"].items()
+                if file in bundle_files
+            }
+            if segments:
+                synced[data_type] = {
+                    "segments": segments,
+                    "experts": {
+                        name: file
+                        for name, file in index["experts"].items()
+                        if file in segments
+                    },
+                }
+
+        indexed = {file for index in synced.values() for file in index["segments"]}
+        for file in sorted(set(bundle_files) - indexed):
+            data_type = file[: -len(BUNDLE_EXTENSION)].rsplit(".", 1)[0]
+            path_or_bytes = self.hf_hub_download(self.repo_id, file)
+            expert_names, config = read_bundle_header(path_or_bytes)
+
+            index = synced.setdefault(data_type, {"segments": {}, "experts": {}})
+            index["segments"][file] = repr(config)
+            index["experts"].update(
+                {
+                    name: file
+                    for name in expert_names
+                    if f"{name}.{data_type}.bin" not in aux_files
+                }
+            )
+        return synced
+
     def refresh_from_remote(self):
         self._build_lib()
 
@@ -221,9 +404,9 @@ class ExpertLibrary:
         model_file = f"{model_name}.ckpt"
         return self.hf_hub_download(self.repo_id, filename=model_file)
 
-    def _upload_weights(self, expert_name, expert_dump):
+    def _upload_weights(self, expert_name, expert_dump, storage_dtype=None):
         buffer = io.BytesIO()
-        torch.save(expert_dump.expert_weights, buffer)
+        torch.save(quantize_weights(expert_dump.expert_weights, storage_dtype), buffer)
         buffer.flush()
 
         logger.info(f"Uploading expert to {self.repo_id}...")
@@ -250,13 +433,14 @@ class ExpertLibrary:
         addition = CommitOperationAdd(
             path_in_repo=f"{metadata.expert_name}.meta", path_or_fileobj=buffer
         )
+        self._manifest["experts"][metadata.expert_name] = metadata.asdict()
 
         if self._in_transaction:
             self._pending_operations.append(addition)
         else:
             self.create_commit(
                 self.repo_id,
-                operations=[addition],
+                operations=[addition, self._manifest_addition([addition])],
                 commit_message=f"Update library with {metadata.expert_name}.",
             )
             logger.info(f"Metadata for {metadata.expert_name} uploaded successfully.")
@@ -269,8 +453,11 @@ class ExpertLibrary:
         for k in list(self.keys()):
             yield k, self.__getitem__(k)
 
-    def get_expert(self, expert_name, with_auxiliary_data: bool = False):
-        expert_dump = self[expert_name]
+    def get_expert(
+        self, expert_name, with_auxiliary_data: bool = False, device: str = "cpu"
+    ):
+        """Loads an expert, quantized weights are dequantized on `device`."""
+        expert_dump = self._load_expert(expert_name, device=device)
 
         if with_auxiliary_data:
             scores = self.get_auxiliary_data(
@@ -280,6 +467,9 @@ class ExpertLibrary:
         return expert_dump
 
     def __getitem__(self, expert_name):
+        return self._load_expert(expert_name)
+
+    def _load_expert(self, expert_name, device="cpu"):
         if self._in_transaction:
             raise ValueError(
                 "Cannot access library while in transaction. Finish current commit!"
@@ -291,6 +481,9 @@ class ExpertLibrary:
         model = self._download_model(expert_name)
         # Load the model from the downloaded file
         model = torch.load(model, map_location="cpu", weights_only=True)
+        model = dequantize_weights(
+            model, self.data[expert_name].storage_dtype, device=device
+        )
 
         return Expert(
             expert_info=self.data[expert_name],
@@ -306,7 +499,14 @@ class ExpertLibrary:
         expert_name: str = None,
         force: bool = False,
         update_readme: bool = True,
+        storage_dtype: Optional[str] = None,
     ):
+        """Adds an expert to the library.
+
+        `storage_dtype` is the format in which the weights are stored, one of "fp32", "fp16",
+        "bf16", "int8" (per-channel scales) or "nf4" (4-bit, blockwise scales). It defaults to the
+        format of the library, fp32 if None, whatever the format the expert was stored in before.
+        """
         if self.sliced:
             raise ValueError("Cannot add expert to sliced library.")
 
@@ -326,8 +526,11 @@ class ExpertLibrary:
 
         # convert to metadata entry
         metadata = MetadataEntry.fromdict(expert_dump.expert_info.asdict())
+        metadata.storage_dtype = storage_dtype or self.storage_dtype
+        if metadata.storage_dtype is not None:
+            check_storage_dtype(metadata.storage_dtype)
 
-        self._upload_weights(metadata.expert_name, expert_dump)
+        self._upload_weights(metadata.expert_name, expert_dump, metadata.storage_dtype)
         self._upload_metadata(metadata)
         self.data[metadata.expert_name] = metadata
         # only update readme if requested. This is useful when adding multiple experts in a batch
@@ -348,6 +551,11 @@ class ExpertLibrary:
 
             if data_type in auxiliary_data:
                 auxiliary_data[data_type][0] += 1
+            elif self._manifest["auxiliary_data"].get(file) is not None:
+                auxiliary_data[data_type] = [
+                    1,
+                    self._manifest["auxiliary_data"][file],
+                ]
             else:
                 path = self.hf_hub_download(self.repo_id, filename=file)
                 try:
@@ -356,6 +564,12 @@ class ExpertLibrary:
                     # old format
                     config = "N/A"
                 auxiliary_data[data_type] = [1, config]
+
+        for data_type, index in self._manifest["bundles"].items():
+            record = auxiliary_data.setdefault(data_type, [0, None])
+            record[0] += len(index["experts"])
+            # config of the latest bundle
+            record[1] = index["segments"][max(index["segments"])]
         return auxiliary_data
 
     def get_auxiliary_data(
@@ -423,6 +637,16 @@ class ExpertLibrary:
                 except Exception as exc:
                     logger.error("%r generated an exception: %s" % (name, exc))
 
+        # bundled data is read with one download per bundle for all the experts it holds
+        bundled = self._bundle_index(data_type)["experts"]
+        expert_names = set(expert_names)
+        for file in {bundled[name] for name in expert_names if name in bundled}:
+            path_or_bytes = self.hf_hub_download(self.repo_id, filename=file)
+            data, config = decode_bundle(path_or_bytes)
+            for name, value in data.items():
+                if name in expert_names and bundled.get(name) == file:
+                    auxiliary_data[name] = (config, value) if return_config else value
+
         if expert_name is not None:
             return auxiliary_data[expert_name]
 
@@ -447,6 +671,7 @@ class ExpertLibrary:
             expert_name
             and data_type
             and f"{expert_name}.{data_type}.bin" not in list_of_files
+            and expert_name not in self._bundle_index(data_type)["experts"]
         ):
             raise ValueError(
                 f"Auxiliary data of type {data_type} for expert {expert_name} not found in repository."
@@ -459,20 +684,34 @@ class ExpertLibrary:
             files_to_remove = [
                 f for f in list_of_files if f.startswith(f"{expert_name}.")
             ]
+        elif expert_name is None:
+            files_to_remove = [
+                f for f in list_of_files if f.endswith(f".{data_type}.bin")
+            ]
         else:
             files_to_remove = [f"{expert_name}.{data_type}.bin"]
+        files_to_remove = [f for f in files_to_remove if f in list_of_files]
 
         deletion_ops = []
         for file in files_to_remove:
             deletion = CommitOperationDelete(path_in_repo=file)
             deletion_ops.append(deletion)
+            self._manifest["auxiliary_data"].pop(file, None)
+
+        # bundles are deleted once none of their experts is left in the index
+        for bundle_type, index in self._manifest["bundles"].items():
+            if data_type is None or bundle_type == data_type:
+                for name in list(index["experts"]):
+                    if expert_name is None or name == expert_name:
+                        index["experts"].pop(name)
+        deletion_ops.extend(self._orphan_bundle_deletions())
 
         if self._in_transaction:
             self._pending_operations.extend(deletion_ops)
         else:
             self.create_commit(
                 self.repo_id,
-                operations=deletion_ops,
+                operations=deletion_ops + [self._manifest_addition(deletion_ops)],
                 commit_message=f"Deleting auxiliary data from the library.",
             )
             logger.info(f"Deletion of {files_to_remove} successful.")
@@ -509,6 +748,7 @@ class ExpertLibrary:
         if not soft_delete:
             deletion_a = CommitOperationDelete(path_in_repo=f"{expert_name}.ckpt")
             deletion_b = CommitOperationDelete(path_in_repo=f"{expert_name}.meta")
+            self._manifest["experts"].pop(expert_name, None)
 
             if self._in_transaction:
                 # watch out, if other operations (adding files) are pending, this might be dangerous
@@ -516,7 +756,11 @@ class ExpertLibrary:
             else:
                 self.create_commit(
                     self.repo_id,
-                    operations=[deletion_a, deletion_b],
+                    operations=[
+                        deletion_a,
+                        deletion_b,
+                        self._manifest_addition([deletion_a, deletion_b]),
+                    ],
                     commit_message=f"Update library with {expert_name}.",
                 )
                 logger.info(f"Deletion of {expert_name} successful.")
@@ -568,13 +812,15 @@ class ExpertLibrary:
             path_in_repo=f"{scores_file}", path_or_fileobj=buffer
         )
         operations.append(addition_a)
+        # scores are stored without config
+        self._manifest["auxiliary_data"][scores_file] = "N/A"
 
         if self._in_transaction:
             self._pending_operations.extend(operations)
         else:
             self.create_commit(
                 self.repo_id,
-                operations=operations,
+                operations=operations + [self._manifest_addition(operations)],
                 commit_message=f"Update library with embedding for {expert_name}.",
             )
             logger.info(f"Scores for {expert_name} uploaded successfully.")
@@ -590,43 +836,155 @@ class ExpertLibrary:
         if expert_name not in self.data and expert_name != "base_model":
             raise ValueError(f"Expert {expert_name} not found in repository.")
 
-        operations = []
         aux_file = f"{expert_name}.{data_type}.bin"
+        # data added earlier in the transaction, for each config of this data type
+        pending = [
+            entries
+            for (pending_type, _), (_, entries) in self._pending_auxiliary_data.items()
+            if pending_type == data_type
+        ]
 
-        aux_data = self.list_repo_files(self.repo_id)
-        if aux_file in aux_data and not force:
+        if not force and (
+            aux_file in self.list_repo_files(self.repo_id)
+            or expert_name in self._bundle_index(data_type)["experts"]
+            or any(expert_name in entries for entries in pending)
+        ):
             raise ValueError(
                 f"Data of type {data_type} for expert {expert_name} already exists in repository. Set `force=True` to overwrite."
             )
 
-        payload = {
-            "data": data,
-            "config": config,
-        }
-
-        buffer = io.BytesIO()
-        torch.save(payload, buffer)
-        buffer.flush()
-
-        addition_a = CommitOperationAdd(
-            path_in_repo=f"{aux_file}", path_or_fileobj=buffer
-        )
-        operations.append(addition_a)
-
         if self._in_transaction:
-            self._pending_pre_uploads.extend(operations)
-            self._pending_operations.extend(operations)
+            # the latest data of the expert is the only one written
+            for entries in pending:
+                entries.pop(expert_name, None)
+            # written at the end of the transaction, in one bundle per data type
+            _, entries = self._pending_auxiliary_data.setdefault(
+                (data_type, repr(config)), (config, {})
+            )
+            entries[expert_name] = data
         else:
-            self.preupload_lfs_files(self.repo_id, additions=operations)
+            operations = self._auxiliary_data_operations(
+                data_type, {expert_name: data}, config
+            )
+            self.preupload_lfs_files(
+                self.repo_id,
+                additions=[
+                    op for op in operations if isinstance(op, CommitOperationAdd)
+                ],
+            )
             self.create_commit(
                 self.repo_id,
-                operations=operations,
+                operations=operations + [self._manifest_addition(operations)],
                 commit_message=f"Upload auxiliary data {data_type} for {expert_name}.",
             )
             logger.info(
                 f"Auxiliary data {data_type} for {expert_name} uploaded successfully."
             )
 
+    def _bundle_index(self, data_type):
+        return self._manifest["bundles"].get(data_type, {"segments": {}, "experts": {}})
+
+    def _auxiliary_data_operations(self, data_type, entries, config):
+        """Operations storing the auxiliary data of several experts.
+
+        The data is stored in a bundle, or in one file per expert if it does not fit the layout
+        of bundles, and replaces the data of this type previously stored for the experts. The
+        latest bundle of the data type is rewritten with the new data if they share their config
+        and layout, and it holds fewer than `_bundle_rewrite_max_experts` experts: adding the
+        data of experts one at a time creates a bundle per `_bundle_rewrite_max_experts`
+        experts, and each addition rewrites at most that many. Batching the additions in
+        `batched_commit` avoids the rewrites.
+        """
+        try:
+            buffer = io.BytesIO(encode_bundle(entries, config))
+        except ValueError:
+            buffer = None
+
+        segments = self._bundle_index(data_type)["segments"]
+        bundled = self._bundle_index(data_type)["experts"]
+        current = max(segments) if segments else None
+        if (
+            buffer is not None
+            and segments.get(current) == repr(config)
+            and list(bundled.values()).count(current) < self._bundle_rewrite_max_experts
+        ):
+            data, _ = decode_bundle(
+                self.hf_hub_download(self.repo_id, filename=current)
+            )
+            kept = {
+                name: value
+                for name, value in data.items()
+                if bundled.get(name) == current and name not in entries
+            }
+            try:
+                buffer = io.BytesIO(encode_bundle({**kept, **entries}, config))
+                entries = {**kept, **entries}
+            except ValueError:
+                # another layout, the new data goes to a bundle of its own
+                pass
+
+        operations = []
+        if buffer is not None:
+            index = self._manifest["bundles"].setdefault(
+                data_type, {"segments": {}, "experts": {}}
+            )
+            number = 1 + max(
+                (int(file.rsplit(".", 2)[1]) for file in index["segments"]),
+                default=-1,
+            )
+            bundle_file = bundle_file_name(data_type, number)
+            operations.append(
+                CommitOperationAdd(path_in_repo=bundle_file, path_or_fileobj=buffer)
+            )
+            index["segments"][bundle_file] = repr(config)
+            index["experts"].update({name: bundle_file for name in entries})
+
+        for expert_name, data in entries.items():
+            aux_file = f"{expert_name}.{data_type}.bin"
+            if buffer is not None:
+                if aux_file in self._manifest["auxiliary_data"]:
+                    operations.append(CommitOperationDelete(path_in_repo=aux_file))
+                    self._manifest["auxiliary_data"].pop(aux_file)
+                continue
+
+            payload = {
+                "data": data,
+                "config": config,
+            }
+
+            aux_buffer = io.BytesIO()
+            torch.save(payload, aux_buffer)
+            aux_buffer.flush()
+
+            operations.append(
+                CommitOperationAdd(path_in_repo=aux_file, path_or_fileobj=aux_buffer)
+            )
+            self._manifest["auxiliary_data"][aux_file] = repr(config)
+            self._bundle_index(data_type)["experts"].pop(expert_name, None)
+        return operations + self._orphan_bundle_deletions()
+
+    def _orphan_bundle_deletions(self):
+        """Removes from the index the bundles that hold data of no expert anymore."""
+        operations = []
+        for data_type, index in list(self._manifest["bundles"].items()):
+            used = set(index["experts"].values())
+            for file in [f for f in index["segments"] if f not in used]:
+                index["segments"].pop(file)
+                pending = [
+                    op
+                    for op in self._pending_operations
+                    if isinstance(op, CommitOperationAdd) and op.path_in_repo == file
+                ]
+                if pending:
+                    # written earlier in the transaction, no need to upload it
+                    self._pending_operations.remove(pending[0])
+                    self._pending_pre_uploads.remove(pending[0])
+                else:
+                    operations.append(CommitOperationDelete(path_in_repo=file))
+            if not index["segments"]:
+                self._manifest["bundles"].pop(data_type)
+        return operations
+
     def add_embeddings(
         self,
         expert_name: str,
@@ -688,6 +1046,14 @@ class ExpertLibrary:
         # set in transaction flag
         self._in_transaction = True
         yield
+        for (data_type, _), (config, entries) in self._pending_auxiliary_data.items():
+            operations = self._auxiliary_data_operations(data_type, entries, config)
+            self._pending_pre_uploads.extend(
+                op for op in operations if isinstance(op, CommitOperationAdd)
+            )
+            self._pending_operations.extend(operations)
+        self._pending_auxiliary_data.clear()
+
         if len(self._pending_operations) == 0:
             self._in_transaction = False
             return
@@ -695,9 +1061,11 @@ class ExpertLibrary:
 
         if self._pending_pre_uploads:
             self.preupload_lfs_files(self.repo_id, additions=self._pending_pre_uploads)
+        # the manifest is written once, in the same commit as the files it lists
         self.create_commit(
             self.repo_id,
-            operations=self._pending_operations,
+            operations=self._pending_operations
+            + [self._manifest_addition(self._pending_operations)],
             commit_message="Update library with new ops.",
         )
 
@@ -734,6 +1102,7 @@ class ExpertLibrary:
         self.data[new_name] = metadata
         self.data.pop(old_name)
 
+        self._manifest["experts"].pop(old_name, None)
         meta_delete = CommitOperationDelete(path_in_repo=f"{old_name}.meta")
         ckpt_copy = CommitOperationCopy(
             src_path_in_repo=f"{old_name}.ckpt", path_in_repo=f"{new_name}.ckpt"
@@ -798,7 +1167,14 @@ class ExpertLibrary:
             update_readme = False
             for name, expert in self.items():
                 if expert.name not in new_lib:
-                    new_lib.add_expert(expert, name, force=force, update_readme=False)
+                    # clones keep the format of the experts
+                    new_lib.add_expert(
+                        expert,
+                        name,
+                        force=force,
+                        update_readme=False,
+                        storage_dtype=self.data[name].storage_dtype,
+                    )
                     update_readme = True
 
             # only update readme if we added new experts
@@ -925,6 +1301,7 @@ class ExpertLibrary:
         ignore_sliced: bool = False,
         expert_library_type: Union[Type["ExpertLibrary"], str] = None,
         destination_id: Optional[str] = None,
+        storage_dtype: Optional[str] = None,
     ) -> "ExpertLibrary":
         """Instantiate an ExpertLibrary from one of the available expert library types:
             - "local": LocalExpertLibrary,
@@ -948,6 +1325,7 @@ class ExpertLibrary:
             exclude_selection=exclude_selection,
             create=create,
             ignore_sliced=ignore_sliced,
+            storage_dtype=storage_dtype,
         )
 
         if destination_id is not None:
@@ -965,13 +1343,20 @@ class LocalExpertLibrary(ExpertLibrary, LocalFSEngine):
         expert_name: str = None,
         force: bool = False,
         update_readme: bool = True,
+        storage_dtype: Optional[str] = None,
     ):
         expert_name = expert_name or expert_dump.expert_info.expert_name
         if "/" in expert_name:
             # create sub-folders if necessary
             path = expert_name.split("/")
             os.makedirs(os.path.join(self.repo_id, *path[:-1]), exist_ok=True)
-        return super().add_expert(expert_dump, expert_name=expert_name, force=force)
+        return super().add_expert(
+            expert_dump,
+            expert_name=expert_name,
+            force=force,
+            update_readme=update_readme,
+            storage_dtype=storage_dtype,
+        )
 
 
 class BlobExpertLibrary(ExpertLibrary, BlobStorageEngine):
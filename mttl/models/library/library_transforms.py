@@ -1,7 +1,11 @@
 import abc
 import copy
 import dataclasses
+import hashlib
 import re
+import resource
+import time
+import zlib
 from abc import abstractmethod
 from collections import defaultdict
 from dataclasses import dataclass
@@ -103,18 +107,44 @@ class LibraryTransformConfig(Serializable):
 class SVDEmbeddingTransformConfig(LibraryTransformConfig):
     n_components: int = 64
     sparsity_threshold: float = 0.8
+    # if set, experts with more parameters are hashed to this size
+    sketch_dim: int = None
+    # if set, the sparsity threshold of larger experts is estimated on this many entries
+    quantile_sample_size: int = None
+
+    def param_hash(self):
+        # exact embeddings keep the names they had before sketching was available
+        return param_hash(
+            self,
+            exclude_fields=[
+                f
+                for f in ["sketch_dim", "quantile_sample_size"]
+                if getattr(self, f) is None
+            ],
+        )
 
 
 @LibraryTransform.register("svd_embedding", SVDEmbeddingTransformConfig)
 class SVDEmbeddingTransform(LibraryTransform):
     """Creates adapter embeddings by low-rank decomposition of a sparsified version
     of the adapter experts.
+
+    Experts are streamed one at a time: each one is sparsified with a per-expert quantile
+    threshold, estimated on `quantile_sample_size` entries if set. With `sketch_dim`, experts
+    with more parameters are hashed into a `sketch_dim` count-sketch that preserves inner
+    products in expectation. The SVD factors are persisted with the embeddings, so that
+    experts added to the library later can be folded in without recomputing the
+    decomposition.
     """
 
     def __init__(self, config, random_state=None):
         super().__init__(config)
         self.random_state = random_state
 
+    @property
+    def factors_name(self):
+        return self.config.save_name + "-factors"
+
     @classmethod
     @torch.no_grad()
     def fetch(cls, library: Union[str, ExpertLibrary], config_hash: str = None):
@@ -134,6 +164,99 @@ class SVDEmbeddingTransform(LibraryTransform):
             "SVD embeddings are missing or corrupted, please recompute them."
         )
 
+    def _sparsity_threshold(self, weights, n_params):
+        """Per-expert quantile of the absolute weights, estimated on a sample if too large."""
+        sample_size = self.config.quantile_sample_size
+        if sample_size is None or n_params <= sample_size:
+            values = torch.cat([w.abs() for w in weights.values()])
+        else:
+            # sample each parameter proportionally to its size
+            rng = torch.Generator().manual_seed(self.random_state or 0)
+            values = []
+            for w in weights.values():
+                n_samples = round(sample_size * w.numel() / n_params)
+                idxs = torch.randint(w.numel(), (max(1, n_samples),), generator=rng)
+                values.append(w[idxs].abs())
+            values = torch.cat(values)
+        return np.quantile(values.numpy(), self.config.sparsity_threshold)
+
+    @torch.no_grad()
+    def _sketch_expert(self, expert: Expert):
+        """Returns the sparsified, and possibly hashed, flat vector of an expert."""
+        weights = {
+            name: w.detach().flatten().float().cpu()
+            for name, w in sorted(expert.expert_weights.items())
+        }
+        n_params = sum(w.numel() for w in weights.values())
+        thr = self._sparsity_threshold(weights, n_params)
+
+        if self.config.sketch_dim is None or n_params <= self.config.sketch_dim:
+            row = torch.cat(list(weights.values()))
+            row[row.abs() <= thr] = 0.0
+            return row.numpy(), thr
+
+        row = torch.zeros(self.config.sketch_dim)
+        for name, w in weights.items():
+            w = torch.where(w.abs() <= thr, 0.0, w)
+            # buckets and signs only depend on the parameter name, so that the sketches
+            # of experts computed at different times live in the same space
+            rng = torch.Generator().manual_seed(
+                zlib.crc32(name.encode()) + (self.random_state or 0)
+            )
+            buckets = torch.randint(self.config.sketch_dim, w.shape, generator=rng)
+            signs = torch.randint(2, w.shape, generator=rng) * 2.0 - 1.0
+            row.index_add_(0, buckets, w * signs)
+        return row.numpy(), thr
+
+    @property
+    def factors_config(self):
+        """Settings the SVD factors were computed with, folding in requires the same."""
+        return {
+            "n_components": self.config.n_components,
+            "sparsity_threshold": self.config.sparsity_threshold,
+            "sketch_dim": self.config.sketch_dim,
+            "quantile_sample_size": self.config.quantile_sample_size,
+            "random_state": self.random_state,
+        }
+
+    def _fold_in(self, library: ExpertLibrary, persist: bool):
+        """Projects experts missing an embedding onto the persisted SVD factors."""
+        output = library.get_auxiliary_data(data_type=self.config.save_name)
+        missing = [name for name in library.keys() if name not in output]
+        if not output or not missing:
+            return None
+
+        try:
+            factors = library.get_auxiliary_data(
+                data_type=self.factors_name, expert_name="base_model"
+            )
+        except KeyError:
+            return None
+        if factors.get("config") != self.factors_config:
+            logger.info("SVD factors were computed with other settings, recomputing.")
+            return None
+        components = factors["components"]
+
+        logger.info("Folding in SVD Embeddings for %s new experts", len(missing))
+        new_embeddings = {}
+        for name in tqdm(missing):
+            embedding = self._sketch_expert(library[name])[0] @ components.T
+            new_embeddings[name] = embedding / np.linalg.norm(embedding, 2)
+
+        if persist:
+            with library.batched_commit():
+                for name, embedding in new_embeddings.items():
+                    library.add_auxiliary_data(
+                        data_type=self.config.save_name,
+                        expert_name=name,
+                        config=self.config.__dict__,
+                        data=embedding,
+                        force=True,  # make sure we overwrite
+                    )
+
+        output.update(new_embeddings)
+        return {name: output[name] for name in library.keys()}
+
     def transform(self, library, persist=True, recompute=False):
         if type(library) == str:
             library = ExpertLibrary.get_expert_library(library)
@@ -147,6 +270,11 @@ class SVDEmbeddingTransform(LibraryTransform):
         except ValueError:
             pass
 
+        if not recompute:
+            output = self._fold_in(library, persist)
+            if output is not None:
+                return output
+
         logger.info("Computing SVD Embeddings for %s experts", len(library))
         logger.info("Saving to: %s", self.config.save_name)
 
@@ -160,29 +288,16 @@ class SVDEmbeddingTransform(LibraryTransform):
             tol=0.0,
         )
 
-        array, names = [], []
+        # only the (n_experts, sketch_dim) matrix of sketches is kept in memory
+        array, names, thr = [], [], []
         for name in tqdm(list(library.keys())):
-            expert = library[name]
-            array += [
-                torch.nn.utils.parameters_to_vector(
-                    [p for p in expert.expert_weights.values()]
-                )
-            ]
+            row, row_thr = self._sketch_expert(library[name])
+            array += [row]
             names += [name]
-        array = torch.stack(array).cpu().numpy()
-
-        # Use quantiles to fit the exact threshold
-        thr = np.quantile(np.abs(array), self.config.sparsity_threshold, axis=1)
-        array[np.abs(array) <= thr.reshape(-1, 1)] = 0.0
+            thr += [row_thr]
+        array = np.stack(array)
 
         logger.info("Sparsity threshold: {}".format(str([f"{x:.4f}" for x in thr])))
-        assert (
-            np.abs(
-                (array == 0).sum(axis=1) / np.prod(array.shape[1])
-                - self.config.sparsity_threshold
-            ).max()
-            < 1e-4
-        )
 
         experts_embeddings = svd.fit_transform(array)
         experts_embeddings = (
@@ -202,6 +317,16 @@ class SVDEmbeddingTransform(LibraryTransform):
                         data=experts_embeddings[i],
                         force=True,  # make sure we overwrite
                     )
+                library.add_auxiliary_data(
+                    data_type=self.factors_name,
+                    expert_name="base_model",
+                    config=self.config.__dict__,
+                    data={
+                        "components": svd.components_,
+                        "config": self.factors_config,
+                    },
+                    force=True,
+                )
         return dict(zip(names, experts_embeddings))
 
 
@@ -414,6 +539,7 @@ class HiddenStateComputer(LibraryTransform):
             setattr(args, arg_name, value)
 
     def _track_hidden_states(self, model, keys=None, device="cpu"):
+        """Registers hooks storing hidden states in `model.container`, returns the hook handles."""
         model.container = {}
 
         if model.model is None:
@@ -424,7 +550,9 @@ class HiddenStateComputer(LibraryTransform):
             def fetch_input(module, input, output):
                 model.container["last_layer"] = input[0].detach().to(device)
 
-            model.model.get_output_embeddings().register_forward_hook(fetch_input)
+            return [
+                model.model.get_output_embeddings().register_forward_hook(fetch_input)
+            ]
         elif self.config.track == "each_layer":
             # add a hook for all the layers that an expert modifies
             def build_hook(name):
@@ -433,8 +561,10 @@ class HiddenStateComputer(LibraryTransform):
 
                 return retrieve_input
 
-            for container in model.experts_containers:
+            return [
                 container.register_forward_hook(build_hook(container.layer_name))
+                for container in model.experts_containers
+            ]
         else:
             raise NotImplementedError()
 
@@ -446,6 +576,51 @@ class HiddenStateComputer(LibraryTransform):
 
         return {k: v for k, v in zip(keys, values)}
 
+    def _pool_hidden_states(self, hidden_state, attention_mask):
+        """Pools (bs, seq_len, D) hidden states into one (bs, D) embedding per example."""
+        assert hidden_state.ndim == 3
+
+        attention_mask = attention_mask.to(hidden_state.device)
+        if self.config.pool == "last":
+            last_token_idx = attention_mask.sum(1) - 1
+            bs_idx = torch.arange(hidden_state.size(0), device=hidden_state.device)
+            return hidden_state[bs_idx, last_token_idx]
+        elif self.config.pool == "mean":
+            deno = attention_mask.sum(1, keepdim=True)
+            return (hidden_state * attention_mask.unsqueeze(-1)).sum(1) / deno
+        else:
+            raise NotImplementedError()
+
+    def _compute_centroids(self, model, training_config, device="cpu"):
+        """
+        Runs `model` over the train split described by `training_config` and returns the
+        normalized average of the pooled hidden states of each tracked layer.
+        """
+        dm = get_datamodule(training_config)
+        dataloader = dm.train_dataloader()
+
+        centroid, count = defaultdict(lambda: 0.0), 0
+
+        pbar = tqdm(enumerate(dataloader), total=len(dataloader))
+        device_model = next(model.parameters()).device
+
+        for _, batch in pbar:
+            batch = transfer_batch_to_device(batch, device_model)
+            model.forward(**batch)
+
+            hidden_states = self._retrieve_hidden_states(model)
+            for layer, hidden_state in hidden_states.items():
+                pooled = self._pool_hidden_states(hidden_state, batch["attention_mask"])
+                centroid[layer] += pooled.sum(0)
+
+            count += batch["input_ids"].size(0)
+
+        # average over all batches
+        return {
+            layer: F.normalize(value / count, p=2, dim=-1).cpu()
+            for layer, value in centroid.items()
+        }
+
     @classmethod
     @torch.no_grad()
     def fetch(cls, library: Union[str, ExpertLibrary], config_hash: str = None):
@@ -474,8 +649,7 @@ class HiddenStateComputer(LibraryTransform):
         default_args=None,
         device="cpu",
     ) -> Expert:
-        from mttl.arguments import ExpertConfig
-        from mttl.models.lightning.expert_module import ExpertModule, MultiExpertModule
+        from mttl.arguments import DataArgs, ExpertConfig
 
         if isinstance(library, str):
             library = ExpertLibrary.get_expert_library(library)
@@ -490,10 +664,13 @@ class HiddenStateComputer(LibraryTransform):
             pass
 
         logger.info("Computing centroids for {} experts".format(len(library)))
-        output = {}
+        start_time = time.perf_counter()
 
-        for _, (expert_name, expert) in enumerate(library.items()):
-            training_config = ExpertConfig.from_dict(expert.training_config)
+        # plan the work from the metadata only, expert weights are loaded when needed
+        jobs = []
+        for expert_name in library.keys():
+            expert_info = library.data[expert_name]
+            training_config = ExpertConfig.from_dict(expert_info.training_config)
 
             if default_args is not None:
                 self._update_args(training_config, default_args)
@@ -501,78 +678,87 @@ class HiddenStateComputer(LibraryTransform):
             if self.config.use_base_model_only and self.config.model is not None:
                 training_config.model = self.config.model
 
-            model = MultiExpertModel(
-                MultiExpertModelConfig(
-                    base_model=training_config.model,
-                ),
-                device_map=training_config.device_map,
-            )
-            if not self.config.use_base_model_only:
-                model.add_expert_instance(expert, is_default=True)
-
-            self._track_hidden_states(model, device=device)
-
-            training_config.dataset = expert.expert_info.dataset
+            training_config.dataset = expert_info.dataset
             training_config.subsample_train = self.config.max_samples_per_task
-            if expert.expert_info.expert_task_name:
-                train_tasks = expert.expert_info.expert_task_name.split(",")
+            if expert_info.expert_task_name:
+                train_tasks = expert_info.expert_task_name.split(",")
                 training_config.finetune_task_name = ",".join(train_tasks)
                 training_config.subsample_train *= len(train_tasks)
-            else:
-                train_tasks = None
 
             training_config.train_batch_size = (
                 default_args.predict_batch_size if default_args is not None else 4
             )
+            jobs.append((expert_name, training_config))
 
-            # get datamodule
-            dm = get_datamodule(training_config)
-            dataloader = dm.train_dataloader()
-
-            centroid, count = defaultdict(lambda: 0.0), 0
+        # experts sharing a base model are processed back to back, so that each
+        # base model is loaded once and experts are swapped in and out of it
+        jobs.sort(key=lambda job: (str(job[1].model), str(job[1].device_map)))
 
-            pbar = tqdm(enumerate(dataloader), total=len(dataloader))
-            device_model = next(model.parameters()).device
+        resident_key, model, n_loads, n_passes = None, None, 0, 0
 
-            for _, batch in pbar:
-                batch = transfer_batch_to_device(batch, device_model)
-                model.forward(**batch)
+        def get_base_model(training_config):
+            nonlocal resident_key, model, n_loads
 
-                bs = batch["input_ids"].size(0)
-                last_token_idx = batch["attention_mask"].sum(1).to(device) - 1
-                hidden_states = self._retrieve_hidden_states(model)
-                bs_idx = torch.arange(
-                    bs, device=hidden_states[list(hidden_states.keys())[0]].device
+            key = (training_config.model, training_config.device_map)
+            if key != resident_key:
+                # release the previous base model before loading the next one
+                model = None
+                model = MultiExpertModel(
+                    MultiExpertModelConfig(base_model=training_config.model),
+                    device_map=training_config.device_map,
+                )
+                resident_key = key
+                n_loads += 1
+            return model
+
+        # each expert is encoded on its own sample of its own tasks, as when it is trained.
+        # Without the expert, experts whose data and base model are the same have the same
+        # hidden states, and share a single pass
+        passes = defaultdict(list)
+        for expert_name, training_config in jobs:
+            if self.config.use_base_model_only:
+                pass_key = (
+                    training_config.model,
+                    training_config.device_map,
+                ) + tuple(
+                    _hash_field(getattr(training_config, field.name, None))
+                    for field in dataclasses.fields(DataArgs)
                 )
+            else:
+                pass_key = expert_name
+            passes[pass_key].append((expert_name, training_config))
 
-                for layer, hidden_state in hidden_states.items():
-                    assert hidden_state.ndim == 3
-
-                    if self.config.pool == "last":
-                        centroid[layer] += hidden_state[bs_idx, last_token_idx].sum(0)
-                    elif self.config.pool == "mean":
-                        deno = batch["attention_mask"].sum(1, keepdim=True)
-                        centroid[layer] += (
-                            (hidden_state * batch["attention_mask"].unsqueeze(-1)).sum(
-                                1
-                            )
-                            / deno
-                        ).sum(0)
-                    else:
-                        raise NotImplementedError()
+        output = {}
+        for pass_jobs in passes.values():
+            expert_name, training_config = pass_jobs[0]
+            model = get_base_model(training_config)
+            if not self.config.use_base_model_only:
+                model.add_expert_instance(library[expert_name], is_default=True)
 
-                count += bs
+            handles = self._track_hidden_states(model, device=device)
+            centroids = self._compute_centroids(model, training_config, device)
+            for handle in handles:
+                handle.remove()
+            n_passes += 1
 
-            # average over all batches
-            for layer in centroid.keys():
-                centroid[layer] /= count
-                centroid[layer] = F.normalize(centroid[layer], p=2, dim=-1).cpu()
+            if not self.config.use_base_model_only:
+                # swap the expert out, the base model stays resident for the next one
+                model.delete_expert_container()
 
-            # convert to regular dict
-            centroids = {k: v for k, v in centroid.items()}
-            output[expert_name] = centroids
+            for expert_name, _ in pass_jobs:
+                output[expert_name] = centroids
 
-            del model
+        del model
+
+        logger.info(
+            "Computed centroids for {} experts in {:.1f}s ({} base model loads, {} dataset passes, peak RSS {:.1f} MB)".format(
+                len(output),
+                time.perf_counter() - start_time,
+                n_loads,
+                n_passes,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            )
+        )
 
         if persist:
             # add embeddings to the library
@@ -1248,22 +1434,122 @@ class CrossExpertNormComputer(HiddenStateComputer):
             )
 
 
+def assign_to_centroids(embeddings, centroids, chunk_size=4096):
+    """Assigns each normalized embedding to the centroid with the highest cosine similarity.
+
+    Returns the cluster labels and the cosine similarity of each embedding to its centroid.
+    """
+    labels, sims = [], []
+    for chunk in torch.split(embeddings, chunk_size):
+        chunk_sims, chunk_labels = (chunk @ centroids.T).max(dim=1)
+        labels.append(chunk_labels)
+        sims.append(chunk_sims)
+    return torch.cat(labels), torch.cat(sims)
+
+
+def spherical_kmeans(
+    embeddings, k, n_init=10, max_iter=100, random_state=None, chunk_size=4096
+):
+    """Spherical k-means on L2-normalized embeddings.
+
+    Embeddings are assigned to the centroid with the highest cosine similarity, centroids
+    are the normalized sum of their embeddings. Memory is linear in the number of embeddings.
+
+    Returns the labels and the centroids of the best of `n_init` k-means++ initializations.
+    """
+    n = embeddings.shape[0]
+    if n < k:
+        raise ValueError(f"Cannot build {k} clusters out of {n} embeddings.")
+
+    rng = torch.Generator().manual_seed(random_state or 0)
+    best_score, best_labels, best_centroids = None, None, None
+
+    for _ in range(n_init):
+        # k-means++ seeding, 1 - cos is proportional to the squared distance on the sphere
+        idxs = [torch.randint(n, (1,), generator=rng).item()]
+        distances = (1.0 - embeddings @ embeddings[idxs[0]]).clamp_(min=0.0)
+        for _ in range(1, k):
+            if distances.sum() > 0:
+                idx = torch.multinomial(distances, 1, generator=rng).item()
+            else:
+                idx = torch.randint(n, (1,), generator=rng).item()
+            idxs.append(idx)
+            distances = torch.minimum(
+                distances, (1.0 - embeddings @ embeddings[idx]).clamp_(min=0.0)
+            )
+        centroids = embeddings[idxs]
+
+        labels = None
+        for _ in range(max_iter):
+            new_labels, sims = assign_to_centroids(embeddings, centroids, chunk_size)
+            if labels is not None and torch.equal(new_labels, labels):
+                break
+            labels = new_labels
+
+            sums = torch.zeros_like(centroids).index_add_(0, labels, embeddings)
+            # empty clusters are re-seeded with the embeddings furthest from their centroid
+            empty = torch.where(sums.norm(dim=1) == 0)[0]
+            if len(empty):
+                sums[empty] = embeddings[sims.argsort()[: len(empty)]]
+            centroids = F.normalize(sums, p=2, dim=1)
+
+        labels, sims = assign_to_centroids(embeddings, centroids, chunk_size)
+        score = sims.sum().item()
+        if best_score is None or score > best_score:
+            best_score, best_labels, best_centroids = score, labels, centroids
+
+    return best_labels, best_centroids
+
+
 @dataclass
 class MBClusteringTransformConfig(SVDEmbeddingTransformConfig):
     random_state: int = 42
     k: int = 10
+    clustering: str = (
+        "cos_sim_kmeans"  # KMeans on similarities, or spherical (k-means on embeddings)
+    )
+    n_init: int = 10
+    max_iter: int = 100
 
 
 @LibraryTransform.register("mbc_with_cos_sim", MBClusteringTransformConfig)
 class MBCWithCosSimTransform(LibraryTransform):
     """
     Computes clusters based on the embedding similarity of the experts.
-    The input to KMeans is the cosine similarity matrix between the experts' embeddings.
+
+    By default, the input to KMeans is the cosine similarity matrix between the experts'
+    embeddings. With `clustering="spherical"`, spherical k-means runs on the normalized
+    embeddings instead, and its centroids and assignments are persisted in the library, so
+    that experts added later are assigned to the closest existing cluster without
+    reclustering the library, as long as `k` and the embeddings of the clustered experts
+    are unchanged.
     """
 
     def __init__(self, config: MBClusteringTransformConfig = None):
         super().__init__(config or MBClusteringTransformConfig())
 
+    @property
+    def clusters_name(self):
+        return self.config.save_name + "-clusters"
+
+    def fetch_clusters(self, library: ExpertLibrary):
+        """Returns the persisted centroids and assignments, or None."""
+        try:
+            return library.get_auxiliary_data(
+                data_type=self.clusters_name, expert_name="base_model"
+            )
+        except KeyError:
+            return None
+
+    @staticmethod
+    def embeddings_hash(embeddings, expert_names):
+        """Fingerprint of the embeddings of `expert_names`, to check they are unchanged."""
+        m = hashlib.sha256()
+        for name in sorted(expert_names):
+            m.update(name.encode())
+            m.update(np.asarray(embeddings[name], dtype=np.float64).tobytes())
+        return m.hexdigest()
+
     def transform(
         self,
         library: ExpertLibrary,
@@ -1274,6 +1560,8 @@ class MBCWithCosSimTransform(LibraryTransform):
             name=self.config.name,
             n_components=self.config.n_components,
             sparsity_threshold=self.config.sparsity_threshold,
+            sketch_dim=self.config.sketch_dim,
+            quantile_sample_size=self.config.quantile_sample_size,
         )
 
         def create_embeddings():
@@ -1295,19 +1583,78 @@ class MBCWithCosSimTransform(LibraryTransform):
         expert_names, embeddings = zip(*sorted(embeddings.items()))
 
         embeddings_array = np.stack(embeddings)
-        cosine_sim_matrix = cosine_similarity(embeddings_array, embeddings_array)
 
-        kmeans = KMeans(
-            n_clusters=self.config.k,
-            init="k-means++",
-            n_init=10,
-            random_state=self.config.random_state,
-        )
-        kmeans.fit(cosine_sim_matrix)
-        cluster_labels = kmeans.labels_
-        clusters = defaultdict(list)
+        if self.config.clustering == "cos_sim_kmeans":
+            cosine_sim_matrix = cosine_similarity(embeddings_array, embeddings_array)
 
-        for key, label in zip(expert_names, cluster_labels):
-            clusters[f"cluster_{label}"].append(key)
-        return clusters
+            kmeans = KMeans(
+                n_clusters=self.config.k,
+                init="k-means++",
+                n_init=self.config.n_init,
+                random_state=self.config.random_state,
+            )
+            kmeans.fit(cosine_sim_matrix)
+            assignments = dict(zip(expert_names, kmeans.labels_.tolist()))
+        elif self.config.clustering == "spherical":
+            embeddings = F.normalize(
+                torch.from_numpy(embeddings_array).float(), p=2, dim=1
+            )
+            state = None if recompute else self.fetch_clusters(library)
+            embeddings_by_name = dict(zip(expert_names, embeddings_array))
+            if state is not None and (
+                len(state["centroids"]) != self.config.k
+                or not set(state["assignments"]) <= set(expert_names)
+                or state.get("embeddings_hash")
+                != self.embeddings_hash(embeddings_by_name, state["assignments"])
+            ):
+                logger.info("Stored clusters are outdated, reclustering.")
+                state = None
+
+            if state is not None:
+                assignments = dict(state["assignments"])
+                new_idxs = [
+                    i for i, name in enumerate(expert_names) if name not in assignments
+                ]
+                logger.info(
+                    "Assigning {} new experts to {} existing clusters.".format(
+                        len(new_idxs), len(state["centroids"])
+                    )
+                )
+                if new_idxs:
+                    labels, _ = assign_to_centroids(
+                        embeddings[new_idxs], state["centroids"]
+                    )
+                    for i, label in zip(new_idxs, labels.tolist()):
+                        assignments[expert_names[i]] = label
+                centroids = state["centroids"]
+            else:
+                labels, centroids = spherical_kmeans(
+                    embeddings,
+                    self.config.k,
+                    n_init=self.config.n_init,
+                    max_iter=self.config.max_iter,
+                    random_state=self.config.random_state,
+                )
+                assignments = dict(zip(expert_names, labels.tolist()))
 
+            if persist:
+                library.add_auxiliary_data(
+                    data_type=self.clusters_name,
+                    expert_name="base_model",
+                    config=self.config.__dict__,
+                    data={
+                        "centroids": centroids,
+                        "assignments": assignments,
+                        "embeddings_hash": self.embeddings_hash(
+                            embeddings_by_name, assignments
+                        ),
+                    },
+                    force=True,  # make sure we overwrite
+                )
+        else:
+            raise ValueError(f"Unknown clustering method {self.config.clustering}")
+
+        clusters = defaultdict(list)
+        for key in expert_names:
+            clusters[f"cluster_{assignments[key]}"].append(key)
+        return clusters
@@ -11,7 +11,6 @@ from mttl.models.expert_model import ExpertModel, ExpertModelConfig
 from mttl.models.utils import model_loader_helper
 from mttl.models.library.merging_methods.utils import (
     load_mask,
-    convert_idx_2_mask,
     dict_to_config,
 )
 
@@ -154,18 +153,14 @@ class BaseMerge(LibraryTransform):
                 Mask = load_mask(expert)
                 # for each layer compute the "average of the overlapped weight"
                 for l in trainable_layers:
-                    # weight
-                    mask = convert_idx_2_mask(
-                        weight_idx=Mask["mask"][f"model.{l}.sparse_layer"],
-                        mat_dim=Mask["mask_shape"][f"model.{l}.sparse_layer"],
-                    )
-                    mask_idx = torch.where(mask.flatten() == 1)[0]
+                    # weight, the flat indices are decoded without building the dense mask
+                    mask_idx = Mask.indices(f"model.{l}.sparse_layer")
                     expert_dtype = expert.expert_weights[
                         f"{l}.sparse_layer.weight"
                     ].dtype
 
                     dense_weight = torch.zeros(
-                        Mask["mask_shape"][f"model.{l}.sparse_layer"],
+                        Mask.shape(f"model.{l}.sparse_layer"),
                         dtype=expert_dtype,
                     )
                     dense_weight.flatten().scatter_add_(
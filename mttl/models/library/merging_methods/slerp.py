@@ -10,6 +10,7 @@ from mttl.models.library.library_transforms import (
 )
 from mttl.models.expert_model import ExpertModel
 from mttl.models.library.expert import Expert
+from mttl.models.modifiers.sparse_mask import SparseMaskFile
 
 
 # -----------------------------------
@@ -83,26 +84,18 @@ class SLERPMerge(LibraryTransform):
             repo_id = ("/").join(f_name.split("/")[:2])
             filename = f"{expert.expert_info.expert_name}_mask.npz"
             f_path = hf_hub_download(repo_id=repo_id, filename=filename)
-            Mask = np.load(f_path, allow_pickle=True)["arr"].item()
+            Mask = SparseMaskFile(f_path)
         except:
             print("trying to load mask from local dir")
             m_loc = f"experiment/{expert.training_config.exp_name}/mask.npz"
-            Mask = np.load(m_loc, allow_pickle=True)["arr"].item()
+            Mask = SparseMaskFile(m_loc)
         return Mask
 
-    def convert_idx_2_mask(self, weight_idx, mat_dim):
-        m = np.zeros(mat_dim)
-        m[tuple(zip(*weight_idx))] = 1
-        return torch.FloatTensor(m)
-
     def sparse_SLERP(self, model, experts, base_expert):
-        base_expert_mask = self.load_mask(base_expert)
-        for layer, _ in base_expert_mask.items():
-            mod_layer = ".".join(layer.split(".")[1:])
-            base_expert_mask[layer] = self.convert_idx_2_mask(
-                weight_idx=base_expert_mask[layer],
-                mat_dim=base_expert.expert_weights[f"{mod_layer}.weight"].shape,
-            )
+        base_mask_file = self.load_mask(base_expert)
+        base_expert_mask = {
+            layer: base_mask_file[layer] for layer in base_mask_file.keys()
+        }
         weight_names = [n for n in model.state_dict().keys() if "sparse_layer" in n]
 
         for expert in experts:
@@ -114,13 +107,8 @@ class SLERPMerge(LibraryTransform):
                     param_type = layer.split(".")[-1]
 
                     if param_type == "weight":
-                        # get mask-m for layer-l: convert the weight_indx to convert sparse-mask
-                        m = self.convert_idx_2_mask(
-                            weight_idx=mask[f"model.{common_name}"],
-                            mat_dim=expert.expert_weights[
-                                f"{common_name}.weight"
-                            ].shape,
-                        )
+                        # get mask-m for layer-l, decoded from the mask file
+                        m = mask[f"model.{common_name}"]
                         bm = base_expert_mask[f"model.{common_name}"]
                     else:
                         m = 1.0
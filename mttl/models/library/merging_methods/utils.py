@@ -3,6 +3,8 @@ import numpy as np
 from huggingface_hub import hf_hub_download
 from types import SimpleNamespace
 
+from mttl.models.modifiers.sparse_mask import SparseMaskFile
+
 
 def dict_to_config(d):
     if isinstance(d, dict):
@@ -35,11 +37,11 @@ def load_mask(expert):
     if destination_type == "hf":
         print("loading mask from hf")
         f_path = hf_hub_download(repo_id=repo_id, filename=filename)
-        Mask = np.load(f_path, allow_pickle=True)["arr"].item()
+        Mask = SparseMaskFile(f_path)
     elif destination_type == "local":
         print("loading mask from local dir")
         m_loc = f"{repo_id}/{filename}"
-        Mask = np.load(m_loc, allow_pickle=True)["arr"].item()
+        Mask = SparseMaskFile(m_loc)
     else:
         raise ValueError(
             f"Unknown destination type {destination_type}. Only 'hf' and 'local' are supported."
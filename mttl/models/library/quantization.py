@@ -0,0 +1,153 @@
+from typing import Dict, Optional
+
+import torch
+
+# storage formats of the expert weights, recorded in the metadata of each expert
+STORAGE_DTYPES = ("fp32", "fp16", "bf16", "int8", "nf4")
+
+# quantiles of a standard normal rescaled to [-1, 1], the 4-bit data type of QLoRA
+NF4_LEVELS = torch.tensor(
+    [
+        -1.0,
+        -0.6961928009986877,
+        -0.5250730514526367,
+        -0.39491748809814453,
+        -0.28444138169288635,
+        -0.18477343022823334,
+        -0.09105003625154495,
+        0.0,
+        0.07958029955625534,
+        0.16093020141124725,
+        0.24611230194568634,
+        0.33791524171829224,
+        0.44070982933044434,
+        0.5626170039176941,
+        0.7229568362236023,
+        1.0,
+    ]
+)
+NF4_BLOCK_SIZE = 64
+
+
+def check_storage_dtype(storage_dtype):
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError(
+            f"Unknown storage dtype {storage_dtype}, choose one of {STORAGE_DTYPES}."
+        )
+
+
+def _quantize_int8(tensor):
+    """Symmetric int8 quantization, with one scale per output channel (first dimension)."""
+    rows = tensor.reshape(tensor.shape[0] if tensor.dim() > 1 else 1, -1)
+    scale = rows.abs().amax(dim=1, keepdim=True) / 127.0
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    data = torch.round(rows / scale).clamp(-127, 127).to(torch.int8)
+    return {"data": data, "scale": scale}
+
+
+def _dequantize_int8(payload):
+    return payload["data"].float() * payload["scale"]
+
+
+def _quantize_nf4(tensor):
+    """Blockwise 4-bit quantization on the NF4 levels, two values packed per byte."""
+    flat = tensor.reshape(-1)
+    pad = -flat.numel() % NF4_BLOCK_SIZE
+    blocks = torch.nn.functional.pad(flat, (0, pad)).reshape(-1, NF4_BLOCK_SIZE)
+
+    scale = blocks.abs().amax(dim=1, keepdim=True)
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    levels = NF4_LEVELS.to(tensor.device)
+    # nearest level, from the midpoints between consecutive levels
+    index = torch.bucketize(
+        (blocks / scale).reshape(-1), (levels[1:] + levels[:-1]) / 2
+    )
+    index = index.to(torch.uint8).reshape(-1, 2)
+    return {"data": index[:, 0] << 4 | index[:, 1], "scale": scale}
+
+
+def _dequantize_nf4(payload, numel):
+    data = payload["data"]
+    index = torch.stack([data >> 4, data & 15], dim=1).reshape(-1).long()
+    levels = NF4_LEVELS.to(data.device)
+    values = levels[index].reshape(-1, NF4_BLOCK_SIZE) * payload["scale"]
+    return values.reshape(-1)[:numel]
+
+
+def quantize_weights(
+    weights: Dict[str, torch.Tensor], storage_dtype: Optional[str]
+) -> Dict:
+    """Converts a state dict of expert weights to the given storage format.
+
+    Non floating point tensors are stored as they are. The result only holds tensors, strings
+    and lists, so it can be read back with `torch.load(..., weights_only=True)`.
+    """
+    if (
+        storage_dtype is None
+        or storage_dtype == "fp32"
+        or not isinstance(weights, dict)
+    ):
+        return weights
+
+    check_storage_dtype(storage_dtype)
+
+    payload = {}
+    for name, tensor in weights.items():
+        if not torch.is_floating_point(tensor):
+            payload[name] = {"data": tensor}
+            continue
+
+        tensor = tensor.detach().float()
+        if storage_dtype == "fp16":
+            entry = {"data": tensor.half()}
+        elif storage_dtype == "bf16":
+            entry = {"data": tensor.bfloat16()}
+        elif storage_dtype == "int8":
+            entry = _quantize_int8(tensor)
+        else:
+            entry = _quantize_nf4(tensor)
+
+        entry["shape"] = list(tensor.shape)
+        payload[name] = entry
+    return payload
+
+
+def dequantize_weights(
+    payload: Dict,
+    storage_dtype: Optional[str],
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+) -> Dict[str, torch.Tensor]:
+    """Inverse of `quantize_weights`.
+
+    The stored tensors are moved to `device` before being dequantized, so that only the
+    compressed weights go through the host to device copy.
+    """
+    if (
+        storage_dtype is None
+        or storage_dtype == "fp32"
+        or not isinstance(payload, dict)
+    ):
+        if device == "cpu" or not isinstance(payload, dict):
+            return payload
+        return {name: tensor.to(device) for name, tensor in payload.items()}
+
+    check_storage_dtype(storage_dtype)
+
+    weights = {}
+    for name, entry in payload.items():
+        entry = {k: v.to(device) if torch.is_tensor(v) else v for k, v in entry.items()}
+        if "shape" not in entry:
+            # non floating point tensor
+            weights[name] = entry["data"]
+            continue
+
+        shape = torch.Size(entry["shape"])
+        if storage_dtype in ("fp16", "bf16"):
+            tensor = entry["data"]
+        elif storage_dtype == "int8":
+            tensor = _dequantize_int8(entry)
+        else:
+            tensor = _dequantize_nf4(entry, shape.numel())
+        weights[name] = tensor.reshape(shape).to(dtype)
+    return weights
@@ -2,7 +2,9 @@ import copy
 import os
 import shutil
 import sys
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import pytorch_lightning as pl
 import torch
@@ -17,9 +19,14 @@ from transformers.utils import ModelOutput
 
 from mttl.datamodule.base import DataModule
 from mttl.evaluators import MMLUEvaluator
-from mttl.evaluators.base import EvaluatorRunner, setup_evaluators
+from mttl.evaluators.base import EvaluatorRunner, KeptBatches, setup_evaluators
 from mttl.evaluators.evaluators import Evaluator
 from mttl.logging import logger
+from mttl.models.chunked_loss import LossAccumulator, compute_loss_sums
+from mttl.models.lightning.checkpoint_writer import (
+    AsyncCheckpointWriter,
+    snapshot_trainable_checkpoint,
+)
 from mttl.models.modifiers.sparse_mask import (
     make_sparse_model_during_training,
     save_mask,
@@ -106,8 +113,18 @@ class UpdateSparseMask(pl.Callback):
         save_mask(pl_module, f_name)
 
 
+def use_async_checkpoint(writer, trainer):
+    # sharded and multi-process checkpoints are left to the trainer
+    return writer is not None and trainer.world_size == 1
+
+
 class LiveCheckpointCallback(pl.Callback):
-    """A better model checkpoint callback, that works in synchrony with LiveLogMixin."""
+    """A better model checkpoint callback, that works in synchrony with LiveLogMixin.
+
+    With `trainable_only`, checkpoints only hold the trainable parameters, and their optimizer
+    state unless `save_weights_only`, and are written in a background thread. The `keep_best_k`
+    best checkpoints are then kept, instead of the best one only.
+    """
 
     def __init__(
         self,
@@ -117,6 +134,8 @@ class LiveCheckpointCallback(pl.Callback):
         save_last: bool = True,
         save_weights_only: bool = True,
         save_each_epoch: bool = False,
+        trainable_only: bool = False,
+        keep_best_k: int = 1,
     ):
         if not monitor and not save_last:
             raise ValueError(
@@ -133,16 +152,31 @@ class LiveCheckpointCallback(pl.Callback):
         self._last_value = None
         self.save_weights_only = save_weights_only
         self.save_each_epoch = save_each_epoch
+        self._writer = (
+            AsyncCheckpointWriter(keep_best_k=keep_best_k, mode=mode)
+            if trainable_only
+            else None
+        )
 
-    def _store_checkpoint(self, trainer, checkpoint_path):
+    def _store_checkpoint(self, trainer, checkpoint_path, score=None):
         """Saves the checkpoint and pushes to the ExpertLibrary if one is available."""
-        trainer.save_checkpoint(checkpoint_path, weights_only=self.save_weights_only)
+        if use_async_checkpoint(self._writer, trainer):
+            checkpoint = snapshot_trainable_checkpoint(
+                trainer.lightning_module, trainer, self.save_weights_only
+            )
+            self._writer.save(checkpoint, checkpoint_path, score=score)
+        else:
+            trainer.save_checkpoint(
+                checkpoint_path, weights_only=self.save_weights_only
+            )
 
     def on_train_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
         """Saves the last checkpoint."""
         if self.save_last:
             self.last_model_path = os.path.join(f"{self.dirpath}", "last.ckpt")
             self._store_checkpoint(trainer, self.last_model_path)
+        if self._writer is not None:
+            self._writer.wait()
 
     def on_train_epoch_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
         """Saves each checkpoint after each epoch"""
@@ -168,14 +202,15 @@ class LiveCheckpointCallback(pl.Callback):
         monitor = self.monitor.replace("/", "-")
         monitor = monitor.replace("_", "-")
 
-        self._maybe_delete_best_path()
+        if not use_async_checkpoint(self._writer, trainer):
+            self._maybe_delete_best_path()
         this_filename = os.path.join(
             f"{self.dirpath}",
             f"best_mode_{self.mode}_metric_{monitor}_value_{this_value:.004f}_step_{self._last_step}.ckpt",
         )
 
         logger.info("Saving new best model to %s", this_filename)
-        self._store_checkpoint(trainer, this_filename)
+        self._store_checkpoint(trainer, this_filename, score=this_value)
         self.best_model_path = this_filename
 
     def on_log(self, trainer, pl_module, metric_name, metric_value, **kwargs):
@@ -228,7 +263,46 @@ class LiveCheckpointCallback(pl.Callback):
             self._last_value = metric_value
 
 
-class LossCallback(cb.Callback):
+class EvalOverheadMixin:
+    """Measures the time spent in the evaluations of a callback during training, as a fraction
+    of the time spent training."""
+
+    _train_start = None
+    _eval_seconds = 0.0
+
+    def on_train_start(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        self._train_start = time.perf_counter()
+        self._eval_seconds = 0.0
+
+    @contextmanager
+    def timed_evaluation(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._eval_seconds += time.perf_counter() - start
+
+    @property
+    def eval_overhead(self):
+        if self._train_start is None:
+            return None
+        elapsed = time.perf_counter() - self._train_start
+        return self._eval_seconds / max(elapsed - self._eval_seconds, 1e-6)
+
+
+class LossCallback(EvalOverheadMixin, cb.Callback):
+    """Logs the loss on a dataloader every `eval_every_opt_step` optimizer steps.
+
+    With `keep_batches`, the batches are collated once, at the first evaluation, and reused by
+    the following ones. With `time_budget`, every evaluation uses the number of batches that
+    the first one ran in `time_budget` seconds, which are the same batches with `keep_batches`
+    or a dataloader without shuffling.
+
+    With `loss_only`, the loss is computed `chunk_size` tokens at a time, without the logits of
+    the whole batch, and is the mean over examples of their mean token loss, whatever the sizes
+    of the batches. The mean over tokens is logged too.
+    """
+
     def __init__(
         self,
         dataloader,
@@ -236,17 +310,31 @@ class LossCallback(cb.Callback):
         name="test",
         eval_every_opt_step=1,
         checkpoint_oracle=True,
+        keep_batches=False,
+        time_budget=None,
+        trainable_only=False,
+        loss_only=False,
+        chunk_size=1024,
     ):
         self.name = name
         self.output_dir = output_dir
         self.dataloader = dataloader
         self.eval_every_opt_step = eval_every_opt_step
+        self.keep_batches = keep_batches
+        self.time_budget = time_budget
+        self.loss_only = loss_only
+        self.chunk_size = chunk_size
+        self.token_loss = None
+        self._kept_batches = None
         # save best perf
         self._best_loss = None
         # checkpointing
         self.do_checkpoint = checkpoint_oracle
         self._checkpoint_now = False
         self._prev_checkpoint = None
+        self._writer = (
+            AsyncCheckpointWriter(keep_best_k=1, mode="min") if trainable_only else None
+        )
 
     @property
     def last_model_path(self):
@@ -278,7 +366,8 @@ class LossCallback(cb.Callback):
         self, trainer: Trainer, pl_module: LightningModule, optimizer: Optimizer
     ) -> None:
         if trainer.global_step % self.eval_every_opt_step == 0:
-            metrics = self.test(pl_module)
+            with self.timed_evaluation():
+                metrics = self.test(pl_module)
             self.best_loss = copy.deepcopy(metrics)
             self.maybe_checkpoint_now(trainer)
             self.log_metrics(metrics, pl_module)
@@ -294,31 +383,60 @@ class LossCallback(cb.Callback):
                     self.output_dir + f"{self.name}/" + f"{self.best_loss:.004f}.ckpt"
                 )
                 ckpt_path = os.path.join(dir_name, filename)
-                trainer.save_checkpoint(ckpt_path)
-                if (
-                    self._prev_checkpoint is not None
-                    and ckpt_path != self._prev_checkpoint
-                ):
-                    os.remove(self._prev_checkpoint)
+                if use_async_checkpoint(self._writer, trainer):
+                    checkpoint = snapshot_trainable_checkpoint(
+                        trainer.lightning_module, trainer, save_weights_only=False
+                    )
+                    self._writer.save(checkpoint, ckpt_path, score=self.best_loss)
+                else:
+                    trainer.save_checkpoint(ckpt_path)
+                    if (
+                        self._prev_checkpoint is not None
+                        and ckpt_path != self._prev_checkpoint
+                    ):
+                        os.remove(self._prev_checkpoint)
                 self._prev_checkpoint = ckpt_path
             except Exception as e:
                 logger.error(e)
         self._checkpoint_now = False
 
+    def on_train_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        if self._writer is not None:
+            self._writer.wait()
+
+    @property
+    def batches(self):
+        if not self.keep_batches and self.time_budget is None:
+            return self.dataloader
+        if self._kept_batches is None:
+            self._kept_batches = KeptBatches(
+                list(self.dataloader) if self.keep_batches else self.dataloader
+            )
+        self._kept_batches.time_budget = self.time_budget
+        return self._kept_batches
+
     def test(self, pl_module: LightningModule):
         outputs = []
         was_train = pl_module.training
         if was_train:
             pl_module.eval()
 
+        batches = self.batches
         total_loss, deno = 0.0, 0.0
+        accumulator = LossAccumulator()
         with torch.no_grad():
             for i, batch in tqdm(
-                enumerate(self.dataloader),
-                total=len(self.dataloader),
+                enumerate(batches),
+                total=len(batches),
                 desc=f"Test {self.name}",
             ):
                 batch = transfer_batch_to_device(batch, pl_module.device)
+                if self.loss_only:
+                    accumulator.update(
+                        *compute_loss_sums(pl_module, batch, self.chunk_size)
+                    )
+                    continue
+
                 loss = pl_module.forward(**batch, reduction="none")
 
                 if isinstance(loss, ModelOutput):
@@ -330,6 +448,9 @@ class LossCallback(cb.Callback):
         if was_train:
             pl_module.train()
 
+        if self.loss_only:
+            self.token_loss = accumulator.token_loss
+            return accumulator.example_loss
         return total_loss / deno
 
     def log_metrics(self, metrics, pl_module: pl.LightningModule, on_step=True):
@@ -338,6 +459,18 @@ class LossCallback(cb.Callback):
             metrics,
             on_step=on_step,
         )
+        if self.token_loss is not None:
+            pl_module.log(
+                f"downstream/{self.name}_token_loss",
+                self.token_loss,
+                on_step=on_step,
+            )
+        if self.eval_overhead is not None:
+            pl_module.log(
+                f"downstream/{self.name}_eval_overhead",
+                self.eval_overhead,
+                on_step=on_step,
+            )
 
 
 class RougeCallback(cb.Callback):
@@ -423,13 +556,22 @@ class NanoMMLUCallback(cb.Callback):
         pl_module.log("test/mmlu", em, on_epoch=True, prog_bar=True)
 
 
-class MMLUCallback(cb.Callback):
+class MMLUCallback(EvalOverheadMixin, cb.Callback):
+    """Evaluates MMLU every `eval_every_opt_step` optimizer steps.
+
+    The evaluator, and the batches of its fixed `subsample`, are built at the first evaluation
+    and reused by the following ones. With `time_budget`, every evaluation uses the batches
+    that the first one ran in `time_budget` seconds.
+    """
+
     def __init__(
         self,
         eval_every_opt_step=1,
         split="test",
         max_input_length=None,
         checkpoint_oracle=True,
+        subsample=-1,
+        time_budget=None,
     ):
         super().__init__()
 
@@ -437,6 +579,8 @@ class MMLUCallback(cb.Callback):
         self.max_input_length = max_input_length
         self.evaluator = None
         self.split = split
+        self.subsample = subsample
+        self.time_budget = time_budget
         # save best perf
         self._best_perf = None
         # checkpointing
@@ -470,7 +614,8 @@ class MMLUCallback(cb.Callback):
         self, trainer: Trainer, pl_module: LightningModule, optimizer: Optimizer
     ) -> None:
         if trainer.global_step % self.eval_every_opt_step == 0:
-            metrics = self.eval_mmlu(pl_module)
+            with self.timed_evaluation():
+                metrics = self.eval_mmlu(pl_module)
             self.best_perf = copy.deepcopy(metrics)
             self.maybe_checkpoint_now(trainer)
             self.log_metrics(metrics, pl_module)
@@ -512,6 +657,12 @@ class MMLUCallback(cb.Callback):
                 v["mean"],
                 on_step=on_step,
             )
+        if self.eval_overhead is not None:
+            pl_module.log(
+                f"downstream/{self.split}/mmlu_eval_overhead",
+                self.eval_overhead,
+                on_step=on_step,
+            )
 
     def eval_mmlu(self, pl_module):
         from mttl.datamodule.mmlu_data_module import MMLUDataConfig
@@ -538,38 +689,11 @@ class MMLUCallback(cb.Callback):
                 config=mmlu_data_config,
             )
 
-        metrics = self.evaluator.evaluate(pl_module, split=self.split)
-        return metrics
-
-    def on_after_backward(self, *args, **kwargs):
-        self.val_epoch += 1
-
-        trainer, pl_module = args
-
-        if trainer.global_step < 1:
-            return
-
-        if self.val_epoch % self.every_val_epochs != 0:
-            return
-
-        from mttl.evaluators import MMLUEvaluator
-
-        evaluator = MMLUEvaluator(
-            pl_module.hparams,
-            **self.eval_kwargs,
-        )
-        metrics = evaluator.evaluate(
-            pl_module,
-            split=self.split,
-            subsample=10,
-        )
-        pl_module.log(
-            "val/mmlu",
-            metrics["all"]["mean"],
-            on_step=False,
-            on_epoch=True,
-            prog_bar=True,
+        self.evaluator.keep_batches(
+            self.split, self.subsample, time_budget=self.time_budget
         )
+        self.evaluator.evaluate(pl_module, split=self.split, subsample=self.subsample)
+        return self.evaluator.last_metrics
 
 
 class NICallback(cb.Callback):
@@ -690,6 +814,7 @@ class MMLUEvalCallback(MMLUEvaluator, EvalCallback):
         split="test",
         subsample=-1,
         use_vllm=False,
+        keep_vllm_engine=False,
     ):
         self.split = split
         from mttl.datamodule.mmlu_data_module import MMLUDataConfig
@@ -703,7 +828,9 @@ class MMLUEvalCallback(MMLUEvaluator, EvalCallback):
                 if k in MMLUDataConfig.__dataclass_fields__.keys()
             }
         )
-        super().__init__(mmlu_config, use_vllm=use_vllm)
+        super().__init__(
+            mmlu_config, use_vllm=use_vllm, keep_vllm_engine=keep_vllm_engine
+        )
         self.subsample = subsample
         self.name = name
 
@@ -0,0 +1,114 @@
+"""Checkpoints of the trainable parameters of a module, written in a background thread.
+
+`snapshot_trainable_checkpoint` copies to CPU the parameters that `_delete_non_trainable_params`
+keeps, and optionally the optimizer state, which only covers trainable parameters. Training then
+resumes while `AsyncCheckpointWriter` writes the snapshot. Checkpoints keep the `state_dict` and
+`hyper_parameters` entries of Lightning checkpoints, so `load_expert` reads them as before.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+import torch
+
+from mttl.logging import logger
+
+
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def snapshot_trainable_checkpoint(pl_module, trainer=None, save_weights_only=True):
+    """Returns a checkpoint of the trainable parameters of `pl_module`, copied to CPU.
+
+    Unless `save_weights_only`, the states of the optimizers and schedulers of `trainer` are
+    included too.
+    """
+    state_dict = pl_module.state_dict()
+    if hasattr(pl_module, "_delete_non_trainable_params"):
+        pl_module._delete_non_trainable_params(state_dict)
+    else:
+        trainable = {n for n, p in pl_module.named_parameters() if p.requires_grad}
+        state_dict = {k: v for k, v in state_dict.items() if k in trainable}
+
+    checkpoint = {
+        "state_dict": state_dict,
+        "hyper_parameters": {
+            k: v.name if isinstance(v, Enum) else v
+            for k, v in getattr(pl_module, "hparams", {}).items()
+        },
+    }
+    # e.g. the expert info of expert modules
+    if hasattr(pl_module, "on_save_checkpoint"):
+        pl_module.on_save_checkpoint(checkpoint)
+    checkpoint["state_dict"] = _to_cpu(checkpoint["state_dict"])
+
+    if trainer is not None:
+        checkpoint["epoch"] = trainer.current_epoch
+        checkpoint["global_step"] = trainer.global_step
+        if not save_weights_only:
+            checkpoint["optimizer_states"] = [
+                _to_cpu(optimizer.state_dict()) for optimizer in trainer.optimizers
+            ]
+            checkpoint["lr_schedulers"] = [
+                config.scheduler.state_dict() for config in trainer.lr_scheduler_configs
+            ]
+    return checkpoint
+
+
+class AsyncCheckpointWriter:
+    """Writes checkpoints in a background thread, one at a time and in order.
+
+    Each checkpoint is written to a temporary file which is then renamed, so that a checkpoint
+    path never holds a partial file. Among the checkpoints saved with a `score`, only the
+    `keep_best_k` best ones, according to `mode`, are kept on disk, if `keep_best_k` is given.
+    """
+
+    def __init__(self, keep_best_k=None, mode="min"):
+        self.keep_best_k = keep_best_k
+        self.mode = mode
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+        self._scored = []
+
+    def save(self, checkpoint, path, score=None):
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(
+            self._executor.submit(self._write, checkpoint, path, score)
+        )
+
+    def _write(self, checkpoint, path, score):
+        try:
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            tmp_path = path + ".tmp"
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Failed to write checkpoint {path}: {e}")
+            return
+
+        if score is None or self.keep_best_k is None:
+            return
+
+        self._scored = [(s, p) for s, p in self._scored if p != path]
+        self._scored.append((float(score), path))
+        self._scored.sort(key=lambda x: x[0], reverse=self.mode == "max")
+        for _, stale_path in self._scored[self.keep_best_k :]:
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        self._scored = self._scored[: self.keep_best_k]
+
+    def wait(self):
+        """Blocks until every checkpoint submitted so far is written."""
+        for future in self._futures:
+            future.result()
+        self._futures = []
@@ -6,6 +6,7 @@ import torch
 from transformers import PreTrainedModel
 
 from mttl.arguments import ExpertConfig, MoEExpertConfig, MultiExpertConfig
+from mttl.models.chunked_loss import compute_chunked_loss
 from mttl.models.containers.selectors.base import AutoSelectorConfig
 from mttl.models.expert_model import (
     ExpertModel,
@@ -52,8 +53,12 @@ class LightningTrainingMixin:
         return self.model.generate(**kwargs)
 
     def training_step(self, batch, _):
-        outputs = self.forward(**batch)
-        loss = outputs.loss
+        loss_chunk_size = getattr(self.hparams, "loss_chunk_size", None)
+        if loss_chunk_size:
+            loss = compute_chunked_loss(self, batch, loss_chunk_size)
+        else:
+            outputs = self.forward(**batch)
+            loss = outputs.loss
         total_loss = loss
 
         self.log(f"{self._log_pref}train/loss", loss, on_step=True, prog_bar=True)
@@ -1,7 +1,18 @@
+from collections import defaultdict
+
 import torch
 from torch import nn
 
 
+def stack_by_shape(tensors):
+    """Stacks tensors of the same shape, dtype and device, so that losses over many adapters or
+    selectors are computed in a few batched ops. Returns the stacked tensors."""
+    groups = defaultdict(list)
+    for tensor in tensors:
+        groups[(tensor.shape, tensor.dtype, tensor.device)].append(tensor)
+    return [torch.stack(group) for group in groups.values()]
+
+
 class TaskPredictionPlugin(nn.Module):
     name = "task_pred"
 
@@ -20,17 +31,20 @@ class TaskPredictionPlugin(nn.Module):
 
     def compute_loss(self, model, batch, **kwargs):
         # tasks have already been propagated
-        num = 0.0
-        loss = 0.0
+        selectors = model.get_selectors().values()
+        task_ids = batch["task_ids"]
 
-        for _, selector in model.get_selectors().items():
-            logits = torch.sigmoid(selector.module_logits[batch["task_ids"]])
+        loss = 0.0
+        for module_logits in stack_by_shape(s.module_logits for s in selectors):
+            logits = torch.sigmoid(module_logits[:, task_ids])
             if self.detach:
                 logits = logits.detach()
             logits = self.predictor(logits)
-            loss += self.loss_fn(logits, batch["task_ids"])
-            num += 1.0
-        return loss / num
+            # the mean over selectors and examples is the mean of the per-selector losses
+            loss += self.loss_fn(
+                logits.flatten(0, 1), task_ids.repeat(logits.size(0))
+            ) * logits.size(0)
+        return loss / len(selectors)
 
 
 class ModuleSparsityPlugin(nn.Module):
@@ -43,15 +57,19 @@ class ModuleSparsityPlugin(nn.Module):
 
     def compute_loss(self, model, batch, **kwargs):
         # tasks have already been propagated
-        num = 0.0
+        selectors = model.get_selectors().values()
+
         loss = 0.0
-        for _, selector in model.get_selectors().items():
-            probs = torch.sigmoid(selector.module_logits[batch["task_ids"]])
-            loss += torch.nn.functional.relu(
-                probs.abs().mean(-1) - (self.num_free_bits / probs.size(-1))
-            ).mean()
-            num += 1.0
-        return loss / num
+        for module_logits in stack_by_shape(s.module_logits for s in selectors):
+            probs = torch.sigmoid(module_logits[:, batch["task_ids"]])
+            loss += (
+                torch.nn.functional.relu(
+                    probs.abs().mean(-1) - (self.num_free_bits / probs.size(-1))
+                )
+                .mean(-1)
+                .sum()
+            )
+        return loss / len(selectors)
 
 
 class OrthoRegularizationPlugin(nn.Module):
@@ -60,26 +78,40 @@ class OrthoRegularizationPlugin(nn.Module):
     @staticmethod
     def orthogonal_loss_fn(param):
         type, param = param
+        return OrthoRegularizationPlugin.batched_orthogonal_loss_fn(
+            type, param.unsqueeze(0)
+        )[0]
+
+    @staticmethod
+    def batched_orthogonal_loss_fn(type, params):
+        """Orthogonality losses of `params`, parameters of the same type and shape stacked along
+        the first dimension. Returns one loss per parameter."""
         if type == "a":
-            if len(param.shape) == 4:
-                s, k, d, r = param.shape
-                normed = nn.functional.normalize(param, p=2, dim=2)
-                cosine_sim = torch.einsum("s i d r, s j d r -> s i j r", normed, normed)
+            if len(params.shape) == 5:
+                n, s, k, d, r = params.shape
+                normed = nn.functional.normalize(params, p=2, dim=3)
+                cosine_sim = torch.einsum(
+                    "n s i d r, n s j d r -> n s i j r", normed, normed
+                )
             else:
-                s, k, d = param.shape
-                normed = nn.functional.normalize(param, p=2, dim=2)
+                n, s, k, d = params.shape
+                normed = nn.functional.normalize(params, p=2, dim=3)
                 if k == 1:
-                    normed = normed.view(s, d)
-                    cosine_sim = torch.einsum("i d, j d -> i j", normed, normed)
-                    return (cosine_sim**2).sum() / (s**2) - (1 / s)
+                    normed = normed.view(n, s, d)
+                    cosine_sim = torch.einsum("n i d, n j d -> n i j", normed, normed)
+                    return (cosine_sim**2).sum((1, 2)) / (s**2) - (1 / s)
                 else:
-                    cosine_sim = torch.einsum("i k d, j k d -> k i j", normed, normed)
-                    return (cosine_sim**2).sum() / (k * s**2) - (1 / s)
+                    cosine_sim = torch.einsum(
+                        "n i k d, n j k d -> n k i j", normed, normed
+                    )
+                    return (cosine_sim**2).sum((1, 2, 3)) / (k * s**2) - (1 / s)
         elif type == "b":
-            s, k, r, d = param.shape
-            normed = nn.functional.normalize(param, p=2, dim=-1)
-            cosine_sim = torch.einsum("s i r d, s j r d -> s i j r", normed, normed)
-        return (cosine_sim**2).sum() / (s * r * k**2) - (1 / k)
+            n, s, k, r, d = params.shape
+            normed = nn.functional.normalize(params, p=2, dim=-1)
+            cosine_sim = torch.einsum(
+                "n s i r d, n s j r d -> n s i j r", normed, normed
+            )
+        return (cosine_sim**2).sum((1, 2, 3, 4)) / (s * r * k**2) - (1 / k)
 
     def __init__(self, model, factor=1.0):
         super().__init__()
@@ -96,6 +128,7 @@ class OrthoRegularizationPlugin(nn.Module):
 
     def compute_loss(self, *args, **kwargs):
         loss = 0.0
-        for param in self.params:
-            loss += self.orthogonal_loss_fn(param)
+        for type in ["a", "b"]:
+            for params in stack_by_shape(p for t, p in self.params if t == type):
+                loss += self.batched_orthogonal_loss_fn(type, params).sum()
         return loss / len(self.params)
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import torch
@@ -14,6 +15,10 @@ class HardPromptConfig:
 
 @Modifier.register("hard_prompt", config_cls=HardPromptConfig)
 class HardPrompt(Modifier):
+    # padded prompt ids for the most recent prompt combinations
+    _padded_prompts_cache = OrderedDict()
+    _padded_prompts_cache_size = 128
+
     def __init__(self, config, prompt_init=None):
         if config.model_family is None or config.tokenizer is None:
             raise ValueError(
@@ -24,103 +29,120 @@ class HardPrompt(Modifier):
         self.prompt = prompt_init
         self.model_family = config.model_family
         self.tokenizer = config.tokenizer
+        # token ids of the prompt, indexed by (prompt, device)
+        self._prompt_ids = {}
+
+    def prompt_ids(self, device) -> torch.Tensor:
+        """Returns the token ids of the prompt, tokenized once per device."""
+        key = (self.prompt, device)
+        if key not in self._prompt_ids:
+            # add a \n separator to be safe :-), doesn't mess w. gpt2 tokenizer!
+            input_ids = self.tokenizer(self.prompt + "\n", return_tensors="pt")[
+                "input_ids"
+            ][0]
+            self._prompt_ids[key] = input_ids.to(device)
+        return self._prompt_ids[key]
+
+    @classmethod
+    def _padded_prompts(cls, prompts, device):
+        """Pads the token ids of the prompts of the batch, cached per prompt combination."""
+        tokenizer = prompts[0].tokenizer
+        key = (
+            tuple(p.prompt for p in prompts),
+            # the same prompts are tokenized differently by different tokenizers
+            id(tokenizer),
+            tokenizer.name_or_path,
+            len(tokenizer),
+            tokenizer.padding_side,
+            tokenizer.pad_token_id,
+            device,
+        )
+
+        if key in cls._padded_prompts_cache:
+            cls._padded_prompts_cache.move_to_end(key)
+            return cls._padded_prompts_cache[key]
+
+        prompt_ids = [p.prompt_ids(device) for p in prompts]
+        lengths = torch.tensor([len(ids) for ids in prompt_ids], device=device)
+        positions = torch.arange(int(lengths.max()), device=device)
+
+        if tokenizer.padding_side == "left":
+            prompt_mask = positions[None] >= (len(positions) - lengths)[:, None]
+        else:
+            prompt_mask = positions[None] < lengths[:, None]
+
+        padded_ids = torch.full(
+            prompt_mask.shape,
+            tokenizer.pad_token_id,
+            dtype=prompt_ids[0].dtype,
+            device=device,
+        )
+        padded_ids[prompt_mask] = torch.cat(prompt_ids)
+
+        cls._padded_prompts_cache[key] = (padded_ids, prompt_mask.long(), lengths)
+        if len(cls._padded_prompts_cache) > cls._padded_prompts_cache_size:
+            cls._padded_prompts_cache.popitem(last=False)
+        return cls._padded_prompts_cache[key]
 
     @classmethod
     def parallel_forward(
         cls, prompts, input_ids, attention_mask, labels=None, **kwargs
     ):
-        # assume left padding
-        def roll_along(arr, shifts, dim):
-            assert arr.ndim - 1 == shifts.ndim
-            dim %= arr.ndim
-            shape = (1,) * dim + (-1,) + (1,) * (arr.ndim - dim - 1)
-            dim_indices = torch.arange(arr.shape[dim]).reshape(shape).to(arr.device)
-            indices = (dim_indices - shifts.unsqueeze(dim)) % arr.shape[dim]
-            return torch.gather(arr, dim, indices)
-
         padding_side = prompts[0].tokenizer.padding_side
-        shifts = attention_mask.sum(1)
-
-        # add a \n separator to be safe :-), doesn't mess w. gpt2 tokenizer!
-        prompt_weights = [p.prompt + "\n" for p in prompts]
-        eps = prompts[0].tokenizer(
-            prompt_weights,
-            return_tensors="pt",
-            padding=True,
-        )
-        # move it to GPU
-        eps["input_ids"] = eps["input_ids"].to(input_ids.device)
-        eps["attention_mask"] = eps["attention_mask"].to(input_ids.device)
+        max_input_length = prompts[0].config.max_input_length
 
-        prompt_shifts = eps["attention_mask"].sum(1)
+        prompt_ids, prompt_mask, prompt_lengths = cls._padded_prompts(
+            prompts, input_ids.device
+        )
         modify_labels = labels is not None and prompts[0].model_family == "gpt"
 
-        if padding_side == "left":
-            # if padding side is left then we move the padding to the right here, so that we can prepend the prompt safely
-            input_ids = roll_along(input_ids, shifts, 1)
-            attention_mask = roll_along(attention_mask, shifts, 1)
-            if modify_labels:
-                labels = roll_along(labels, shifts, 1)
-
-        elif padding_side == "right":
-            # if padding side of tokenizer is right, then we move the padding to the left here
-            eps["input_ids"] = roll_along(eps["input_ids"], prompt_shifts, 1)
-            eps["attention_mask"] = roll_along(eps["attention_mask"], prompt_shifts, 1)
-
-        input_ids_with_prompts = torch.cat((eps["input_ids"], input_ids), dim=1)
-        attn_mask_with_prompts = torch.cat(
-            (eps["attention_mask"], attention_mask), dim=1
-        )
-        if modify_labels:
-            labels_empty = torch.zeros_like(eps["input_ids"]).fill_(-100)
-            labels_with_prompts = torch.cat((labels_empty, labels), dim=1)
+        # each example is the concatenation of its padded prompt and its padded input,
+        # we compute where each position of the output is read from in this sequence
+        n_prompt, n_input = prompt_ids.shape[1], input_ids.shape[1]
+        lengths = attention_mask.sum(1, keepdim=True)
+        prompt_lengths = prompt_lengths[:, None]
+        positions = torch.arange(n_prompt + n_input, device=input_ids.device)[None]
 
-        # roll back
         if padding_side == "left":
-            reset_shifts = attention_mask.shape[1] - shifts
-            input_ids_with_prompts = roll_along(input_ids_with_prompts, reset_shifts, 1)
-            attn_mask_with_prompts = roll_along(attn_mask_with_prompts, reset_shifts, 1)
-
-            # now we know that all the padding is on the left, cut to max input length
-            input_ids_with_prompts = input_ids_with_prompts[
-                :, -prompts[0].config.max_input_length :
-            ]
-            attn_mask_with_prompts = attn_mask_with_prompts[
-                :, -prompts[0].config.max_input_length :
-            ]
-            if modify_labels:
-                labels_with_prompts = roll_along(labels_with_prompts, reset_shifts, 1)
-                labels_with_prompts = labels_with_prompts[
-                    :, -prompts[0].config.max_input_length :
-                ]
-        else:
-            reset_shifts = eps["attention_mask"].shape[1] - prompt_shifts
-            input_ids_with_prompts = roll_along(
-                input_ids_with_prompts,
-                -reset_shifts,
-                1,
+            # all the padding goes to the left: input padding, prompt padding, prompt, input
+            n_input_padding = n_input - lengths
+            index = torch.where(
+                positions < n_input_padding,
+                positions + n_prompt,
+                torch.where(
+                    positions < n_input_padding + n_prompt,
+                    positions - n_input_padding,
+                    positions,
+                ),
             )
-            attn_mask_with_prompts = roll_along(
-                attn_mask_with_prompts,
-                -reset_shifts,
-                1,
+        else:
+            # all the padding goes to the right: prompt, input, input padding, prompt padding
+            index = torch.where(
+                positions < prompt_lengths,
+                positions,
+                torch.where(
+                    positions < prompt_lengths + n_input,
+                    positions - prompt_lengths + n_prompt,
+                    positions - n_input,
+                ),
             )
 
-            input_ids_with_prompts = input_ids_with_prompts[
-                :, : prompts[0].config.max_input_length
-            ]
-            attn_mask_with_prompts = attn_mask_with_prompts[
-                :, : prompts[0].config.max_input_length
-            ]
-            if modify_labels:
-                labels_with_prompts = roll_along(labels_with_prompts, -reset_shifts, 1)
-                labels_with_prompts = labels_with_prompts[
-                    :, : prompts[0].config.max_input_length
-                ]
-
-        if labels is None:
-            labels_with_prompts = None
+        def _join(prompt_part, input_part):
+            joined = torch.cat((prompt_part, input_part), dim=1).gather(1, index)
+            if padding_side == "left":
+                # now we know that all the padding is on the left, cut to max input length
+                return joined[:, -max_input_length:]
+            return joined[:, :max_input_length]
+
+        input_ids_with_prompts = _join(prompt_ids, input_ids)
+        attn_mask_with_prompts = _join(
+            prompt_mask.to(attention_mask.dtype), attention_mask
+        )
 
+        if modify_labels:
+            labels_with_prompts = _join(torch.full_like(prompt_ids, -100), labels)
+        else:
+            labels_with_prompts = labels
         return input_ids_with_prompts, attn_mask_with_prompts, labels_with_prompts
 
     def forward(self, batch, **kwargs):
@@ -52,23 +52,111 @@ class MLPModifier(Modifier):
         if len(set([mlp.layer for mlp in mlps])) > 1:
             raise ValueError("Cannot parallelize adapters applied to different layers.")
 
-        mlp_to_index = {}
-        for i, mlp in enumerate(mlps):
-            mlp_to_index.setdefault(mlp, []).append(i)
-
-        if input.ndim == 3:
-            raise ValueError("Cannot parallelize MLP modules applied to 3D inputs.")
+        if len(mlps) not in [1, input.shape[0]]:
+            raise ValueError("Needed either 1 mlp or as many batch examples.")
+
+        layer_out = mlps[0].layer(input)
+
+        # (n_examples, seq_len, n_embd), 2D inputs are treated as sequences of length 1
+        hidden_states = input if input.ndim == 3 else input.unsqueeze(1)
+        hidden_states = hidden_states.to(mlps[0].mod_fc1.weight.dtype)
+
+        unique_mlps = list(dict.fromkeys(mlps))
+        if len(unique_mlps) == 1:
+            adapter_out = unique_mlps[0]._modifier_forward(hidden_states)
+        else:
+            adapter_out = cls._grouped_modifier_forward(
+                hidden_states, unique_mlps, [unique_mlps.index(mlp) for mlp in mlps]
+            )
+
+        adapter_out = adapter_out.view(layer_out.shape)
+        return layer_out + adapter_out.to(dtype=layer_out.dtype)
+
+    @staticmethod
+    def _stacked_weights(mlps: List["MLPModifier"]):
+        """Returns the fc1/fc2 weights and biases of `mlps` stacked in (n_mlps, ...) banks.
+
+        Without gradients, the banks of the latest combination of MLPs are kept on its first
+        MLP, and rebuilt when a weight is replaced or modified in place.
+        """
+        params = [
+            p
+            for mlp in mlps
+            for p in (
+                mlp.mod_fc1.weight,
+                mlp.mod_fc1.bias,
+                mlp.mod_fc2.weight,
+                mlp.mod_fc2.bias,
+            )
+        ]
+        cache = not torch.is_grad_enabled() or not any(p.requires_grad for p in params)
+        key = tuple((id(p), p.data_ptr(), p._version) for p in params)
+
+        cached = getattr(mlps[0], "_stacked_weights_cache", None)
+        if cache and cached is not None and cached[0] == key:
+            return cached[1]
+
+        # (n_mlps, out_features, in_features) and (n_mlps, 1, out_features)
+        banks = (
+            torch.stack(params[0::4]),
+            torch.stack(params[1::4]).unsqueeze(1),
+            torch.stack(params[2::4]),
+            torch.stack(params[3::4]).unsqueeze(1),
+        )
+        if cache:
+            mlps[0]._stacked_weights_cache = (key, banks)
+        return banks
 
-        output = torch.zeros(
-            input.shape,
-            dtype=input.dtype,
-            device=input.device,
+    @classmethod
+    def _grouped_modifier_forward(
+        cls,
+        hidden_states: torch.Tensor,
+        mlps: List["MLPModifier"],
+        mlp_indices: List[int],
+    ) -> torch.Tensor:
+        """Applies a different MLP to each example with one bmm per projection.
+
+        Examples are bucketed by MLP in a (n_mlps, max_examples_per_mlp * seq_len, n_embd)
+        tensor, and the weights of the distinct MLPs are stacked in (n_mlps, ...) banks. When
+        the buckets would be mostly padding, e.g. when most examples use the same MLP, each MLP
+        is applied to its own examples instead.
+        """
+        n_mlps = len(mlps)
+        batch_size, seq_len, n_embd = hidden_states.shape
+        device = hidden_states.device
+
+        # position of each example in the bucket of its mlp
+        mlp_indices = torch.tensor(mlp_indices, device=device)
+        counts = torch.bincount(mlp_indices, minlength=n_mlps)
+        max_count = int(counts.max())
+
+        if n_mlps * max_count > 2 * batch_size:
+            output = None
+            for i, mlp in enumerate(mlps):
+                idxs = (mlp_indices == i).nonzero().squeeze(1)
+                out = mlp._modifier_forward(hidden_states[idxs])
+                if output is None:
+                    output = out.new_empty(batch_size, *out.shape[1:])
+                output[idxs] = out
+            return output
+
+        order = torch.argsort(mlp_indices, stable=True)
+        bucket_start = torch.cumsum(counts, 0) - counts
+        positions = torch.empty_like(order)
+        positions[order] = (
+            torch.arange(batch_size, device=device) - bucket_start[mlp_indices[order]]
         )
-        for mlp, indices in mlp_to_index.items():
-            hidden_states = input[indices]
-            hidden_states = mlp._modifier_forward(hidden_states)
-            output.index_add_(0, indices, hidden_states.to(input.dtype))
-        return mlps[0].layer(input) + output
+
+        buckets = hidden_states.new_zeros(n_mlps, max_count, seq_len, n_embd)
+        buckets[mlp_indices, positions] = hidden_states
+        buckets = buckets.view(n_mlps, max_count * seq_len, n_embd)
+
+        fc1_weight, fc1_bias, fc2_weight, fc2_bias = cls._stacked_weights(mlps)
+        buckets = torch.baddbmm(fc1_bias, buckets, fc1_weight.transpose(1, 2))
+        buckets = mlps[0].act(buckets)
+        buckets = torch.baddbmm(fc2_bias, buckets, fc2_weight.transpose(1, 2))
+
+        return buckets.view(n_mlps, max_count, seq_len, -1)[mlp_indices, positions]
 
 
 @dataclass
@@ -78,6 +166,8 @@ class PEERConfig(ModifierConfig):
     emb_dim: int = 128
     down_proj_layer: str = "fc1"
     up_proj_layer: str = "fc2"
+    # number of tokens whose expert weights are gathered at once in the forward
+    peer_chunk_size: int = 1024
 
 
 @Modifier.register("peer", config_cls=PEERConfig)
@@ -72,10 +72,19 @@ class ExtendedEmbedding(nn.Module):
         )
 
     def forward(self, input_ids):
-        # 1) concat the embeddings, and run fwd pass
-        all_embeds = torch.cat((self.input_embeds, self.new_embeds), dim=0)
-        out = F.embedding(input_ids, all_embeds, sparse=self.sparse)
-        return out
+        # ids past the vocabulary are soft prompt tokens, looked up in their own table so that
+        # the (large) base table is never copied
+        vocab_size = self.input_embeds.size(0)
+        is_new = (input_ids >= vocab_size).unsqueeze(-1)
+
+        out = F.embedding(
+            input_ids.clamp(max=vocab_size - 1), self.input_embeds, sparse=self.sparse
+        )
+        new_out = F.embedding(
+            (input_ids - vocab_size).clamp(0, self.new_embeds.size(0) - 1),
+            self.new_embeds,
+        )
+        return torch.where(is_new, new_out, out)
 
 
 class ExtendedLinear(nn.Module):
@@ -95,14 +104,10 @@ class ExtendedLinear(nn.Module):
             self.ext_bias = None
 
     def forward(self, x):
-        # regular out
-        weights = torch.cat((self.lm_head.weight, self.ext_weight), dim=0)
-        if self.lm_head.bias is not None:
-            bias = torch.cat((self.lm_head.bias, self.ext_bias), dim=0)
-        else:
-            bias = None
-
-        return F.linear(x, weights, bias)
+        # the logits of the new tokens are computed on their own, without copying the head
+        out = F.linear(x, self.lm_head.weight, self.lm_head.bias)
+        ext_out = F.linear(x, self.ext_weight, self.ext_bias)
+        return torch.cat((out, ext_out), dim=-1)
 
 
 class DecoderPromptTuningWrapper(torch.nn.Module):
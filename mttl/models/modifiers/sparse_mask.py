@@ -31,6 +31,158 @@ def hook_factory(keep_mask):
     return hook
 
 
+# storage formats of a layer mask, see `encode_mask`
+MASK_BITMAP, MASK_DELTA, MASK_BLOCK = 0, 1, 2
+
+
+def _varint_encode(values):
+    """LEB128 encoding of non-negative integers, 7 bits per byte."""
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+
+    starts = np.repeat(np.cumsum(n_bytes) - n_bytes, n_bytes)
+    position = np.arange(n_bytes.sum()) - starts
+    data = np.repeat(values, n_bytes) >> (np.uint64(7) * position.astype(np.uint64))
+    data = data & np.uint64(0x7F)
+    # the high bit flags that more bytes follow
+    more = position < np.repeat(n_bytes, n_bytes) - 1
+    return (data | (more.astype(np.uint64) << np.uint64(7))).astype(np.uint8)
+
+
+def _varint_decode(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = (data & 0x7F).astype(np.uint64) << (
+        np.uint64(7) * position.astype(np.uint64)
+    )
+    return np.add.reduceat(values, starts).astype(np.int64)
+
+
+def encode_mask(mask, block_size=None):
+    """Encodes a binary mask as (meta, data) numpy arrays, without pickled objects.
+
+    The smallest of the following formats is chosen:
+        - a bitmap, 1 bit per entry, for dense masks;
+        - the flat indices of kept entries, as varint encoded gaps, for sparse masks;
+        - the varint encoded gaps between kept blocks, if every `block_size` x `block_size`
+          block is either kept or dropped entirely.
+
+    `meta` holds the format, the block size and the shape of the mask.
+    """
+    mask = torch.as_tensor(mask).detach().cpu() != 0
+    shape = list(mask.shape)
+    flat = mask.flatten().numpy()
+
+    candidates = [(MASK_BITMAP, 0, np.packbits(flat))]
+
+    indices = np.flatnonzero(flat)
+    candidates.append((MASK_DELTA, 0, _varint_encode(np.diff(indices, prepend=0))))
+
+    if (
+        block_size
+        and mask.dim() == 2
+        and shape[0] % block_size == 0
+        and shape[1] % block_size == 0
+    ):
+        blocks = mask.reshape(
+            shape[0] // block_size, block_size, shape[1] // block_size, block_size
+        ).sum((1, 3))
+        if ((blocks == 0) | (blocks == block_size**2)).all():
+            block_indices = np.flatnonzero(blocks.flatten().numpy())
+            candidates.append(
+                (
+                    MASK_BLOCK,
+                    block_size,
+                    _varint_encode(np.diff(block_indices, prepend=0)),
+                )
+            )
+
+    mask_format, block_size, data = min(candidates, key=lambda c: len(c[2]))
+    meta = np.array([mask_format, block_size] + shape, dtype=np.int64)
+    return meta, data
+
+
+def decode_mask_indices(meta, data):
+    """Returns the sorted flat indices of the kept entries of a mask from `encode_mask`."""
+    mask_format, block_size, shape = int(meta[0]), int(meta[1]), meta[2:].tolist()
+
+    if mask_format == MASK_BITMAP:
+        flat = np.unpackbits(data, count=int(np.prod(shape)))
+        return np.flatnonzero(flat)
+    elif mask_format == MASK_DELTA:
+        return np.cumsum(_varint_decode(data))
+    elif mask_format == MASK_BLOCK:
+        n_col_blocks = shape[1] // block_size
+        block_indices = np.cumsum(_varint_decode(data))
+        rows = (block_indices // n_col_blocks)[:, None, None] * block_size
+        cols = (block_indices % n_col_blocks)[:, None, None] * block_size
+        offsets = np.arange(block_size)
+        rows = rows + offsets[None, :, None]
+        cols = cols + offsets[None, None, :]
+        return np.sort((rows * shape[1] + cols).reshape(-1))
+    raise ValueError(f"Unknown mask format {mask_format}.")
+
+
+class SparseMaskFile:
+    """Read-only access to the masks saved by `save_mask`, decoded lazily per layer.
+
+    Also reads the legacy format, a pickled dict of `nonzero()` indices.
+    """
+
+    def __init__(self, path):
+        self._file = np.load(path)
+        self._legacy = None
+
+        if "arr" in self._file.files:
+            self._legacy = np.load(path, allow_pickle=True)["arr"].item()
+            self._layers = list(self._legacy["mask"].keys())
+        else:
+            self._layers = [
+                k[: -len("/meta")] for k in self._file.files if k.endswith("/meta")
+            ]
+
+    def keys(self):
+        return list(self._layers)
+
+    def __contains__(self, layer):
+        return layer in self._layers
+
+    def __len__(self):
+        return len(self._layers)
+
+    def shape(self, layer):
+        if self._legacy is not None:
+            return torch.Size(self._legacy["mask_shape"][layer])
+        return torch.Size(self._file[f"{layer}/meta"][2:].tolist())
+
+    def indices(self, layer):
+        """Sorted flat indices of the kept entries of the mask of `layer`."""
+        if self._legacy is not None:
+            idx = self._legacy["mask"][layer]
+            flat = np.ravel_multi_index(tuple(idx.T), tuple(self.shape(layer)))
+            return torch.from_numpy(np.sort(flat))
+        return torch.from_numpy(
+            decode_mask_indices(
+                self._file[f"{layer}/meta"], self._file[f"{layer}/data"]
+            )
+        )
+
+    def __getitem__(self, layer):
+        """Dense float mask of `layer`."""
+        shape = self.shape(layer)
+        mask = torch.zeros(shape.numel())
+        mask[self.indices(layer)] = 1.0
+        return mask.reshape(shape)
+
+
 def load_mask(f_name):
     destination_type, _ = f_name.split("://")
     if destination_type == "hf":
@@ -38,9 +190,10 @@ def load_mask(f_name):
         repo_id = ("/").join(f_name.split("/")[:2])
         task_name = f_name.split("/")[-1]
         f_path = hf_hub_download(repo_id=repo_id, filename=task_name)
-        mask_dict = np.load(f_path, allow_pickle=True)["arr"]
+        mask_dict = SparseMaskFile(f_path)
     elif destination_type == "local":
-        mask_dict = np.load(f"{f_name}.npz", allow_pickle=True)["arr"]
+        destination_type, f_name = f_name.split("://")
+        mask_dict = SparseMaskFile(f"{f_name}.npz")
     return mask_dict
 
 
@@ -48,18 +201,22 @@ def save_mask(module, f_name):
     """
     to load the saved mask use the `load_mask` function
     """
-    mask_dict = {"mask": {}, "mask_shape": {}}
-    import numpy as np
-
-    for m_name, m in dict(module.named_modules()).items():
+    modules = dict(module.named_modules())
+    arrays = {}
+    for m_name, m in modules.items():
         if "sparse_layer" in m_name:
-            mask_dict["mask"][m_name] = torch.nonzero(m.weight_mask.data).cpu().numpy()
-            mask_dict["mask_shape"][m_name] = m.weight_mask.shape
+            adapter = modules.get(m_name.rsplit(".", 1)[0])
+            block_size = None
+            if getattr(adapter, "sparse_cat", None) == "block_sparse":
+                block_size = adapter.BLOCK_SIZE
+            meta, data = encode_mask(m.weight_mask.data, block_size=block_size)
+            arrays[f"{m_name}/meta"] = meta
+            arrays[f"{m_name}/data"] = data
     destination_type = f_name.split("://")[0]
     # save in local dir
     if destination_type == "local":
         destination_type, f_name = f_name.split("://")
-        np.savez_compressed(f"./{f_name}.npz", arr=mask_dict)
+        np.savez_compressed(os.path.join(".", f"{f_name}.npz"), **arrays)
 
     # upload to hf
     elif destination_type == "hf":
@@ -71,7 +228,7 @@ def save_mask(module, f_name):
         path_in_repo = f"{task_name}.npz"
         os.makedirs("./temp/test_library/", exist_ok=True)
         local_file_path = f"./temp/test_library/{path_in_repo}"
-        np.savez_compressed(local_file_path, arr=mask_dict)
+        np.savez_compressed(local_file_path, **arrays)
 
         hf_upload_file(
             path_or_fileobj=local_file_path,  # path saved in local machine
@@ -80,7 +237,7 @@ def save_mask(module, f_name):
         )  #
     # exact local dir is provided
     else:
-        np.savez_compressed(f"./{f_name}.npz", arr=mask_dict)
+        np.savez_compressed(os.path.join(".", f"{f_name}.npz"), **arrays)
 
 
 class MatrixBlockIndexer:
@@ -1,33 +1,150 @@
 import math
 import os
+import queue
+import threading
+import time
 
+import numpy as np
 import torch
 from tqdm.auto import tqdm
 
 from mttl.datamodule.base import DataModule
 from mttl.logging import logger
 from mttl.models.base_model import WEIGHTS_NAME, BaseExpertModel
+from mttl.models.chunked_loss import (
+    LossAccumulator,
+    compute_chunked_loss,
+    compute_loss_sums,
+)
 from mttl.models.get_optimizer import get_optimizer_and_scheduler
 from mttl.models.modifiers.sparse_mask import make_sparse_model_during_training
 from mttl.models.utils import transfer_batch_to_device
 
 
+class BatchPrefetcher:
+    """Iterates over `dataloader` forever, loading batches in a background thread.
+
+    Up to `num_prefetch` batches are loaded ahead of the training loop. On GPUs, they are pinned
+    and copied to `device` without blocking. `wait_seconds` is the time spent waiting for
+    batches, and `num_tokens` the number of tokens (non-padding if there is an attention mask)
+    in the batches returned so far. Used as a context manager, the thread is stopped on exit.
+    """
+
+    def __init__(self, dataloader, device, num_prefetch=2):
+        self.device = torch.device(device)
+        self.wait_seconds = 0.0
+        self.num_tokens = 0
+        self._queue = queue.Queue(maxsize=max(num_prefetch, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._load, args=(dataloader,), daemon=True
+        )
+        self._thread.start()
+
+    def _load(self, dataloader):
+        try:
+            while not self._stop.is_set():
+                empty = True
+                for batch in dataloader:
+                    empty = False
+                    if "attention_mask" in batch:
+                        num_tokens = int(batch["attention_mask"].sum())
+                    elif "input_ids" in batch:
+                        num_tokens = batch["input_ids"].numel()
+                    else:
+                        num_tokens = 0
+                    if self.device.type == "cuda":
+                        batch = {
+                            k: (
+                                v.pin_memory()
+                                if isinstance(v, torch.Tensor) and not v.is_pinned()
+                                else v
+                            )
+                            for k, v in batch.items()
+                        }
+                    if not self._put((batch, num_tokens)):
+                        return
+                if empty:
+                    raise StopIteration("The dataloader is empty.")
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        self.wait_seconds += time.perf_counter() - start
+        if isinstance(item, BaseException):
+            raise RuntimeError("Failed to load a batch.") from item
+
+        batch, num_tokens = item
+        self.num_tokens += num_tokens
+        return transfer_batch_to_device(batch, self.device, non_blocking=True)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def log_training_stats(step_seconds, prefetcher):
+    """Logs the throughput of the training loop, the fraction of the time spent waiting for
+    data, and percentiles of the step time."""
+    if not step_seconds:
+        return
+    total_seconds = sum(step_seconds)
+    p50, p90, p99 = np.percentile(np.array(step_seconds) * 1000, [50, 90, 99])
+    logger.info(
+        f"Training: {prefetcher.num_tokens / total_seconds:.1f} tokens/s,"
+        f" data wait: {prefetcher.wait_seconds / total_seconds:.1%},"
+        f" step time (ms): p50 {p50:.1f}, p90 {p90:.1f}, p99 {p99:.1f}"
+    )
+
+
 @torch.no_grad()
-def evaluate_model(dataloader, model):
-    """Evaluation loop."""
+def evaluate_model(dataloader, model, loss_only=False, chunk_size=1024):
+    """Evaluation loop.
+
+    With `loss_only`, the loss is computed `chunk_size` tokens at a time, without the logits of
+    the whole batch, and is the mean over all tokens instead of the mean of the batch losses.
+    """
     model.eval()
-    total_loss = 0.0
+    total_loss = torch.zeros((), device=model.device)
     total_samples = 0
+    accumulator = LossAccumulator()
     for batch in dataloader:
         with torch.autocast(
             device_type=model.device.type,
             dtype=model.dtype,
         ):
-            batch = transfer_batch_to_device(batch, model.device)
+            batch = transfer_batch_to_device(batch, model.device, non_blocking=True)
+            if loss_only:
+                accumulator.update(*compute_loss_sums(model, batch, chunk_size))
+                continue
+
             output = model.forward(**batch)
-            total_loss += output.loss.item()
+            total_loss += output.loss.detach()
             total_samples += 1
-    return total_loss / total_samples
+
+    if loss_only:
+        return accumulator.token_loss
+    return total_loss.item() / total_samples
 
 
 def train_model(
@@ -50,64 +167,73 @@ def train_model(
     )
     dataloader = datamodule.train_dataloader()
     num_train_steps = len(dataloader)
-    iter_train = iter(dataloader)
 
     if args.eval_every_n_epoch != -1:
         args.eval_every = num_train_steps * args.eval_every_n_epoch
 
     bar = tqdm(range(args.total_steps))
     best_val_loss = float("inf")
-    running_loss = 0.0
-
-    for step in bar:
-        loss_accum = 0.0
-        model.train()
-        optimizer.zero_grad()
-
-        for micro_step in range(args.gradient_accumulation_steps):
-            try:
-                batch = next(iter_train)
-            except StopIteration:
-                iter_train = iter(dataloader)
-                batch = next(iter_train)
-
-            with torch.autocast(
-                device_type=model.device.type,
-                dtype=model.dtype,
-            ):
-                batch = transfer_batch_to_device(batch, model.device)
-                loss = model.forward(**batch).loss
-                loss = loss / args.gradient_accumulation_steps
-                loss_accum += loss.detach()
-                loss.backward()
-
-        if loss_accum:
-            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            running_loss += loss_accum.item()
+    # the loss stays on the device, it is only read every `log_every` steps
+    running_loss = torch.zeros((), device=model.device)
+    step_seconds = []
+
+    with BatchPrefetcher(dataloader, model.device, args.prefetch_batches) as batches:
+        for step in bar:
+            step_start = time.perf_counter()
+            loss_accum = torch.zeros((), device=model.device)
+            model.train()
+            optimizer.zero_grad()
+
+            for micro_step in range(args.gradient_accumulation_steps):
+                batch = next(batches)
+
+                with torch.autocast(
+                    device_type=model.device.type,
+                    dtype=model.dtype,
+                ):
+                    if args.loss_chunk_size:
+                        loss = compute_chunked_loss(model, batch, args.loss_chunk_size)
+                    else:
+                        loss = model.forward(**batch).loss
+                    loss = loss / args.gradient_accumulation_steps
+                    loss_accum += loss.detach()
+                    loss.backward()
+
+            torch.nn.utils.clip_grad_norm_(
+                [p for group in optimizer.param_groups for p in group["params"]], 1.0
+            )
+            running_loss += loss_accum
             optimizer.step()
             scheduler.step()
-            if model.device.type == "cuda":
-                torch.cuda.synchronize()
-
-            bar.set_description_str(
-                f"Step {step + 1}/{args.total_steps},"
-                f" Loss: {running_loss / (step + 1):.4f},"
-                f" Lr: {scheduler.get_last_lr()[0]:.4f},"
-                f" Val: {best_val_loss:.4f}"
-            )
+            step_seconds.append(time.perf_counter() - step_start)
+
+            if (step + 1) % args.log_every == 0 or step + 1 == args.total_steps:
+                bar.set_description_str(
+                    f"Step {step + 1}/{args.total_steps},"
+                    f" Loss: {running_loss.item() / (step + 1):.4f},"
+                    f" Lr: {scheduler.get_last_lr()[0]:.4f},"
+                    f" Val: {best_val_loss:.4f}"
+                )
 
-        # eval and save best model
-        if (
-            args.eval_every > 0
-            and step % args.eval_every == 0
-            and datamodule.dev_dataset
-        ):
-            val_loss = evaluate_model(datamodule.val_dataloader(), model)
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                if args.output_dir:
-                    model.save_pretrained(args.output_dir + "/best_model")
-            running_loss = 0.0
+            # eval and save best model
+            if (
+                args.eval_every > 0
+                and step % args.eval_every == 0
+                and datamodule.dev_dataset
+            ):
+                val_loss = evaluate_model(
+                    datamodule.val_dataloader(),
+                    model,
+                    loss_only=args.eval_loss_only,
+                    chunk_size=args.eval_loss_chunk_size,
+                )
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    if args.output_dir:
+                        model.save_pretrained(args.output_dir + "/best_model")
+                running_loss.zero_()
+
+    log_training_stats(step_seconds, batches)
 
     # reload best model
     if args.output_dir and os.path.exists(
@@ -124,7 +250,12 @@ def train_model(
 
     # do test evaluation
     if do_test and datamodule.test_dataset:
-        test_loss = evaluate_model(datamodule.test_dataloader(), model)
+        test_loss = evaluate_model(
+            datamodule.test_dataloader(),
+            model,
+            loss_only=args.eval_loss_only,
+            chunk_size=args.eval_loss_chunk_size,
+        )
         logger.info(f"Test loss: {test_loss:.4f}")
 
     return model
@@ -144,7 +275,6 @@ def train_sparse_model(model, datamodule, args, do_test=False):
     )
     dataloader = datamodule.train_dataloader()
     num_train_steps = len(dataloader)
-    iter_train = iter(dataloader)
 
     if args.eval_every_n_epoch != -1:
         args.eval_every = math.ceil(
@@ -153,73 +283,89 @@ def train_sparse_model(model, datamodule, args, do_test=False):
 
     bar = tqdm(range(args.total_steps))
     best_val_loss = float("inf")
-    running_loss = 0.0
-
-    for step in bar:
-        loss_accum = 0.0
-        model.train()
-        optimizer.zero_grad()
-
-        for micro_step in range(args.gradient_accumulation_steps):
-            try:
-                batch = next(iter_train)
-            except StopIteration:
-                iter_train = iter(dataloader)
-                batch = next(iter_train)
-
-            with torch.autocast(
-                device_type=model.device.type,
-                dtype=model.dtype,
-            ):
-                batch = transfer_batch_to_device(batch, model.device)
-                loss = model.forward(**batch).loss
-                loss = loss / args.gradient_accumulation_steps
-                loss_accum += loss.detach()
-                loss.backward()
-
-        if loss_accum:
-            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            running_loss += loss_accum.item()
+    # the loss stays on the device, it is only read every `log_every` steps
+    running_loss = torch.zeros((), device=model.device)
+    step_seconds = []
+
+    with BatchPrefetcher(dataloader, model.device, args.prefetch_batches) as batches:
+        for step in bar:
+            step_start = time.perf_counter()
+            loss_accum = torch.zeros((), device=model.device)
+            model.train()
+            optimizer.zero_grad()
+
+            for micro_step in range(args.gradient_accumulation_steps):
+                batch = next(batches)
+
+                with torch.autocast(
+                    device_type=model.device.type,
+                    dtype=model.dtype,
+                ):
+                    if args.loss_chunk_size:
+                        loss = compute_chunked_loss(model, batch, args.loss_chunk_size)
+                    else:
+                        loss = model.forward(**batch).loss
+                    loss = loss / args.gradient_accumulation_steps
+                    loss_accum += loss.detach()
+                    loss.backward()
+
+            torch.nn.utils.clip_grad_norm_(
+                [p for group in optimizer.param_groups for p in group["params"]], 1.0
+            )
+            running_loss += loss_accum
             optimizer.step()
             scheduler.step()
-            if model.device.type == "cuda":
-                torch.cuda.synchronize()
-
-            bar.set_description_str(
-                f"Step {step + 1}/{args.total_steps},"
-                f" Loss: {running_loss / (step + 1):.4f},"
-                f" Lr: {scheduler.get_last_lr()[0]:.4f},"
-                f" Val: {best_val_loss:.4f}"
-            )
+            step_seconds.append(time.perf_counter() - step_start)
+
+            if (step + 1) % args.log_every == 0 or step + 1 == args.total_steps:
+                bar.set_description_str(
+                    f"Step {step + 1}/{args.total_steps},"
+                    f" Loss: {running_loss.item() / (step + 1):.4f},"
+                    f" Lr: {scheduler.get_last_lr()[0]:.4f},"
+                    f" Val: {best_val_loss:.4f}"
+                )
 
             # update sparse mask every 5 steps and only in first epoch
             if step % 5 == 0 and step < (
                 num_train_steps / args.gradient_accumulation_steps
             ):
                 make_sparse_model_during_training(
-                    model, batch, parameter_selection_procedure="max_connection_sensitivity"
+                    model,
+                    batch,
+                    parameter_selection_procedure="max_connection_sensitivity",
                 )
 
-        # eval and save best model
-        if (
-            args.eval_every > 0
-            and step % args.eval_every == 0
-            and datamodule.dev_dataset
-        ):
-            val_loss = evaluate_model(datamodule.val_dataloader(), model)
-            if val_loss < best_val_loss:
-                best_val_loss = val_loss
-                if args.output_dir:
-                    model.save_pretrained(args.output_dir + "/best_model")
-            running_loss = 0.0
+            # eval and save best model
+            if (
+                args.eval_every > 0
+                and step % args.eval_every == 0
+                and datamodule.dev_dataset
+            ):
+                val_loss = evaluate_model(
+                    datamodule.val_dataloader(),
+                    model,
+                    loss_only=args.eval_loss_only,
+                    chunk_size=args.eval_loss_chunk_size,
+                )
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    if args.output_dir:
+                        model.save_pretrained(args.output_dir + "/best_model")
+                running_loss.zero_()
 
     # additionally eval at end of training
-    val_loss = evaluate_model(datamodule.val_dataloader(), model)
+    val_loss = evaluate_model(
+        datamodule.val_dataloader(),
+        model,
+        loss_only=args.eval_loss_only,
+        chunk_size=args.eval_loss_chunk_size,
+    )
     if val_loss < best_val_loss:
         best_val_loss = val_loss
         if args.output_dir:
             model.save_pretrained(args.output_dir + "/best_model")
-    running_loss = 0.0
+
+    log_training_stats(step_seconds, batches)
 
     # reload best model
     if args.output_dir and os.path.exists(
@@ -236,7 +382,12 @@ def train_sparse_model(model, datamodule, args, do_test=False):
 
     # do test evaluation
     if do_test and datamodule.test_dataset:
-        test_loss = evaluate_model(datamodule.test_dataloader(), model)
+        test_loss = evaluate_model(
+            datamodule.test_dataloader(),
+            model,
+            loss_only=args.eval_loss_only,
+            chunk_size=args.eval_loss_chunk_size,
+        )
         logger.info(f"Test loss: {test_loss:.4f}")
 
     return model
@@ -1,3 +1,5 @@
+import copy
+import json
 import os
 import re
 from collections import defaultdict, deque
@@ -33,10 +35,10 @@ def compute_loglike_loss(logits, labels, reduction="none"):
     return loss
 
 
-def transfer_batch_to_device(batch, device):
+def transfer_batch_to_device(batch, device, non_blocking=False):
     for key, value in batch.items():
         if isinstance(value, torch.Tensor):
-            batch[key] = value.to(device)
+            batch[key] = value.to(device, non_blocking=non_blocking)
     return batch
 
 
@@ -176,6 +178,173 @@ def model_loader_helper(
     return model_object.train()
 
 
+def merged_layer_weight(modifier, device="cpu"):
+    """Returns the weight of `modifier.layer` with the modifier merged into it.
+
+    The merge runs on a shallow copy of the modifier holding a copy of the layer weight,
+    so that neither the modifier nor the layer of the model are modified.
+    """
+    layer = copy.copy(modifier.layer)
+    layer._parameters = layer._parameters.copy()
+    layer.weight = torch.nn.Parameter(
+        modifier.layer.weight.detach().to(device, copy=True), requires_grad=False
+    )
+
+    view = copy.copy(modifier)
+    view._modules = view._modules.copy()
+    view.layer = layer
+    view.merge_with_layer()
+    return layer.weight.data
+
+
+def iter_merged_tensors(model, expert_name=None, strict=True):
+    """Yields (name, tensor, modifier) for every tensor of the base model.
+
+    Modifiers and expert containers are replaced by the layer they wrap. `modifier` is not None
+    for layer weights into which an adapter must be merged, with `merged_layer_weight`:
+    mergeable modifiers or, if `expert_name` is given, the expert of the containers holding it.
+    Other modifiers raise an error if `strict`, and are dropped with a warning otherwise.
+    """
+    from mttl.models.containers.base import ExpertContainer, MergeableContainer
+    from mttl.models.modifiers.base import MergeableModifierMixin, Modifier
+
+    seen, skipped = set(), []
+
+    def visit(module, prefix):
+        modifier = None
+        if isinstance(module, ExpertContainer):
+            if expert_name is not None and expert_name in module.expert_infos:
+                if not isinstance(module, MergeableContainer):
+                    raise ValueError(
+                        "Cannot merge expert loaded in a non-mergeable container. Either change container type or expert type."
+                    )
+                modifier = module.get(expert_name)
+            module = module.layer
+        elif isinstance(module, Modifier):
+            if isinstance(module, MergeableModifierMixin):
+                modifier = module
+            elif strict:
+                raise ValueError(
+                    "Modifier {} is not mergeable!".format(module.__class__)
+                )
+            else:
+                skipped.append(prefix.rstrip("."))
+            module = module.layer
+
+        for name, tensor in module._parameters.items():
+            # tied parameters are saved once, under their first name
+            if tensor is None or id(tensor) in seen:
+                continue
+            seen.add(id(tensor))
+            yield prefix + name, tensor, modifier if name == "weight" else None
+
+        for name, tensor in module._buffers.items():
+            if tensor is None or name in module._non_persistent_buffers_set:
+                continue
+            yield prefix + name, tensor, None
+
+        for name, child in module._modules.items():
+            if child is not None:
+                yield from visit(child, prefix + name + ".")
+
+    yield from visit(model, "")
+
+    if skipped:
+        logger.warning(
+            "Dropped non-mergeable modifiers of layers: %s" % ", ".join(skipped)
+        )
+
+
+@torch.no_grad()
+def save_merged_checkpoint(
+    model,
+    output_dir,
+    expert_name=None,
+    strict=True,
+    max_shard_size="5GB",
+    dtype=None,
+    device="cpu",
+):
+    """
+    Saves a huggingface `model` in the safetensors format to `output_dir`, with its adapters
+    merged in the base weights, as `save_pretrained` would do on a merged copy of the model.
+
+    Mergeable modifiers are merged; for expert containers, only `expert_name` is merged and
+    other experts are dropped. The model is never copied: merged weights are computed on
+    `device` when their shard is written, and shards are written one at a time, so that the
+    memory overhead is bounded by `max_shard_size`. If `dtype` is given, tensors are cast
+    before being written.
+
+    Returns the mapping from tensor names to shard files.
+    """
+    from safetensors.torch import save_file
+    from transformers.utils.hub import convert_file_size_to_int
+
+    os.makedirs(output_dir, exist_ok=True)
+    max_shard_size = convert_file_size_to_int(max_shard_size)
+
+    # plan the shards from the tensor sizes, before producing any merged tensor
+    shards, shard_size, merged = [[]], 0, []
+    for name, tensor, modifier in iter_merged_tensors(
+        model, expert_name=expert_name, strict=strict
+    ):
+        n_bytes = tensor.numel() * (dtype or tensor.dtype).itemsize
+        if shards[-1] and shard_size + n_bytes > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append((name, tensor, modifier))
+        shard_size += n_bytes
+        if modifier is not None:
+            merged.append(name)
+
+    if len(shards) == 1:
+        file_names = ["model.safetensors"]
+    else:
+        file_names = [
+            f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            for i in range(len(shards))
+        ]
+
+    weight_map, total_size = {}, 0
+    for shard, file_name in zip(shards, file_names):
+        state_dict = {}
+        for name, tensor, modifier in shard:
+            if modifier is not None:
+                tensor = merged_layer_weight(modifier, device)
+            else:
+                tensor = tensor.detach()
+            if dtype is not None:
+                tensor = tensor.to(dtype)
+            state_dict[name] = tensor.cpu().contiguous()
+            weight_map[name] = file_name
+            total_size += tensor.numel() * tensor.dtype.itemsize
+
+        save_file(
+            state_dict, os.path.join(output_dir, file_name), metadata={"format": "pt"}
+        )
+        del state_dict
+
+    if len(shards) > 1:
+        index = {"metadata": {"total_size": total_size}, "weight_map": weight_map}
+        with open(os.path.join(output_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+    config = copy.deepcopy(model.config)
+    config.architectures = [model.__class__.__name__]
+    if dtype is not None:
+        config.torch_dtype = dtype
+    config.save_pretrained(output_dir)
+
+    if getattr(model, "generation_config", None) is not None and model.can_generate():
+        model.generation_config.save_pretrained(output_dir)
+
+    logger.info("Merged layers: %s" % ", ".join(merged))
+    logger.info(
+        "Saved merged model to %s in %d shard(s)" % (output_dir, len(file_names))
+    )
+    return weight_map
+
+
 # https://github.com/facebookresearch/dino/blob/main/utils.py
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
@@ -1,4 +1,3 @@
-import copy
 import gc
 import os
 import time
@@ -9,7 +8,11 @@ from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
 from mttl.logging import logger
-from mttl.models.modifiers.base import MergeableModifierMixin
+from mttl.models.utils import (
+    iter_merged_tensors,
+    merged_layer_weight,
+    save_merged_checkpoint,
+)
 
 try:
     from vllm import LLM, SamplingParams
@@ -24,8 +27,8 @@ except ImportError:
 def save_merged_model(model, model_path, hf_path="/tmp/merged"):
     """
     This prioritizes model_path: if both model and model_path are given, it loads model from model_path.
-    For the model, this assumes the model is on CPU. Creates a copy of the model and merges all adapters
-    if needed. Then saves the model to the given path.
+    Merges all mergeable adapters on the fly, without copying the model, while the checkpoint is
+    written shard by shard to the given path.
     """
 
     if model_path:
@@ -40,37 +43,15 @@ def save_merged_model(model, model_path, hf_path="/tmp/merged"):
         )
         hf_path = os.path.join(hf_path, model_path.replace("/", "_"))
 
-    for _, p in model.named_parameters():
-        if p.device != torch.device("cpu"):
-            raise ValueError("Model must be on CPU to merge adapters.")
-
     if not hasattr(model, "model"):
         raise ValueError("Model must have a `model` attribute, a HuggingFace model.")
 
     # if path already exists, we don't need to do anything
     if os.path.exists(hf_path):
         return hf_path
-    else:
-        os.makedirs(hf_path)
-
-    merged = []
-    model_copy = copy.deepcopy(model.model)
-
-    for name, module in model_copy.named_modules():
-        for c_name, child in module.named_children():
-            if isinstance(child, MergeableModifierMixin):
-                child.merge_with_layer()
-                setattr(
-                    module,
-                    c_name,
-                    child.layer,
-                )
-                merged.append(name)
 
-    logger.info("Merged layers: %s" % merged)
     logger.info("Saving merged model to: %s" % hf_path)
-
-    model_copy.save_pretrained(hf_path, save_full_model=True)
+    save_merged_checkpoint(model.model, hf_path, strict=False)
 
     logger.info("Saving tokenizer to: %s" % hf_path)
     model.tokenizer.save_pretrained(hf_path)
@@ -78,6 +59,74 @@ def save_merged_model(model, model_path, hf_path="/tmp/merged"):
     return hf_path
 
 
+def save_model_config(model, hf_path="/tmp/merged"):
+    """Saves only the config and the tokenizer of the model, for engines receiving weights in memory."""
+    os.makedirs(hf_path, exist_ok=True)
+    model.model.config.save_pretrained(hf_path)
+    if getattr(model.model, "generation_config", None) is not None:
+        model.model.generation_config.save_pretrained(hf_path)
+    model.tokenizer.save_pretrained(hf_path)
+    return hf_path
+
+
+class WeightHandoff:
+    """
+    Hands the merged weights of a model to an inference engine in memory.
+
+    `load_weights` receives an iterable of (name, tensor) pairs with the huggingface names, as
+    the `load_weights` of vLLM models does. Only the tensors whose contents changed since the
+    previous push are handed over: base weights are sent once, merged layers whenever their base
+    weight or the adapters merged into them change. Contents are compared with checksums, a
+    reloaded weight can reuse the memory of the one it replaces.
+    """
+
+    def __init__(self, load_weights, device="cpu"):
+        self.load_weights = load_weights
+        self.device = device
+        self._fingerprints = {}
+
+    @staticmethod
+    @torch.no_grad()
+    def _fingerprint(tensor, modifier=None):
+        from mttl.evaluators.base import _tensor_checksum
+
+        tensors = [tensor] if modifier is None else [tensor, *modifier.parameters()]
+        tensors = [t for t in tensors if t.numel() > 0]
+        if not tensors:
+            return ()
+        # one copy to the host for all the checksums of the layer
+        device = tensors[0].device
+        checksums = torch.stack(
+            [_tensor_checksum(t).to(device) for t in tensors]
+        ).tolist()
+        return tuple(
+            (tuple(t.shape), t.dtype, t.device, checksum)
+            for t, checksum in zip(tensors, checksums)
+        )
+
+    def push(self, model, expert_name=None):
+        """Hands the tensors of `model` that changed since the last push, returns their names."""
+        updated = []
+
+        def weights():
+            for name, tensor, modifier in iter_merged_tensors(
+                model, expert_name=expert_name, strict=False
+            ):
+                fingerprint = self._fingerprint(tensor, modifier)
+                if self._fingerprints.get(name) == fingerprint:
+                    continue
+
+                self._fingerprints[name] = fingerprint
+                updated.append(name)
+                if modifier is not None:
+                    yield name, merged_layer_weight(modifier, self.device)
+                else:
+                    yield name, tensor.detach()
+
+        self.load_weights(weights())
+        return updated
+
+
 def free_memory():
     from ray import shutdown
 
@@ -93,19 +142,55 @@ class LLMEngine(LLM):
         assert (
             model is not None or model_path is not None
         ), "Either model or model_path must be given."
-        # merge adapters -- if needed --
-        path = save_merged_model(model, model_path, hf_path=temp_path)
-        options["model"] = path
 
-        LLM.__init__(
-            self,
-            **options,
-        )
+        self.handoff = None
+        if model_path is None and options.get("tensor_parallel_size", 1) == 1:
+            # only the config goes through the disk, weights are handed over in memory
+            path = save_model_config(model, hf_path=temp_path)
+            LLM.__init__(self, model=path, load_format="dummy", **options)
+
+            if self.vllm_model is not None:
+                self.handoff = WeightHandoff(self.load_weights)
+                self.update_weights(model)
+            else:
+                logger.warning(
+                    "Can't find the model of this version of vLLM, loading its weights from disk."
+                )
+                del self.llm_engine
+                free_memory()
+                # the merged checkpoint is written where the config was
+                os.system("rm -rf %s" % path)
+
+        if self.handoff is None:
+            # merge adapters -- if needed --
+            path = save_merged_model(model, model_path, hf_path=temp_path)
+            LLM.__init__(self, model=path, **options)
 
         if os.path.exists(path):
             # remvoe directory
             os.system("rm -rf %s" % path)
 
+    @property
+    def vllm_model(self):
+        """The model run by the engine, or None if this version of vLLM doesn't expose it."""
+        # private attributes of vLLM, which change across versions
+        try:
+            model = self.llm_engine.model_executor.driver_worker.model_runner.model
+        except AttributeError:
+            return None
+        return model if hasattr(model, "load_weights") else None
+
+    def load_weights(self, weights):
+        self.vllm_model.load_weights(weights)
+
+    def update_weights(self, model, expert_name=None):
+        """Updates the engine in place with the weights of `model` that changed."""
+        if self.handoff is None:
+            raise ValueError(
+                "This engine was loaded from disk, weights cannot be updated."
+            )
+        return self.handoff.push(model.model, expert_name=expert_name)
+
     @property
     def model_name(self):
         return self.llm_engine.model_config.model
@@ -165,5 +250,4 @@ class LLMEngineMMLU(LLMEngine):
                 ):
                     max_logprob = logprobs_first_tok[tok_id]
                     _all_predictions[-1] = prediction
-        del self.llm_engine
         return _all_predictions, _all_references, _all_task_names
@@ -340,6 +340,9 @@ def run_eval(args: EvaluationConfig):
                 truncation_side=train_cfg.truncation_side,
                 tasks=args.pipeline_eval_tasks,
                 output_path=os.path.join(args.output_dir, "DOWNSTREAM"),
+                cache_path=os.path.join(
+                    args.output_dir, "DOWNSTREAM", "eval_cache.json"
+                ),
                 add_eos_to_targets=args.add_eos_to_downstream_targets,
             )
             scores = runner.run(model)
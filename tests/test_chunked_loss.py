@@ -0,0 +1,103 @@
+import torch
+import torch.nn.functional as F
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.models.chunked_loss import (
+    LossAccumulator,
+    compute_chunked_loss,
+    compute_loss_sums,
+)
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.modifiers.lora import LoRAConfig
+from mttl.models.train_utils import evaluate_model
+
+
+def make_lora_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    return ExpertModel(
+        ExpertModelConfig(
+            modifier_config=LoRAConfig(
+                modify_layers="q_proj|v_proj", lora_init_b_random=True
+            )
+        ),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+
+
+def make_batch(batch_size, seed):
+    torch.manual_seed(seed)
+    input_ids = torch.randint(0, 100, (batch_size, 10))
+    attention_mask = torch.ones_like(input_ids)
+    labels = input_ids.clone()
+    for i in range(batch_size):
+        # prompts and right padding are not labeled
+        labels[i, : 2 + i] = -100
+        attention_mask[i, 10 - i :] = 0
+        labels[i, 10 - i :] = -100
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def test_compute_loss_sums():
+    model = make_lora_model()
+    model.eval()
+    batches = [make_batch(3, 0), make_batch(1, 1)]
+
+    token_losses = []
+    accumulator = LossAccumulator()
+    for batch in batches:
+        with torch.no_grad():
+            logits = model.forward(**batch).logits
+        expected = F.cross_entropy(
+            logits[:, :-1].transpose(1, 2), batch["labels"][:, 1:], reduction="none"
+        )
+        mask = batch["labels"][:, 1:] != -100
+
+        loss_sums, num_tokens = compute_loss_sums(model, batch, chunk_size=4)
+        assert torch.allclose(loss_sums, expected.sum(1), atol=1e-5)
+        assert torch.equal(num_tokens, mask.sum(1))
+        accumulator.update(loss_sums, num_tokens)
+        token_losses += [expected[i][mask[i]] for i in range(len(mask))]
+
+    assert abs(accumulator.token_loss - torch.cat(token_losses).mean().item()) < 1e-5
+    example_loss = torch.stack([l.mean() for l in token_losses]).mean().item()
+    assert abs(accumulator.example_loss - example_loss) < 1e-5
+    assert (
+        abs(
+            evaluate_model(batches, model, loss_only=True, chunk_size=4)
+            - accumulator.token_loss
+        )
+        < 1e-5
+    )
+
+    # the model computes its logits and loss as usual afterwards
+    assert model.forward(**batches[0]).logits.shape == (3, 10, 100)
+
+
+def test_chunked_training_loss():
+    model = make_lora_model()
+    lm_head = model.model.get_output_embeddings()
+    lm_head.weight.requires_grad = True
+    params = [p for p in model.parameters() if p.requires_grad]
+
+    batch = make_batch(3, 0)
+    # two sequences packed in each row, the second one starts at position 6
+    seq_lens = torch.tensor([[6, 4]] * 3)
+    batch["seq_lens"] = seq_lens
+    batch["packed_seq_lens"] = F.pad(seq_lens.flatten().cumsum(0), (1, 0)).int()
+
+    loss = model.forward(**batch).loss
+    grads = torch.autograd.grad(loss, params)
+    chunked_loss = compute_chunked_loss(model, batch, chunk_size=4)
+    chunked_grads = torch.autograd.grad(chunked_loss, params)
+
+    assert torch.allclose(chunked_loss, loss, atol=1e-5)
+    for grad, chunked_grad in zip(grads, chunked_grads):
+        assert torch.allclose(grad, chunked_grad, atol=1e-6)
@@ -393,3 +393,141 @@ def test_dst_subsample(tiny_flan_id, subsample, subsample_per_task, train_size):
     config = FlatMultiTaskConfig(**common_kwargs)
     dm = FlatMultiTaskModule(config)
     assert len(dm.train_dataset) == train_size
+
+
+def test_augment_few_shot():
+    from datasets import Dataset
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    from mttl.datamodule.mt_seq_to_seq_module import augment_few_shot
+
+    rng = np.random.RandomState(0)
+    words = [f"w{i}" for i in range(50)]
+    examples = [
+        {
+            "source": " ".join(rng.choice(words, rng.randint(1, 20))),
+            "target": " ".join(rng.choice(words, rng.randint(1, 5))),
+            "task_name": f"task{i % 3}",
+            "task_source": "test",
+            "split": "train" if i % 5 else "validation",
+        }
+        for i in range(120)
+    ]
+    dataset = Dataset.from_list(examples)
+
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.train_from_iterator(
+        [e["source"] + " " + e["target"] + "\n\n" for e in examples],
+        trainers.BpeTrainer(vocab_size=300, special_tokens=["<unk>"]),
+    )
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, unk_token="<unk>")
+
+    augmented = augment_few_shot(dataset, 4, seed=1)
+    assert augmented.to_list() == augment_few_shot(dataset, 4, seed=1).to_list()
+    assert augmented.to_list()[: len(dataset)] == examples
+
+    shot_texts = {}
+    for i, example in enumerate(examples):
+        if example["split"] == "train":
+            shot_texts.setdefault(example["task_name"], {})[i] = " ".join(
+                [example["source"], example["target"]]
+            )
+
+    for task in ["task0", "task1", "task2"]:
+        task_examples = [i for i, e in enumerate(examples) if e["task_name"] == task]
+        offset = 120 + len([e for e in examples if e["task_name"] < task])
+        for j, i in enumerate(task_examples):
+            new = augmented[offset + j]
+            *shots, source = new["source"].split("\n\n")
+            assert source == examples[i]["source"]
+            candidates = {k: v for k, v in shot_texts[task].items() if k != i}
+            assert len(shots) == 4 and len(set(shots)) == 4
+            assert all(shot in candidates.values() for shot in shots)
+            assert new["task_source"] == "few_shot_test"
+
+    # trimmed prompts are the longest that fit, keeping at least one shot
+    trimmed = augment_few_shot(dataset, 4, tokenizer, max_input_length=40, seed=1)
+    trimmed_any = False
+    for full, new in zip(augmented.to_list(), trimmed.to_list()):
+        *shots, source = full["source"].split("\n\n")
+        n = len(shots)
+        while (
+            n > 1
+            and len(tokenizer("\n\n".join(shots[:n]) + "\n\n" + source).input_ids) > 40
+        ):
+            n -= 1
+        if full["task_source"] == "few_shot_test":
+            assert new["source"] == "\n\n".join(shots[:n]) + "\n\n" + source
+            trimmed_any = trimmed_any or n < len(shots)
+    assert trimmed_any
+
+
+def test_dataset_index(tmp_path, monkeypatch):
+    from datasets import Dataset
+
+    from mttl.datamodule.dataset_index import DatasetIndex
+
+    monkeypatch.setenv("MTTL_DATASET_INDEX_DIR", str(tmp_path))
+
+    rng = np.random.RandomState(0)
+    examples = [
+        {
+            "source": str(i),
+            "task_name": f"task{rng.randint(5)}",
+            "split": rng.choice(["train", "validation", "test"]),
+            "template_type": rng.choice(["zs_opt", "fs_opt", None]),
+        }
+        for i in range(500)
+    ]
+    dataset = Dataset.from_list(examples)
+    columns = ["task_name", "split", "template_type"]
+    index = DatasetIndex.from_dataset(dataset, columns)
+
+    assert index.values("task_name") == list(
+        dict.fromkeys(e["task_name"] for e in examples)
+    )
+    for filters in [
+        {},
+        {"task_name": ["task1"]},
+        {"task_name": ["task3", "task0"], "split": ["train"]},
+        {"split": ["validation"], "template_type": ["zs_opt", None]},
+        {"task_name": ["task7"]},
+    ]:
+        expected = [
+            i
+            for i, e in enumerate(examples)
+            if all(e[column] in values for column, values in filters.items())
+        ]
+        assert index.rows(**filters).tolist() == expected
+        assert index.select(dataset, **filters)["source"] == [str(i) for i in expected]
+
+    # the index is reused, and rebuilt for another version of the dataset
+    assert len(list(tmp_path.iterdir())) == 1
+    DatasetIndex.from_dataset(dataset, columns)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    other = dataset.map(lambda x: {"split": "train"})
+    with pytest.raises(ValueError):
+        index.select(other, task_name=["task1"])
+    other_index = DatasetIndex.from_dataset(other, columns)
+    assert len(list(tmp_path.iterdir())) == 2
+    assert other_index.rows(split=["train"]).tolist() == list(range(500))
+
+
+def test_sample_shots_small_pool():
+    from mttl.datamodule.mt_seq_to_seq_module import _sample_shots
+
+    # 17 train examples: 16 candidates for each of them, one more for the others
+    is_train = np.array([True] * 17 + [False] * 3)
+    shots = _sample_shots(np.random.RandomState(0), is_train, 16)
+    for i, row in enumerate(shots):
+        assert len(set(row)) == 16 and i not in row
+        assert all(is_train[row])
+
+    # every candidate is drawn equally often
+    counts = np.zeros(len(is_train))
+    for seed in range(200):
+        np.add.at(counts, _sample_shots(np.random.RandomState(seed), is_train, 16), 1)
+    assert np.abs(counts[:17] / counts[:17].mean() - 1).max() < 0.05
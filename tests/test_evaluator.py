@@ -1,4 +1,5 @@
 import os
+from types import SimpleNamespace
 
 import numpy as np
 import pytest
@@ -207,3 +208,260 @@ def test_runner(mocker, gpt_neo):
     assert obj_mmlu.call_count == 2
     assert "shuffle" not in obj_mmlu._mock_call_args_list[0][1]
     assert obj_mmlu._mock_call_args_list[1][1]["shuffle"]
+
+
+def test_runner_cache_and_resume(tmp_path):
+    import torch
+
+    from mttl.evaluators.base import CollatedBatches, Evaluator, EvaluatorRunner
+
+    class SumEvaluator(Evaluator):
+        def __init__(self, offset):
+            datamodule = SimpleNamespace(
+                config=SimpleNamespace(offset=offset),
+                test_dataloader=lambda subsample, shuffle: torch.utils.data.DataLoader(
+                    list(range(10)), batch_size=3, collate_fn=torch.tensor
+                ),
+            )
+            super().__init__(datamodule=datamodule)
+            self.calls = 0
+            self.fail = False
+            self.batches = None
+
+        def evaluate(self, model, split="test", subsample=-1, shuffle=False, **_):
+            self.calls += 1
+            if self.fail:
+                raise RuntimeError("interrupted")
+            self.batches = self.get_dataloader(split, subsample, shuffle)
+            weight = model.weight.sum().item()
+            return (
+                sum(b.sum().item() for b in self.batches) + self.config.offset + weight
+            )
+
+    def make_runner(prefetch=True, cache=True):
+        runner = EvaluatorRunner(
+            str(tmp_path / "out"),
+            cache_path=str(tmp_path / "out" / "cache.json") if cache else None,
+            prefetch=prefetch,
+        )
+        for i in range(4):
+            runner.add_evaluator(f"task{i}", SumEvaluator(offset=i))
+        return runner
+
+    model = torch.nn.Linear(2, 2)
+    runner = make_runner()
+    scores = runner.run(model)
+    assert [e.calls for e in runner.evaluators.values()] == [1, 1, 1, 1]
+    # batches of the next task are collated ahead of time, and stand in for the dataloader
+    batches = runner.evaluators["task1"].batches
+    assert isinstance(batches, CollatedBatches)
+    assert batches.batch_size == 3 and len(batches.dataset) == 10
+    assert scores == make_runner(prefetch=False, cache=False).run(model)
+
+    # unchanged model, everything is read from the cache
+    runner = make_runner()
+    assert runner.run(model) == scores
+    assert [e.calls for e in runner.evaluators.values()] == [0, 0, 0, 0]
+
+    # new weights, and a run interrupted at the third task
+    with torch.no_grad():
+        model.weight.add_(1.0)
+    runner = make_runner()
+    runner.evaluators["task2"].fail = True
+    with pytest.raises(RuntimeError):
+        runner.run(model)
+
+    # resuming only evaluates the remaining tasks
+    runner = make_runner()
+    new_scores = runner.run(model)
+    assert [e.calls for e in runner.evaluators.values()] == [0, 0, 1, 1]
+    assert new_scores["task0"] == pytest.approx(scores["task0"] + 4.0)
+    assert new_scores["task3"] == pytest.approx(scores["task3"] + 4.0)
+
+
+def test_runner_cache_model_settings(tmp_path):
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    from mttl.evaluators.base import Evaluator, EvaluatorRunner, weights_fingerprint
+    from mttl.models.containers.selectors.base import UniformSelectorConfig
+    from mttl.models.expert_model import MultiExpertModel, MultiExpertModelConfig
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    class CountingEvaluator(Evaluator):
+        def __init__(self):
+            super().__init__(config=SimpleNamespace())
+            self.calls = 0
+
+        def evaluate(self, model, **_):
+            self.calls += 1
+            return 1.0
+
+    def run(model):
+        runner = EvaluatorRunner(
+            cache_path=str(tmp_path / "cache.json"), prefetch=False
+        )
+        runner.add_evaluator("task", CountingEvaluator())
+        runner.run(model)
+        return runner.evaluators["task"].calls
+
+    torch.manual_seed(0)
+    model = MultiExpertModel(
+        MultiExpertModelConfig(selector_config=UniformSelectorConfig()),
+        model_object=LlamaForCausalLM(
+            LlamaConfig(
+                vocab_size=100,
+                hidden_size=32,
+                intermediate_size=64,
+                num_hidden_layers=2,
+                num_attention_heads=4,
+            )
+        ),
+        device_map="cpu",
+    )
+    lora_config = LoRAConfig(modify_layers="q_proj|v_proj", lora_init_b_random=True)
+    model.add_empty_expert("a", lora_config)
+    model.add_empty_expert("b", lora_config)
+
+    assert run(model) == 1
+    assert run(model) == 0
+
+    # same weights, another routing: the tasks are evaluated again
+    fingerprint = weights_fingerprint(model)
+    for selector in model.selectors["lora"]:
+        selector.config.lora_merge_after = True
+    assert weights_fingerprint(model) == fingerprint
+    assert run(model) == 1
+    assert run(model) == 0
+
+    model.set_selector(
+        "lora", UniformSelectorConfig(router_granularity="coarsegrained")
+    )
+    assert weights_fingerprint(model) == fingerprint
+    assert run(model) == 1
+
+
+def test_prefetch_collates_with_tokenizer_copy():
+    from concurrent.futures import ThreadPoolExecutor
+    from dataclasses import dataclass
+
+    import torch
+
+    from mttl.evaluators.base import Evaluator
+
+    @dataclass
+    class Collator:
+        tokenizer: object
+
+        def __call__(self, examples):
+            return {"tokenizer": self.tokenizer, "ids": torch.tensor(examples)}
+
+    tokenizer = SimpleNamespace(name="tokenizer")
+
+    class DummyEvaluator(Evaluator):
+        def evaluate(self, *args, **kwargs):
+            pass
+
+    evaluator = DummyEvaluator(
+        datamodule=SimpleNamespace(
+            config=SimpleNamespace(),
+            test_dataloader=lambda subsample, shuffle: torch.utils.data.DataLoader(
+                list(range(5)), batch_size=2, collate_fn=Collator(tokenizer)
+            ),
+        )
+    )
+
+    def collated_with():
+        return [
+            batch["tokenizer"] for batch in evaluator.get_dataloader("test", -1, False)
+        ]
+
+    assert collated_with() == [tokenizer] * 3
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        evaluator.prefetch(executor, "test")
+        copies = collated_with()
+        evaluator.prefetch(executor, "test")
+        assert collated_with() == copies
+
+    # the main thread keeps the tokenizer, the background collations share one copy
+    assert copies[0] is not tokenizer and copies[0] == tokenizer
+    assert all(copy is copies[0] for copy in copies)
+
+
+def test_loss_callback_keeps_batches():
+    import time
+
+    import torch
+
+    from mttl.evaluators.base import Evaluator
+    from mttl.models.lightning.callbacks import LossCallback
+
+    collated = []
+
+    def collate(examples):
+        collated.append(examples)
+        return {"x": torch.tensor(examples, dtype=torch.float)}
+
+    class Module(torch.nn.Module):
+        device = "cpu"
+
+        def forward(self, x, reduction="mean"):
+            time.sleep(0.01)
+            return x.mean()
+
+    dataloader = torch.utils.data.DataLoader(
+        list(range(10)), batch_size=2, collate_fn=collate
+    )
+    # batches are not kept by default
+    callback = LossCallback(dataloader, output_dir=None, checkpoint_oracle=False)
+    callback.test(Module())
+    callback.test(Module())
+    assert len(collated) == 10
+    collated.clear()
+
+    callback = LossCallback(
+        dataloader, output_dir=None, checkpoint_oracle=False, keep_batches=True
+    )
+    callback.on_train_start(None, None)
+    assert callback.eval_overhead == pytest.approx(0.0)
+
+    with callback.timed_evaluation():
+        loss = callback.test(Module())
+    assert loss == pytest.approx(4.5)
+    assert callback.test(Module()) == loss
+    # batches are only collated for the first evaluation
+    assert len(collated) == 5
+    assert callback.eval_overhead > 0.0
+
+    # the evaluation stops after its time budget, with at least one batch
+    callback.time_budget = 0.0
+    assert callback.test(Module()) == pytest.approx(0.5)
+    assert len(collated) == 5
+
+    # the number of batches is measured once, later evaluations use as many batches
+    class SlowModule(Module):
+        def forward(self, x, reduction="mean"):
+            time.sleep(0.1)
+            return x.mean()
+
+    callback.time_budget = 0.035
+    loss = callback.test(Module())
+    num_batches = callback.batches.num_batches
+    assert 1 < num_batches < 5
+    assert callback.test(SlowModule()) == loss
+    assert callback.batches.num_batches == num_batches
+
+    class TestEvaluator(Evaluator):
+        def evaluate(self, model, split="test", subsample=-1, shuffle=False):
+            return [
+                b["x"].tolist() for b in self.get_dataloader(split, subsample, shuffle)
+            ]
+
+    evaluator = TestEvaluator(
+        datamodule=SimpleNamespace(
+            config=None, test_dataloader=lambda subsample, shuffle: dataloader
+        )
+    )
+    evaluator.keep_batches("test", time_budget=60)
+    assert evaluator.evaluate(None) == evaluator.evaluate(None)
+    assert len(collated) == 10
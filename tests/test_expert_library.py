@@ -13,13 +13,18 @@ from huggingface_hub import (
     CommitOperationDelete,
 )
 
-from mttl.models.library.backend_engine import BlobStorageEngine, LocalFSEngine
+from mttl.models.library.backend_engine import (
+    BlobStorageEngine,
+    LocalFSEngine,
+    VirtualFSEngine,
+)
 from mttl.models.library.dataset_library import DatasetLibrary
 from mttl.models.library.expert_library import (
     BlobExpertLibrary,
     ExpertLibrary,
     HFExpertLibrary,
     LocalExpertLibrary,
+    MetadataEntry,
     VirtualLocalLibrary,
 )
 
@@ -483,7 +488,8 @@ def test_copy_library_local_to_local(tmp_path, build_meta_ckpt, setup_repo, repo
     # drop the path and keep the filenames
     base_files = {f.split("/")[-1] for f in library.list_repo_files(library.repo_id)}
     new_files = {f.split("/")[-1] for f in new_lib.list_repo_files(new_lib.repo_id)}
-    assert base_files == new_files
+    # the clone was written with a manifest, the legacy base library has none
+    assert base_files | {"library.manifest"} == new_files
 
 
 def test_get_expert_library_copy(tmp_path, build_meta_ckpt, setup_repo, repo_id):
@@ -505,7 +511,8 @@ def test_get_expert_library_copy(tmp_path, build_meta_ckpt, setup_repo, repo_id)
     # drop the path and keep the filenames
     base_files = {f.split("/")[-1] for f in library.list_repo_files(library.repo_id)}
     new_files = {f.split("/")[-1] for f in new_lib.list_repo_files(new_lib.repo_id)}
-    assert base_files == new_files
+    # the clone was written with a manifest, the legacy base library has none
+    assert base_files | {"library.manifest"} == new_files
 
 
 def test_virtual_library_is_in_memory(tmp_path, build_meta_ckpt, setup_repo, repo_id):
@@ -648,3 +655,381 @@ def test_dataset_library_kwargs(tmp_path):
 
     finally:  # Clean up. Delete the dataset from the library
         DatasetLibrary.delete_dataset(blob_dataset_id, token=token)
+
+
+@pytest.mark.parametrize(
+    "storage_dtype,tolerance,max_size_ratio",
+    [
+        ("fp32", 0.0, 1.0),
+        ("fp16", 1e-3, 0.55),
+        ("bf16", 1e-2, 0.55),
+        ("int8", 1e-2, 0.3),
+        ("nf4", 0.1, 0.2),
+    ],
+)
+def test_quantized_expert_storage(tmp_path, storage_dtype, tolerance, max_size_ratio):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    torch.manual_seed(0)
+    weights = {
+        f"layers.{i}.q_proj.lora_{side}": torch.randn(*shape)
+        for i in range(2)
+        for side, shape in [("a", (1024, 16)), ("b", (16, 1024))]
+    }
+    expert = Expert(
+        expert_info=ExpertInfo("a", expert_config=LoRAConfig(lora_rank=16)),
+        expert_weights=weights,
+    )
+    library = LocalExpertLibrary(str(tmp_path / "reference"), create=True)
+    library.add_expert(expert)
+    quantized = LocalExpertLibrary(
+        str(tmp_path / storage_dtype), create=True, storage_dtype=storage_dtype
+    )
+    quantized.add_expert(expert)
+    # the format is recorded in the metadata, and the expert is untouched
+    assert quantized.data["a"].storage_dtype == storage_dtype
+    assert expert.expert_info.expert_name == "a"
+
+    # weights come back in fp32 from a fresh library object
+    quantized = LocalExpertLibrary(str(tmp_path / storage_dtype))
+    assert quantized.data["a"].storage_dtype == storage_dtype
+    (name, loaded), *_ = quantized.items()
+    assert name == "a"
+    assert loaded.expert_weights.keys() == weights.keys()
+    for key, value in weights.items():
+        assert loaded.expert_weights[key].dtype == torch.float32
+        error = (loaded.expert_weights[key] - value).norm() / value.norm()
+        assert error <= tolerance, key
+
+    size = os.path.getsize(tmp_path / storage_dtype / "a.ckpt")
+    assert size <= max_size_ratio * os.path.getsize(tmp_path / "reference" / "a.ckpt")
+
+    # cloning keeps the format of the expert
+    clone = quantized.clone(f"local://{tmp_path / 'clone'}")
+    assert clone.data["a"].storage_dtype == storage_dtype
+
+    # other libraries store the expert in their own format
+    library.add_expert(loaded, "b")
+    assert library.data["b"].storage_dtype is None
+    size = os.path.getsize(tmp_path / "reference" / "b.ckpt")
+    assert size == os.path.getsize(tmp_path / "reference" / "a.ckpt")
+    fp16 = LocalExpertLibrary(
+        str(tmp_path / "fp16_library"), create=True, storage_dtype="fp16"
+    )
+    fp16.add_expert(loaded, "a")
+    assert fp16.data["a"].storage_dtype == "fp16"
+    library.add_expert(loaded, "c", storage_dtype="bf16")
+    assert library.data["c"].storage_dtype == "bf16"
+
+
+@pytest.mark.parametrize(
+    "library_cls,engine_cls",
+    [(LocalExpertLibrary, LocalFSEngine), (VirtualLocalLibrary, VirtualFSEngine)],
+)
+def test_library_manifest(tmp_path, monkeypatch, library_cls, engine_cls):
+    import time
+
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.library.expert_library import MANIFEST_FILE
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    repo_id = str(tmp_path / "library")
+    library = library_cls(repo_id, create=True)
+    with library.batched_commit():
+        for i in range(8):
+            library.add_expert(
+                Expert(
+                    expert_info=ExpertInfo(f"e{i}", expert_config=LoRAConfig()),
+                    expert_weights={"lora_a": torch.randn(4, 2)},
+                ),
+                update_readme=False,
+            )
+        library.add_auxiliary_data("test", "e0", {"name": "test"}, {"test": 1})
+
+    # simulate a remote backend, every read is a round trip
+    downloads = []
+    hf_hub_download = engine_cls.hf_hub_download
+
+    def slow_download(self, repo_id, filename):
+        time.sleep(0.01)
+        downloads.append(filename)
+        return hf_hub_download(self, repo_id, filename)
+
+    monkeypatch.setattr(engine_cls, "hf_hub_download", slow_download)
+
+    # opening the library reads the manifest only
+    reopened = library_cls(repo_id)
+    assert downloads == [MANIFEST_FILE]
+    assert reopened.keys() == library.keys()
+    assert reopened.data["e3"] == library.data["e3"]
+    assert reopened.list_auxiliary_data() == {"test": [1, repr({"name": "test"})]}
+    assert downloads == [MANIFEST_FILE]
+
+    # removals are reflected in the manifest
+    reopened.remove_expert("e1", soft_delete=True)
+    reopened.remove_expert("e2", soft_delete=False)
+    reopened.remove_auxiliary_data("test", "e0")
+    downloads.clear()
+    reopened = library_cls(repo_id)
+    assert downloads == [MANIFEST_FILE]
+    assert "e1" not in reopened and "e2" not in reopened and len(reopened) == 6
+    assert reopened.list_auxiliary_data() == {}
+
+    def write_metadata(metadata):
+        buffer = io.BytesIO()
+        torch.save(metadata.asdict(), buffer)
+        buffer.seek(0)
+        reopened.create_commit(
+            repo_id,
+            operations=[
+                CommitOperationAdd(
+                    path_in_repo=f"{metadata.expert_name}.meta",
+                    path_or_fileobj=buffer,
+                )
+            ],
+            commit_message="",
+        )
+
+    # a .meta file written without the manifest is picked up, opening doesn't write
+    metadata = MetadataEntry.fromdict(library.data["e3"].asdict())
+    metadata.expert_name = "e9"
+    write_metadata(metadata)
+    manifest = reopened.hf_hub_download(repo_id, MANIFEST_FILE)
+    manifest = manifest.getvalue() if isinstance(manifest, io.BytesIO) else manifest
+    for _ in range(2):
+        downloads.clear()
+        assert "e9" in library_cls(repo_id)
+        assert downloads == [MANIFEST_FILE, "e9.meta"]
+    new_manifest = reopened.hf_hub_download(repo_id, MANIFEST_FILE)
+    if isinstance(new_manifest, io.BytesIO):
+        assert new_manifest.getvalue() == manifest
+    else:
+        assert os.path.getmtime(new_manifest) == os.path.getmtime(manifest)
+
+    # a .meta file rewritten in place, to a file of the same size, is read again
+    metadata = MetadataEntry.fromdict(library.data["e3"].asdict())
+    metadata.expert_deleted = True
+    write_metadata(metadata)
+    downloads.clear()
+    assert "e3" not in library_cls(repo_id)
+    assert sorted(downloads) == ["e3.meta", "e9.meta", MANIFEST_FILE]
+
+    # once the manifest is rebuilt, only the manifest is read
+    library_cls(repo_id).rebuild_manifest()
+    downloads.clear()
+    assert len(library_cls(repo_id)) == 6
+    assert downloads == [MANIFEST_FILE]
+
+    # without a manifest, the library is rebuilt from the .meta files
+    reopened.create_commit(
+        repo_id,
+        operations=[CommitOperationDelete(path_in_repo=MANIFEST_FILE)],
+        commit_message="",
+    )
+    downloads.clear()
+    assert len(library_cls(repo_id)) == 6
+    assert len(downloads) == 8
+    assert MANIFEST_FILE not in reopened.list_repo_files(repo_id)
+
+
+@pytest.mark.parametrize(
+    "library_cls,engine_cls",
+    [(LocalExpertLibrary, LocalFSEngine), (VirtualLocalLibrary, VirtualFSEngine)],
+)
+def test_auxiliary_data_bundle(tmp_path, monkeypatch, library_cls, engine_cls):
+    import numpy as np
+
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.library.expert_library import MANIFEST_FILE
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    repo_id = str(tmp_path / "library")
+    library = library_cls(repo_id, create=True)
+    protos = {}
+    with library.batched_commit():
+        for i in range(10):
+            library.add_expert(
+                Expert(
+                    expert_info=ExpertInfo(f"e{i}", expert_config=LoRAConfig()),
+                    expert_weights={"lora_a": torch.randn(4, 2)},
+                ),
+                update_readme=False,
+            )
+            protos[f"e{i}"] = {
+                "layer0": np.random.randn(8).astype(np.float32),
+                "layer1": np.random.randn(8).astype(np.float32),
+            }
+            library.add_auxiliary_data("protos", f"e{i}", {"k": 1}, protos[f"e{i}"])
+            library.add_auxiliary_data("eigvals", f"e{i}", {"k": 1}, {"layer0": 0.5})
+
+    # one bundle per data type
+    files = library.list_repo_files(repo_id)
+    assert sorted(f for f in files if f.endswith(".bundle")) == [
+        "eigvals.00000.bundle",
+        "protos.00000.bundle",
+    ]
+    assert not any(f.endswith(".bin") for f in files)
+
+    downloads = []
+    hf_hub_download = engine_cls.hf_hub_download
+
+    def download(self, repo_id, filename):
+        downloads.append(filename)
+        return hf_hub_download(self, repo_id, filename)
+
+    monkeypatch.setattr(engine_cls, "hf_hub_download", download)
+
+    library = library_cls(repo_id)
+    downloads.clear()
+    loaded = library.get_auxiliary_data("protos")
+    assert downloads == ["protos.00000.bundle"]
+    assert loaded.keys() == protos.keys()
+    for name, value in protos.items():
+        assert isinstance(loaded[name]["layer0"], np.ndarray)
+        assert np.array_equal(loaded[name]["layer1"], value["layer1"])
+    assert library.get_auxiliary_data("eigvals", "e3") == {"layer0": 0.5}
+    config, _ = library.get_auxiliary_data("eigvals", "e3", return_config=True)
+    assert config == {"k": 1}
+    assert library.list_auxiliary_data() == {
+        "protos": [10, repr({"k": 1})],
+        "eigvals": [10, repr({"k": 1})],
+    }
+
+    # data with another config goes to a new bundle, which takes over the data of the experts it holds
+    with pytest.raises(ValueError):
+        library.add_auxiliary_data("protos", "e0", {"k": 1}, protos["e1"])
+    library.add_auxiliary_data("protos", "e0", {"k": 2}, protos["e1"], force=True)
+    assert "protos.00001.bundle" in library.list_repo_files(repo_id)
+    assert np.array_equal(
+        library.get_auxiliary_data("protos", "e0")["layer0"], protos["e1"]["layer0"]
+    )
+
+    # data that does not fit in a bundle is stored per expert
+    library.add_auxiliary_data("protos", "e2", {"k": 1}, {"layer0": "x"}, force=True)
+    assert library.get_auxiliary_data("protos", "e2") == {"layer0": "x"}
+    assert len(library.get_auxiliary_data("protos")) == 10
+
+    # bundles are deleted with the last data they hold
+    library.remove_auxiliary_data("protos", "e0")
+    assert "protos.00001.bundle" not in library.list_repo_files(repo_id)
+    library.remove_auxiliary_data("eigvals")
+    assert "eigvals.00000.bundle" not in library.list_repo_files(repo_id)
+
+    library = library_cls(repo_id)
+    assert sorted(library.get_auxiliary_data("protos")) == [
+        f"e{i}" for i in range(1, 10)
+    ]
+    assert library.list_auxiliary_data() == {"protos": [9, repr({"k": 1})]}
+
+    # without a manifest, bundles are indexed from their header
+    library.create_commit(
+        repo_id,
+        operations=[CommitOperationDelete(path_in_repo=MANIFEST_FILE)],
+        commit_message="",
+    )
+    library = library_cls(repo_id)
+    assert library.get_auxiliary_data("protos", "e2") == {"layer0": "x"}
+    assert np.array_equal(
+        library.get_auxiliary_data("protos", "e5")["layer0"], protos["e5"]["layer0"]
+    )
+
+
+def test_auxiliary_data_bundle_scalars(tmp_path):
+    from mttl.models.library.auxiliary_bundle import decode_bundle, encode_bundle
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    # floats are stored as doubles
+    entries = {"e0": {"score": 0.123456789012345}, "e1": {"score": 1e-300}}
+    data, _ = decode_bundle(encode_bundle(entries, {}))
+    assert data == entries
+
+    # ints beyond int64 are not bundled, and are stored per expert
+    with pytest.raises(ValueError):
+        encode_bundle({"e0": {"count": 2**64}}, {})
+    with pytest.raises(ValueError):
+        encode_bundle({"e0": {"count": 1}, "e1": {"count": -(2**70)}}, {})
+
+    library = LocalExpertLibrary(str(tmp_path / "library"), create=True)
+    for i in range(2):
+        library.add_expert(
+            Expert(
+                expert_info=ExpertInfo(f"e{i}", expert_config=LoRAConfig()),
+                expert_weights={"lora_a": torch.randn(4, 2)},
+            )
+        )
+    with library.batched_commit():
+        for name, value in entries.items():
+            library.add_auxiliary_data("scores", name, {}, value)
+    library.add_auxiliary_data("counts", "e0", {}, {"count": 2**64})
+
+    library = LocalExpertLibrary(str(tmp_path / "library"))
+    assert library.get_auxiliary_data("scores") == entries
+    assert library.get_auxiliary_data("counts", "e0") == {"count": 2**64}
+
+
+@pytest.mark.parametrize("library_cls", [LocalExpertLibrary, VirtualLocalLibrary])
+def test_auxiliary_data_bundle_appends(tmp_path, library_cls, monkeypatch):
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    repo_id = str(tmp_path / "library")
+    library = library_cls(repo_id, create=True)
+    with library.batched_commit():
+        for i in range(4):
+            library.add_expert(
+                Expert(
+                    expert_info=ExpertInfo(f"e{i}", expert_config=LoRAConfig()),
+                    expert_weights={"lora_a": torch.randn(4, 2)},
+                ),
+                update_readme=False,
+            )
+
+    def bundles():
+        return sorted(
+            f for f in library.list_repo_files(repo_id) if f.endswith(".bundle")
+        )
+
+    # data added one expert at a time goes to the current bundle
+    protos = {f"e{i}": {"layer0": torch.randn(8)} for i in range(4)}
+    for i in range(3):
+        library.add_auxiliary_data("protos", f"e{i}", {"k": 1}, protos[f"e{i}"])
+    assert len(bundles()) == 1
+    library.add_auxiliary_data("protos", "e0", {"k": 1}, protos["e3"], force=True)
+    assert len(bundles()) == 1
+    loaded = library_cls(repo_id).get_auxiliary_data("protos")
+    assert sorted(loaded) == ["e0", "e1", "e2"]
+    assert torch.equal(loaded["e0"]["layer0"], protos["e3"]["layer0"])
+    assert torch.equal(loaded["e2"]["layer0"], protos["e2"]["layer0"])
+
+    # a new config, or a new layout, starts a new bundle
+    library.add_auxiliary_data("protos", "e3", {"k": 2}, protos["e3"])
+    library.add_auxiliary_data("protos", "e1", {"k": 2}, {"layer1": 1.0}, force=True)
+    assert len(bundles()) == 3
+    assert library_cls(repo_id).get_auxiliary_data("protos", "e1") == {"layer1": 1.0}
+
+    # data added earlier in a transaction is checked for duplicates, and replaced
+    with library.batched_commit():
+        library.add_auxiliary_data("scores", "e0", {"k": 1}, protos["e0"])
+        with pytest.raises(ValueError):
+            library.add_auxiliary_data("scores", "e0", {"k": 1}, protos["e1"])
+        library.add_auxiliary_data("scores", "e0", {"k": 2}, protos["e1"], force=True)
+    config, data = library_cls(repo_id).get_auxiliary_data(
+        "scores", "e0", return_config=True
+    )
+    assert config == {"k": 2}
+    assert torch.equal(data["layer0"], protos["e1"]["layer0"])
+    assert [f for f in bundles() if f.startswith("scores")] == ["scores.00000.bundle"]
+
+    # bundles stop being rewritten once they are full
+    monkeypatch.setattr(library, "_bundle_rewrite_max_experts", 2)
+    for i in range(4):
+        library.add_auxiliary_data("capped", f"e{i}", {"k": 1}, protos[f"e{i}"])
+    assert [f for f in bundles() if f.startswith("capped")] == [
+        "capped.00001.bundle",
+        "capped.00003.bundle",
+    ]
+    loaded = library_cls(repo_id).get_auxiliary_data("capped")
+    assert sorted(loaded) == ["e0", "e1", "e2", "e3"]
+    assert all(torch.equal(loaded[n]["layer0"], protos[n]["layer0"]) for n in loaded)
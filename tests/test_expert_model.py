@@ -343,5 +343,93 @@ def test_save_load(tmp_path):
     assert model.config == new_model.config
 
 
+@pytest.mark.parametrize("max_shard_size", ["5GB", "1MB"])
+def test_merge_and_save_base_model(tmp_path, make_tiny_llama, max_shard_size):
+    import copy
+
+    import torch
+
+    from mttl.models.modifiers.base import MergeableModifierMixin
+
+    seed_everything(0)
+    config = LoRAConfig(
+        modify_layers="k_proj|v_proj|q_proj|o_proj",
+        lora_rank=4,
+        lora_init_b_random=True,
+    )
+
+    def reference(model, path):
+        # merge on a copy of the model, and save it with `save_pretrained`
+        model_copy = copy.deepcopy(model)
+        for module in model_copy.modules():
+            for c_name, child in module.named_children():
+                if isinstance(child, MergeableModifierMixin):
+                    child.merge_with_layer()
+                    setattr(module, c_name, child.layer)
+                elif isinstance(child, LoRAExpertContainer):
+                    if "a" in child.expert_infos:
+                        child.merge_expert("a")
+                    setattr(module, c_name, child.layer)
+        model_copy.save_pretrained(path)
+        return AutoModelForCausalLM.from_pretrained(path).state_dict()
+
+    def check(reference_state_dict, path):
+        state_dict = AutoModelForCausalLM.from_pretrained(path).state_dict()
+        assert state_dict.keys() == reference_state_dict.keys()
+        for key, value in reference_state_dict.items():
+            assert torch.equal(state_dict[key], value), key
+
+    model = ExpertModel(
+        ExpertModelConfig(modifier_config=config),
+        model_object=make_tiny_llama(),
+        device_map="cpu",
+    )
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    model.merge_and_save_base_model(tmp_path / "merged", max_shard_size=max_shard_size)
+    check(reference(model.model, tmp_path / "reference"), tmp_path / "merged")
+    # the model itself is left untouched
+    for key, value in model.state_dict().items():
+        assert torch.equal(state_dict[key], value)
+    assert not any(m.merged_with_layer for m in model.modifiers)
+
+    model = MultiExpertModel(
+        MultiExpertModelConfig(), model_object=make_tiny_llama(), device_map="cpu"
+    )
+    model.add_empty_expert("a", config)
+    model.add_empty_expert("b", config)
+    model.merge_and_save_base_model(
+        tmp_path / "merged_a", "a", max_shard_size=max_shard_size
+    )
+    check(reference(model.model, tmp_path / "reference_a"), tmp_path / "merged_a")
+    assert len(model.experts_containers[0].expert_infos) == 2
+
+
+def test_merge_drops_non_mergeable_modifiers(tmp_path, make_tiny_llama, monkeypatch):
+    import torch
+
+    from mttl.models import utils
+    from mttl.models.modifiers.ia3 import IA3
+    from mttl.models.utils import save_merged_checkpoint
+
+    model = make_tiny_llama()
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    attention = model.model.layers[0].self_attn
+    attention.q_proj = IA3(None, attention.q_proj)
+
+    with pytest.raises(ValueError):
+        save_merged_checkpoint(model, tmp_path / "strict")
+
+    warnings = []
+    monkeypatch.setattr(utils.logger, "warning", warnings.append)
+    save_merged_checkpoint(model, tmp_path / "merged", strict=False)
+
+    # the layer is saved without its modifier, and the dropped modifier is reported
+    merged = AutoModelForCausalLM.from_pretrained(tmp_path / "merged").state_dict()
+    assert merged.keys() == state_dict.keys()
+    for key, value in state_dict.items():
+        assert torch.equal(merged[key], value), key
+    assert len(warnings) == 1 and "model.layers.0.self_attn.q_proj" in warnings[0]
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -212,6 +212,68 @@ def test_hard_prompt(padding_side, dm_batch):
         assert torch.all(target_ids == target_ids_true)
 
 
+def test_hard_prompt_mixed_lengths_cached(dm_batch):
+    tokenizer = get_tokenizer_with_args(
+        "EleutherAI/gpt-neo-125m",
+        model_family="gpt",
+        padding_side="right",
+    )
+    config = HardPromptConfig(
+        max_input_length=1024, model_family="gpt", tokenizer=tokenizer
+    )
+    prompt1 = HardPrompt(config, prompt_init="This is a much longer test prompt")
+    prompt2 = HardPrompt(config, prompt_init="Test")
+
+    batch = dm_batch(padding_side="right")
+    inputs_and_prompts, attn_masks, labels_and_prompts = HardPrompt.parallel_forward(
+        [prompt1, prompt2], **batch
+    )
+    assert tokenizer.batch_decode(inputs_and_prompts, skip_special_tokens=True) == [
+        "This is a much longer test prompt\nThis is a dev sentence a",
+        "Test\nThis is dev b",
+    ]
+    n_tokens = attn_masks.sum(1)
+    for i in range(2):
+        assert attn_masks[i, : n_tokens[i]].all()
+        assert not attn_masks[i, n_tokens[i] :].any()
+
+    # prompts are tokenized once and kept on the device of the inputs
+    device = batch["input_ids"].device
+    prompt_ids = prompt1.prompt_ids(device)
+    HardPrompt.parallel_forward([prompt2, prompt1], **batch)
+    assert prompt1.prompt_ids(device) is prompt_ids
+
+
+def test_hard_prompt_cache_per_tokenizer():
+    tokenizer = get_tokenizer_with_args(
+        "EleutherAI/gpt-neo-125m",
+        model_family="gpt",
+        padding_side="right",
+    )
+    other_tokenizer = get_tokenizer_with_args(
+        "EleutherAI/gpt-neo-125m",
+        model_family="gpt",
+        padding_side="right",
+    )
+    other_tokenizer.add_tokens(["Test"])
+
+    prompts = [
+        HardPrompt(
+            HardPromptConfig(
+                max_input_length=1024, model_family="gpt", tokenizer=tokenizer
+            ),
+            prompt_init="Test",
+        )
+        for tokenizer in [tokenizer, other_tokenizer]
+    ]
+    padded_ids = HardPrompt._padded_prompts(prompts[:1], "cpu")[0]
+    other_padded_ids = HardPrompt._padded_prompts(prompts[1:], "cpu")[0]
+
+    # the same prompt, tokenized by another tokenizer, is not read from the cache
+    assert other_padded_ids[0, 0] == len(other_tokenizer) - 1
+    assert not torch.equal(padded_ids, other_padded_ids)
+
+
 def test_hard_prompt_eval(dm_batch):
     model = AutoModelForCausalLM.from_pretrained("EleutherAI/gpt-neo-125m")
     tokenizer = get_tokenizer_with_args(
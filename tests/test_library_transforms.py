@@ -1,5 +1,6 @@
 # unit test for adapter_ranker
 import copy
+import hashlib
 import logging
 from collections import OrderedDict
 
@@ -233,6 +234,94 @@ def test_hidden_state_transform(tiny_flan, tmp_path, create_dummy_expert, monkey
     assert model.selectors["lora"][0].prototypes.shape[1] == 768
 
 
+@pytest.mark.parametrize("use_base_model_only", [False, True])
+def test_hidden_state_transform_per_expert(
+    tiny_flan, tmp_path, create_dummy_expert, monkeypatch, use_base_model_only
+):
+    from mttl.datamodule.base import get_datamodule
+    from mttl.models.utils import transfer_batch_to_device
+
+    monkeypatch.setenv("WANDB_MODE", "disabled")
+
+    _, dataset_id = tiny_flan
+
+    config = ExpertConfig(
+        **{
+            "model_modifier": "lora",
+            "lora_rank": 4,
+            "modify_layers": "k_proj|v_proj|q_proj|o_proj",
+            "trainable_param_names": ".*lora_[ab].*",
+            "output_dir": tmp_path,
+            "precision": "32",
+            "model": "EleutherAI/gpt-neo-125m",
+            "dataset": dataset_id,
+            "device_map": "cpu",
+            "dataset_type": "flan",
+            "lora_init_b_random": True,
+        }
+    )
+
+    library = LocalExpertLibrary(tmp_path)
+    # a multi-task expert, and two experts trained on the same task
+    for expert_name, task_name in [
+        ("creak", "cot_creak"),
+        ("creak_ecqa", "cot_creak,cot_ecqa"),
+        ("creak_ii", "cot_creak_ii"),
+        ("creak_copy", "cot_creak"),
+    ]:
+        config.finetune_task_name = task_name
+        library.add_expert(create_dummy_expert(config, expert_name))
+
+    hc = HiddenStateComputer(
+        HiddenStateComputerConfig(
+            use_base_model_only=use_base_model_only,
+            max_samples_per_task=2,
+            track="last_layer",
+            pool="mean",
+        )
+    )
+    output = hc.transform(library, recompute=True, default_args=config, device="cpu")
+
+    # reference: a model per expert, run on a sample of the tasks of the expert
+    for expert_name, expert in library.items():
+        training_config = ExpertConfig.from_dict(expert.training_config)
+        hc._update_args(training_config, config)
+        model = MultiExpertModel(
+            MultiExpertModelConfig(base_model=training_config.model),
+            device_map="cpu",
+        )
+        if not use_base_model_only:
+            model.add_expert_instance(expert, is_default=True)
+        hc._track_hidden_states(model)
+
+        train_tasks = expert.expert_info.expert_task_name.split(",")
+        training_config.dataset = expert.expert_info.dataset
+        training_config.finetune_task_name = ",".join(train_tasks)
+        training_config.subsample_train = 2 * len(train_tasks)
+        training_config.train_batch_size = config.predict_batch_size
+
+        centroid, count = 0.0, 0
+        for batch in get_datamodule(training_config).train_dataloader():
+            batch = transfer_batch_to_device(batch, "cpu")
+            with torch.no_grad():
+                model.forward(**batch)
+            hidden_state = hc._retrieve_hidden_states(model)["last_layer"]
+            mask = batch["attention_mask"].unsqueeze(-1)
+            centroid += ((hidden_state * mask).sum(1) / mask.sum(1)).sum(0)
+            count += hidden_state.size(0)
+        expected = torch.nn.functional.normalize(centroid / count, p=2, dim=-1)
+
+        assert torch.allclose(output[expert_name]["last_layer"], expected, atol=1e-5)
+
+    same_task = torch.allclose(
+        output["creak"]["last_layer"], output["creak_copy"]["last_layer"]
+    )
+    assert same_task == use_base_model_only
+    assert not torch.allclose(
+        output["creak"]["last_layer"], output["creak_ecqa"]["last_layer"]
+    )
+
+
 def test_compute_svd_embeddings():
     from mttl.models.library.library_transforms import (
         SVDEmbeddingTransform,
@@ -248,6 +337,114 @@ def test_compute_svd_embeddings():
     assert embeddings["abstract_algebra"].shape[0] == 2
 
 
+def test_svd_embeddings_sketch_and_fold_in(tmp_path):
+    import sklearn.decomposition
+
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.library.library_transforms import (
+        SVDEmbeddingTransform,
+        SVDEmbeddingTransformConfig,
+    )
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    rng = torch.Generator().manual_seed(0)
+    basis = torch.randn(3, 2 * 64 * 32, generator=rng)
+
+    def make_expert(i):
+        flat = torch.randn(3, generator=rng) @ basis
+        flat += 0.1 * torch.randn(basis.shape[1], generator=rng)
+        lora_a, lora_b = flat.split(64 * 32)
+        return Expert(
+            expert_info=ExpertInfo(
+                expert_name=f"expert_{i}",
+                expert_task_name=f"task_{i}",
+                expert_config=LoRAConfig(),
+            ),
+            expert_weights={
+                "layer.lora_a": lora_a.view(64, 32),
+                "layer.lora_b": lora_b.view(32, 64),
+            },
+        )
+
+    library = LocalExpertLibrary(tmp_path)
+    for i in range(8):
+        library.add_expert(make_expert(i))
+
+    # reference: exact quantiles and SVD of the dense (n_experts, D) matrix
+    array = np.stack(
+        [
+            torch.nn.utils.parameters_to_vector(
+                [p for _, p in sorted(library[name].expert_weights.items())]
+            ).numpy()
+            for name in library.keys()
+        ]
+    )
+    thr = np.quantile(np.abs(array), 0.8, axis=1)
+    array[np.abs(array) <= thr.reshape(-1, 1)] = 0.0
+    reference = sklearn.decomposition.TruncatedSVD(
+        n_components=3, n_oversamples=10, random_state=0, tol=0.0
+    ).fit_transform(array)
+    reference = reference / np.linalg.norm(reference, 2, axis=1)[:, None]
+
+    def cos_sim(embeddings):
+        embeddings = np.stack([embeddings[name] for name in library.keys()])
+        return embeddings @ embeddings.T
+
+    # embeddings are exact by default, and keep the names they had before sketching
+    exact_config = SVDEmbeddingTransformConfig(n_components=3)
+    assert exact_config.save_name == "svdembeddingtransformconfig-" + (
+        hashlib.md5(str(("", 3, 0.8)).encode()).hexdigest()
+    )
+    exact = SVDEmbeddingTransform(exact_config, random_state=0).transform(
+        library, persist=False, recompute=True
+    )
+    assert np.allclose(cos_sim(exact), reference @ reference.T, atol=1e-4)
+
+    sketch_config = SVDEmbeddingTransformConfig(
+        name="svd", n_components=3, sketch_dim=2048, quantile_sample_size=2048
+    )
+    sketched = SVDEmbeddingTransform(sketch_config, random_state=0).transform(
+        library, persist=True, recompute=True
+    )
+    assert np.abs(cos_sim(sketched) - reference @ reference.T).max() < 0.1
+
+    # a new expert is projected on the persisted factors, others are left untouched
+    new_expert = library["expert_3"]
+    new_expert.expert_info = ExpertInfo(
+        expert_name="expert_8",
+        expert_task_name="task_8",
+        expert_config=LoRAConfig(),
+    )
+    library.add_expert(new_expert)
+    folded = SVDEmbeddingTransform(sketch_config, random_state=0).transform(
+        library, persist=True
+    )
+    assert len(folded) == 9
+    for name in sketched:
+        assert np.allclose(folded[name], sketched[name])
+    assert np.allclose(folded["expert_8"], sketched["expert_3"], atol=1e-5)
+    assert len(library.get_auxiliary_data(sketch_config.save_name)) == 9
+
+    # factors computed with other settings are not reused
+    new_expert.expert_info = ExpertInfo(
+        expert_name="expert_9",
+        expert_task_name="task_9",
+        expert_config=LoRAConfig(),
+    )
+    library.add_expert(new_expert)
+    other_config = SVDEmbeddingTransformConfig(
+        name="svd", n_components=3, sketch_dim=1024, quantile_sample_size=2048
+    )
+    recomputed = SVDEmbeddingTransform(other_config, random_state=0).transform(
+        library, persist=False
+    )
+    expected = SVDEmbeddingTransform(other_config, random_state=0).transform(
+        library, persist=False, recompute=True
+    )
+    for name in library.keys():
+        assert np.allclose(recomputed[name], expected[name])
+
+
 def test_mbc_clustering(tmp_path):
     library = HFExpertLibrary("sordonia/new-test-library")
     k = 2
@@ -261,6 +458,74 @@ def test_mbc_clustering(tmp_path):
     assert len(clusters) == k
 
 
+def test_mbc_spherical_clustering_incremental(tmp_path, monkeypatch):
+    from mttl.models.library import library_transforms
+    from mttl.models.library.expert import Expert, ExpertInfo
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    rng = np.random.RandomState(0)
+    centers = rng.randn(3, 16)
+    library = LocalExpertLibrary(tmp_path)
+
+    def add_expert(i, cluster):
+        library.add_expert(
+            Expert(
+                expert_info=ExpertInfo(
+                    expert_name=f"expert_{i}",
+                    expert_task_name=f"task_{i}",
+                    expert_config=LoRAConfig(),
+                ),
+                expert_weights={"layer.lora_a": torch.zeros(1)},
+            )
+        )
+        # precomputed embeddings, shared by the clustering transform name
+        library.add_auxiliary_data(
+            data_type="mbc_test",
+            expert_name=f"expert_{i}",
+            config={},
+            data=centers[cluster] + 0.1 * rng.randn(16),
+        )
+
+    for i in range(30):
+        add_expert(i, i % 3)
+
+    transform = MBCWithCosSimTransform(
+        MBClusteringTransformConfig(
+            name="mbc_test", k=3, random_state=42, clustering="spherical"
+        )
+    )
+    clusters = transform.transform(library, persist=True)
+    assert sorted(sorted(c) for c in clusters.values()) == sorted(
+        sorted(f"expert_{i}" for i in range(j, 30, 3)) for j in range(3)
+    )
+
+    # new experts are assigned to the persisted centroids, without reclustering
+    def fail(*args, **kwargs):
+        raise AssertionError("should not recluster")
+
+    monkeypatch.setattr(library_transforms, "spherical_kmeans", fail)
+    add_expert(30, 1)
+    new_clusters = transform.transform(library, persist=True)
+    assert len(new_clusters) == 3
+    assert any({"expert_1", "expert_30"} <= set(c) for c in new_clusters.values())
+    assert len(transform.fetch_clusters(library)["assignments"]) == 31
+
+    # the stored clusters are not reused for another k, or once embeddings changed
+    monkeypatch.undo()
+    transform.config.k = 2
+    assert len(transform.transform(library)) == 2
+    transform.config.k = 3
+    library.add_auxiliary_data(
+        data_type="mbc_test",
+        expert_name="expert_0",
+        config={},
+        data=centers[2] + 0.1 * rng.randn(16),
+        force=True,
+    )
+    clusters = transform.transform(library)
+    assert any({"expert_0", "expert_2"} <= set(c) for c in clusters.values())
+
+
 def test_weighted_merge():
     library = HFExpertLibrary("sordonia/new-test-library")
 
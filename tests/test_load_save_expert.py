@@ -66,3 +66,63 @@ def test_load_model(tmp_path, tiny_llama):
     assert isinstance(reloaded.selector_config, PolySelectorConfig)
     assert len(reloaded.experts_names) == 1
     assert "b" in reloaded.experts_names
+
+
+def test_async_trainable_checkpoint(tmp_path):
+    from types import SimpleNamespace
+
+    import torch
+
+    from mttl.models.lightning.callbacks import LiveCheckpointCallback
+
+    class Module(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.base = torch.nn.Linear(64, 64)
+            self.base.requires_grad_(False)
+            self.adapter = torch.nn.Linear(64, 2)
+            self.hparams = {"expert_name": "a"}
+
+    module = Module()
+    optimizer = torch.optim.Adam(module.adapter.parameters())
+    module.adapter(torch.randn(3, 64)).sum().backward()
+    optimizer.step()
+
+    trainer = SimpleNamespace(
+        world_size=1,
+        lightning_module=module,
+        current_epoch=0,
+        global_step=1,
+        optimizers=[optimizer],
+        lr_scheduler_configs=[],
+    )
+    callback = LiveCheckpointCallback(
+        str(tmp_path),
+        monitor="val/loss",
+        save_weights_only=False,
+        trainable_only=True,
+        keep_best_k=2,
+    )
+
+    for step, loss in enumerate([3.0, 2.0, 2.5, 1.0]):
+        trainer.global_step = step + 1
+        callback.on_log(trainer, module, "val/loss", torch.tensor(loss))
+        # training goes on while the checkpoint is written
+        with torch.no_grad():
+            module.adapter.weight.add_(1.0)
+    callback.on_train_end(trainer, module)
+
+    files = sorted(p.name for p in tmp_path.iterdir())
+    assert len(files) == 3 and "last.ckpt" in files
+    assert any("value_1.0000_step_4" in f for f in files)
+    assert any("value_2.0000_step_2" in f for f in files)
+
+    checkpoint = torch.load(callback.best_model_path, weights_only=False)
+    assert set(checkpoint["state_dict"]) == {"adapter.weight", "adapter.bias"}
+    assert checkpoint["hyper_parameters"] == {"expert_name": "a"}
+    assert checkpoint["global_step"] == 4
+    assert len(checkpoint["optimizer_states"][0]["state"]) == 2
+    # the snapshot is taken before the following update
+    assert torch.allclose(
+        checkpoint["state_dict"]["adapter.weight"] + 1.0, module.adapter.weight
+    )
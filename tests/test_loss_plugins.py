@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+
+from mttl.models.loss_plugins import (
+    ModuleSparsityPlugin,
+    OrthoRegularizationPlugin,
+    TaskPredictionPlugin,
+)
+
+
+def make_model(adapters=None, selectors=None):
+    return SimpleNamespace(
+        model=SimpleNamespace(
+            get_adapters=lambda: adapters, get_selectors=lambda: selectors
+        ),
+        get_selectors=lambda: selectors,
+    )
+
+
+def grads(loss, params):
+    return torch.autograd.grad(loss, params)
+
+
+@pytest.mark.parametrize(
+    "shape_a,shape_b",
+    [((4, 2, 16, 3), (4, 2, 3, 16)), ((4, 1, 16), (4, 2, 3, 16)), ((4, 3, 16), None)],
+)
+def test_ortho_regularization(shape_a, shape_b):
+    torch.manual_seed(0)
+    adapters = {}
+    for i in range(5):
+        adapters[f"layer{i}"] = SimpleNamespace(
+            lora_a=nn.Parameter(torch.randn(shape_a))
+        )
+        if shape_b is not None:
+            adapters[f"layer{i}"].lora_b = nn.Parameter(torch.randn(shape_b))
+
+    plugin = OrthoRegularizationPlugin(make_model(adapters=adapters))
+    params = [p for _, p in plugin.params]
+    loss = plugin.compute_loss()
+
+    # one parameter at a time
+    expected = sum(plugin.orthogonal_loss_fn(p) for p in plugin.params) / len(params)
+    assert torch.allclose(loss, expected)
+    for grad, expected_grad in zip(grads(loss, params), grads(expected, params)):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
+
+
+def test_selector_plugins():
+    torch.manual_seed(0)
+    selectors = {
+        f"layer{i}": SimpleNamespace(module_logits=nn.Parameter(torch.randn(6, 8)))
+        for i in range(5)
+    }
+    model = make_model(selectors=selectors)
+    module_logits = [s.module_logits for s in selectors.values()]
+    batch = {"task_ids": torch.tensor([0, 3, 3, 5])}
+
+    plugin = TaskPredictionPlugin(model, detach=False)
+    loss = plugin.compute_loss(model, batch)
+    expected = sum(
+        plugin.loss_fn(
+            plugin.predictor(torch.sigmoid(l[batch["task_ids"]])), batch["task_ids"]
+        )
+        for l in module_logits
+    ) / len(module_logits)
+    assert torch.allclose(loss, expected)
+    for grad, expected_grad in zip(
+        grads(loss, module_logits), grads(expected, module_logits)
+    ):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
+
+    plugin = ModuleSparsityPlugin(model)
+    loss = plugin.compute_loss(model, batch)
+    expected = 0.0
+    for l in module_logits:
+        probs = torch.sigmoid(l[batch["task_ids"]])
+        expected += torch.relu(probs.abs().mean(-1) - 1.0 / probs.size(-1)).mean()
+    expected = expected / len(module_logits)
+    assert torch.allclose(loss, expected)
+    for grad, expected_grad in zip(
+        grads(loss, module_logits), grads(expected, module_logits)
+    ):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
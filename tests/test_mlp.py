@@ -0,0 +1,66 @@
+import pytest
+import torch
+from torch import nn
+
+from mttl.models.modifiers.mlp import MLPConfig, MLPModifier
+
+
+@pytest.mark.parametrize("input_shape", [(6, 16), (6, 5, 16)])
+def test_mlp_parallel_linear_forward(input_shape):
+    torch.manual_seed(0)
+
+    layer = nn.Linear(16, 16)
+    mlps = [MLPModifier(MLPConfig(n_embd=16), layer) for _ in range(3)]
+
+    input = torch.randn(*input_shape)
+    # mixed experts per batch, with one expert that is not used
+    batch_mlps = [mlps[0], mlps[2], mlps[0], mlps[0], mlps[2], mlps[0]]
+
+    expected = torch.stack(
+        [mlp(example) for mlp, example in zip(batch_mlps, input)], dim=0
+    )
+    output = MLPModifier.parallel_linear_forward(input, batch_mlps)
+    assert output.shape == input.shape
+    assert torch.allclose(output, expected, atol=1e-5)
+
+    # single mlp for the whole batch
+    output = MLPModifier.parallel_linear_forward(input, [mlps[1]])
+    assert torch.allclose(output, mlps[1](input), atol=1e-5)
+
+    with pytest.raises(ValueError):
+        MLPModifier.parallel_linear_forward(input, mlps[:2])
+
+
+def test_mlp_grouped_forward_cache_and_skew():
+    torch.manual_seed(0)
+
+    layer = nn.Linear(16, 16)
+    mlps = [MLPModifier(MLPConfig(n_embd=16), layer) for _ in range(3)]
+    input = torch.randn(8, 5, 16)
+
+    def check(batch_mlps):
+        expected = torch.stack(
+            [mlp(example) for mlp, example in zip(batch_mlps, input)], dim=0
+        )
+        output = MLPModifier.parallel_linear_forward(input, batch_mlps)
+        assert torch.allclose(output, expected, atol=1e-5)
+        return output
+
+    # without gradients, the stacked weights are reused until a weight changes
+    batch_mlps = [mlps[0], mlps[1], mlps[2], mlps[1]] * 2
+    with torch.no_grad():
+        check(batch_mlps)
+        banks = MLPModifier._stacked_weights(mlps)
+        assert MLPModifier._stacked_weights(mlps) is banks
+        mlps[1].mod_fc2.weight.add_(1.0)
+        assert MLPModifier._stacked_weights(mlps) is not banks
+        check(batch_mlps)
+
+    # with gradients, the weights of every mlp receive their gradient
+    check(batch_mlps).sum().backward()
+    assert all(mlp.mod_fc1.weight.grad is not None for mlp in mlps)
+
+    # skewed batches are not padded to the largest group
+    skewed_mlps = [mlps[0]] * 6 + [mlps[1], mlps[2]]
+    with torch.no_grad():
+        check(skewed_mlps)
@@ -0,0 +1,85 @@
+import copy
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.arguments import ExpertConfig
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.get_optimizer import get_optimizer
+from mttl.models.modifiers.lora import LoRAConfig
+
+
+def make_lora_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    return ExpertModel(
+        ExpertModelConfig(
+            modifier_config=LoRAConfig(
+                modify_layers="q_proj|v_proj|up_proj", lora_init_b_random=True
+            )
+        ),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+
+
+@pytest.mark.parametrize("optimizer", ["adamw", "adam", "sgd"])
+def test_flat_buffers(optimizer):
+    args = ExpertConfig(
+        optimizer=optimizer,
+        trainable_param_names=".*lora.*",
+        learning_rate=1e-2,
+        weight_decay=0.1,
+    )
+    model = make_lora_model()
+    optim, _ = get_optimizer(model, args, no_decay=["lora_b"])
+
+    flat_model = make_lora_model()
+    args.optimizer_flat_buffers = True
+    flat_optim, trainable = get_optimizer(flat_model, args, no_decay=["lora_b"])
+    # one buffer per param group
+    assert [len(g["params"]) for g in flat_optim.param_groups] == [1, 1]
+    assert sum(g["params"][0].numel() for g in flat_optim.param_groups) == sum(
+        p.numel() for n, p in flat_model.named_parameters() if n in trainable
+    )
+
+    input_ids = torch.randint(0, 100, (2, 8))
+    for step in range(3):
+        for m, o in [(model, optim), (flat_model, flat_optim)]:
+            o.zero_grad()
+            for _ in range(2):
+                m.forward(input_ids=input_ids, labels=input_ids).loss.backward()
+            torch.nn.utils.clip_grad_norm_(
+                [p for g in o.param_groups for p in g["params"]], 0.1
+            )
+            o.step()
+        # gradients released by the module are restored by the optimizer
+        flat_model.zero_grad()
+
+    state_dict, flat_state_dict = model.state_dict(), flat_model.state_dict()
+    assert state_dict.keys() == flat_state_dict.keys()
+    for name, value in flat_state_dict.items():
+        assert torch.allclose(state_dict[name], value, atol=1e-6), name
+        # views of the buffers are not saved with the whole buffer
+        if name in trainable:
+            assert value.untyped_storage().nbytes() == value.numel() * 4
+
+    # checkpoints of the model and of the optimizer load back into flat buffers
+    new_model = make_lora_model()
+    new_optim, _ = get_optimizer(new_model, args, no_decay=["lora_b"])
+    new_model.load_state_dict(flat_state_dict)
+    # the loaded state shares its tensors with the state dict
+    new_optim.load_state_dict(copy.deepcopy(flat_optim.state_dict()))
+    for m, o in [(flat_model, flat_optim), (new_model, new_optim)]:
+        o.zero_grad()
+        m.forward(input_ids=input_ids, labels=input_ids).loss.backward()
+        o.step()
+    for (name, p), new_p in zip(flat_model.named_parameters(), new_model.parameters()):
+        assert torch.equal(p, new_p), name
@@ -1,6 +1,8 @@
-from mttl.models.containers.peer_container import PEERMLPContainer
+from mttl.models.containers.peer_container import PEERDownProjection, PEERMLPContainer
 import numpy as np
 import pytest
+import torch
+import torch.nn.functional as F
 
 from mttl.arguments import MoEExpertConfig
 from mttl.models.expert_model import MoEModel, MoEModelConfig
@@ -21,5 +23,46 @@ def test_peer_moe(tmp_peer_moe_config, dummy_batch):
     assert isinstance(module.experts_containers[0], PEERMLPContainer)
 
 
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 10])
+def test_peer_down_projection_gradcheck(chunk_size):
+    torch.manual_seed(0)
+    input = torch.randn(5, 4, dtype=torch.double, requires_grad=True)
+    weight = torch.randn(9, 4, dtype=torch.double, requires_grad=True)
+    # repeated experts, within and across tokens
+    indices = torch.randint(9, (5, 3))
+    indices[0, 1] = indices[0, 0]
+
+    assert torch.autograd.gradcheck(
+        lambda input, weight: PEERDownProjection.apply(
+            input, indices, weight, chunk_size
+        ),
+        (input, weight),
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 6, 7, 64])
+def test_peer_down_projection_matches_einsum(chunk_size):
+    torch.manual_seed(0)
+    # b, s, heads, experts as given by the selector, 12 tokens
+    b, s, h, e, d = 2, 6, 2, 3, 8
+    input = torch.randn(b, s, d, requires_grad=True)
+    weight = torch.randn(16, d, requires_grad=True)
+    indices = torch.randint(16, (b, s, h, e))
+    grad_output = torch.randn(b, s, h, e)
+
+    # previous implementation, gathering the expert weights of every token
+    expected = torch.einsum("bsd,bshed->bshe", input, F.embedding(indices, weight))
+    expected_grads = torch.autograd.grad(expected, [input, weight], grad_output)
+
+    output = PEERDownProjection.apply(
+        input.reshape(b * s, d), indices.reshape(b * s, -1), weight, chunk_size
+    ).view(b, s, h, e)
+    grads = torch.autograd.grad(output, [input, weight], grad_output)
+
+    assert torch.allclose(output, expected, atol=1e-5)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-5)
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -159,3 +159,39 @@ def test_suffix_prompt_tuning():
         output = new_model(**batch)
         loss = masked_cross_entropy(output.logits, labels, batch["attention_mask"])
         assert round(loss.item(), 4) == 0.7495
+
+
+def test_extended_embedding_and_linear():
+    from types import SimpleNamespace
+
+    from mttl.models.modifiers.prompt_tuning import ExtendedLinear
+
+    seed_everything(0)
+    config = SimpleNamespace(soft_prompt_length=3, n_skills=3)
+
+    embedding = torch.nn.Embedding(20, 8)
+    extended = ExtendedEmbedding(config, embedding)
+    extended.new_embeds.data.normal_()
+    input_ids = torch.randint(0, 23, (4, 10))
+    input_ids[:, :3] = torch.arange(20, 23)
+
+    out = extended(input_ids)
+    reference = F.embedding(
+        input_ids, torch.cat((extended.input_embeds, extended.new_embeds))
+    )
+    assert torch.equal(out, reference)
+
+    out.sum().backward()
+    counts = torch.bincount(input_ids.flatten(), minlength=23).float()
+    assert torch.allclose(extended.input_embeds.grad[:, 0], counts[:20])
+    assert torch.allclose(extended.new_embeds.grad[:, 0], counts[20:])
+
+    lm_head = torch.nn.Linear(8, 20)
+    extended_head = ExtendedLinear(config, lm_head)
+    x = torch.randn(4, 10, 8)
+    reference = F.linear(
+        x,
+        torch.cat((lm_head.weight, extended_head.ext_weight)),
+        torch.cat((lm_head.bias, extended_head.ext_bias)),
+    )
+    assert torch.allclose(extended_head(x), reference, atol=1e-6)
@@ -18,3 +18,109 @@ def test_load_selectors_from_config():
     config = TaskNameSelectorConfig()
     selector = get_selector(config)
     assert type(selector) == TaskNameSelector
+
+
+@pytest.mark.parametrize("routing_groups", ["auto", "q_proj|k_proj|v_proj"])
+def test_per_token_routing_groups(mocker, dummy_batch, routing_groups):
+    import torch
+
+    from mttl.models.containers.selectors.arrow_selector import ArrowSelectorConfig
+    from mttl.models.containers.selectors.per_token_selector import PerTokenSelector
+    from mttl.models.expert_model import MultiExpertModel, MultiExpertModelConfig
+    from mttl.models.modifiers.lora import LoRAConfig
+
+    torch.manual_seed(0)
+    model = MultiExpertModel(MultiExpertModelConfig("EleutherAI/gpt-neo-125m"))
+    for name in ["a", "b", "c"]:
+        model.add_empty_expert(
+            name,
+            LoRAConfig(
+                modify_layers="q_proj|k_proj|v_proj|out_proj", lora_init_b_random=True
+            ),
+        )
+
+    model.set_selector("lora", ArrowSelectorConfig(top_k=2))
+    for selector in model.selectors["lora"]:
+        selector.overwrite_prototypes(torch.randn_like(selector.prototypes))
+    prototypes = [s.prototypes.data.clone() for s in model.selectors["lora"]]
+    expected = model(**dummy_batch).logits
+
+    model.set_selector(
+        "lora", ArrowSelectorConfig(top_k=2, routing_groups=routing_groups)
+    )
+    for selector, proto in zip(model.selectors["lora"], prototypes):
+        selector.overwrite_prototypes(proto)
+
+    attention = model.model.transformer.h[0].attn.attention
+    spy = mocker.spy(PerTokenSelector, "_compute_router_logits")
+
+    output = model(**dummy_batch).logits
+    assert torch.allclose(output, expected, atol=1e-5)
+
+    # q, k and v are routed together, out_proj receives the attention output
+    group = attention.q_proj.selector.routing_group
+    assert group is not None and len(group) == 3
+    assert attention.k_proj.selector.routing_group is group
+    assert attention.v_proj.selector.routing_group is group
+    assert attention.out_proj.selector.routing_group is None
+
+    # the next forward does a single router matmul for q, k and v of each layer
+    spy.reset_mock()
+    output = model(**dummy_batch).logits
+    assert torch.allclose(output, expected, atol=1e-5)
+    assert spy.call_count == 2 * len(model.model.transformer.h)
+
+
+def test_task_predictor_selector_caches_predictions(mocker):
+    import torch
+
+    from mttl.models.containers.selectors.base import (
+        TaskPredictorSelector,
+        TaskPredictorSelectorConfig,
+        get_selector,
+    )
+    from mttl.models.expert_context import InfoContainer
+    from mttl.models.modifiers.routing import RoutingInfo
+
+    ranker = mocker.MagicMock()
+    ranker.predict_task.side_effect = lambda texts, n=1: (
+        [["a"] for _ in texts],
+        [[1.0] for _ in texts],
+    )
+    mocker.patch(
+        "mttl.models.containers.selectors.base.AdapterRankerHelper.get_ranker_instance",
+        return_value=ranker,
+    )
+
+    selector = get_selector(TaskPredictorSelectorConfig(ranker_cache_size=2))
+    assert isinstance(selector, TaskPredictorSelector)
+    selector.add_expert("a")
+    selector.add_expert("b")
+    selector.total_calls_per_forward = 1
+
+    def generate(texts, n_steps=3):
+        routing_infos = RoutingInfo(sources_texts=texts)
+        with InfoContainer(None, routing_infos):
+            for _ in range(n_steps):
+                output = selector(torch.zeros(len(texts), 1, 4))
+        return output
+
+    # one prediction per generate call, for unique texts only
+    output = generate(["x", "y", "x"])
+    assert output.experts == [["a"], ["a"], ["a"]]
+    assert ranker.predict_task.call_count == 1
+    assert ranker.predict_task.call_args[0][0] == ["x", "y"]
+    assert ranker.set_available_tasks.call_count == 1
+
+    # repeated prompts are served from the LRU across batches
+    generate(["y", "x"])
+    assert ranker.predict_task.call_count == 1
+
+    generate(["z", "x"])
+    assert ranker.predict_task.call_count == 2
+    assert ranker.predict_task.call_args[0][0] == ["z"]
+    assert ranker.set_available_tasks.call_count == 1
+
+    # "y" was evicted
+    generate(["y"])
+    assert ranker.predict_task.call_count == 3
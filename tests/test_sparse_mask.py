@@ -3,6 +3,7 @@ import math
 import os
 import sys
 
+import numpy as np
 import pytest
 import torch
 import torch.nn as nn
@@ -226,3 +227,70 @@ def test_load_expert_from_checkpoint():
     assert outputs != new_outputs
 
     temp_dir.cleanup()
+
+
+@pytest.mark.parametrize("keep_ratio", [0.0, 0.05, 0.5])
+def test_encode_mask(keep_ratio):
+    from mttl.models.modifiers.sparse_mask import (
+        MASK_BITMAP,
+        MASK_BLOCK,
+        MASK_DELTA,
+        decode_mask_indices,
+        encode_mask,
+    )
+
+    torch.manual_seed(0)
+    mask = (torch.rand(64, 128) < keep_ratio).float()
+    meta, data = encode_mask(mask)
+    assert meta[0] == (MASK_BITMAP if keep_ratio == 0.5 else MASK_DELTA)
+    assert meta[2:].tolist() == [64, 128]
+    assert np.array_equal(
+        decode_mask_indices(meta, data), torch.nonzero(mask.flatten())[:, 0].numpy()
+    )
+
+    # block sparse masks only store the kept blocks
+    blocks = (torch.rand(4, 8) < max(keep_ratio, 0.1)).float()
+    mask = blocks.repeat_interleave(16, 0).repeat_interleave(16, 1)
+    meta, data = encode_mask(mask, block_size=16)
+    assert meta[0] == MASK_BLOCK and meta[1] == 16
+    assert len(data) <= blocks.numel()
+    assert np.array_equal(
+        decode_mask_indices(meta, data), torch.nonzero(mask.flatten())[:, 0].numpy()
+    )
+
+
+def test_save_and_load_mask(tmp_path):
+    from mttl.models.modifiers.sparse_mask import SparseMaskFile, load_mask, save_mask
+
+    torch.manual_seed(0)
+    module = nn.Module()
+    module.adapter = nn.Module()
+    module.adapter.sparse_layer = nn.Module()
+    module.adapter.sparse_layer.weight_mask = nn.Parameter(
+        (torch.rand(256, 512) < 0.05).float()
+    )
+
+    save_mask(module, f"local://{tmp_path}/task_mask")
+    mask_file = load_mask(f"local://{tmp_path}/task_mask")
+    assert mask_file.keys() == ["adapter.sparse_layer"]
+    assert mask_file.shape("adapter.sparse_layer") == (256, 512)
+    assert torch.equal(
+        mask_file["adapter.sparse_layer"], module.adapter.sparse_layer.weight_mask
+    )
+
+    # the legacy format, a pickled dict of `nonzero()` indices, can still be read
+    weight_mask = module.adapter.sparse_layer.weight_mask.data
+    legacy = {
+        "mask": {"adapter.sparse_layer": torch.nonzero(weight_mask).numpy()},
+        "mask_shape": {"adapter.sparse_layer": weight_mask.shape},
+    }
+    np.savez_compressed(tmp_path / "legacy.npz", arr=legacy)
+    legacy_file = SparseMaskFile(tmp_path / "legacy.npz")
+    assert torch.equal(legacy_file["adapter.sparse_layer"], weight_mask)
+    assert torch.equal(
+        legacy_file.indices("adapter.sparse_layer"),
+        mask_file.indices("adapter.sparse_layer"),
+    )
+    assert os.path.getsize(tmp_path / "task_mask.npz") * 2 < os.path.getsize(
+        tmp_path / "legacy.npz"
+    )
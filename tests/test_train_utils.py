@@ -0,0 +1,126 @@
+import copy
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from mttl.arguments import ExpertConfig
+from mttl.models.expert_model import ExpertModel, ExpertModelConfig
+from mttl.models.get_optimizer import get_optimizer_and_scheduler
+from mttl.models.modifiers.lora import LoRAConfig
+from mttl.models.train_utils import BatchPrefetcher, train_model
+
+
+def make_lora_model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    return ExpertModel(
+        ExpertModelConfig(modifier_config=LoRAConfig(modify_layers="q_proj|v_proj")),
+        model_object=LlamaForCausalLM(config),
+        device_map="cpu",
+    )
+
+
+def make_batches(n_batches):
+    torch.manual_seed(1)
+    batches = []
+    for _ in range(n_batches):
+        input_ids = torch.randint(0, 100, (2, 8))
+        batches.append(
+            {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "labels": input_ids,
+            }
+        )
+    return batches
+
+
+def test_batch_prefetcher():
+    batches = make_batches(3)
+    prefetcher = BatchPrefetcher(batches, "cpu", num_prefetch=2)
+    # cycles over the dataloader
+    for i in range(7):
+        assert next(prefetcher) is batches[i % 3]
+    prefetcher.close()
+    assert prefetcher.num_tokens == 7 * 16
+
+    prefetcher = BatchPrefetcher([], "cpu")
+    with pytest.raises(RuntimeError):
+        next(prefetcher)
+    prefetcher.close()
+
+
+def test_train_model_stops_prefetcher_on_error(monkeypatch):
+    import mttl.models.train_utils as train_utils
+
+    prefetchers = []
+
+    class RecordingPrefetcher(BatchPrefetcher):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            prefetchers.append(self)
+
+    monkeypatch.setattr(train_utils, "BatchPrefetcher", RecordingPrefetcher)
+    args = ExpertConfig(
+        trainable_param_names=".*lora.*",
+        total_steps=5,
+        eval_every=-1,
+        eval_every_n_epoch=-1,
+    )
+    # batches without labels have no loss, the training loop fails on the first step
+    batches = [{"input_ids": torch.randint(0, 100, (2, 8))}]
+    datamodule = SimpleNamespace(
+        train_dataset=[None] * 2,
+        train_dataloader=lambda: batches,
+        dev_dataset=None,
+        test_dataset=None,
+    )
+    with pytest.raises(TypeError):
+        train_model(args, make_lora_model(), datamodule)
+    assert len(prefetchers) == 1 and not prefetchers[0]._thread.is_alive()
+
+
+def test_train_model_matches_reference_loop():
+    args = ExpertConfig(
+        trainable_param_names=".*lora.*",
+        learning_rate=1e-2,
+        total_steps=5,
+        train_batch_size=4,
+        micro_batch_size=2,
+        eval_every=-1,
+        eval_every_n_epoch=-1,
+        log_every=2,
+    )
+    batches = make_batches(3)
+    datamodule = SimpleNamespace(
+        train_dataset=[None] * 6,
+        train_dataloader=lambda: batches,
+        dev_dataset=None,
+        test_dataset=None,
+    )
+    model = train_model(args, make_lora_model(), datamodule)
+
+    ref_model = make_lora_model()
+    (optimizer, scheduler), _ = get_optimizer_and_scheduler(
+        ref_model, copy.deepcopy(args), num_train_examples=6
+    )
+    torch.manual_seed(args.seed)
+    for step in range(args.total_steps):
+        optimizer.zero_grad()
+        for micro_step in range(2):
+            batch = batches[(2 * step + micro_step) % 3]
+            (ref_model.forward(**batch).loss / 2).backward()
+        torch.nn.utils.clip_grad_norm_(ref_model.parameters(), 1.0)
+        optimizer.step()
+        scheduler.step()
+
+    for (name, p), ref_p in zip(model.named_parameters(), ref_model.parameters()):
+        assert torch.allclose(p, ref_p), name
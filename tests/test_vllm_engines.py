@@ -0,0 +1,125 @@
+import pytest
+import torch
+from pytorch_lightning import seed_everything
+from transformers import LlamaForCausalLM
+
+from mttl.models.expert_model import (
+    ExpertModel,
+    ExpertModelConfig,
+    MultiExpertModel,
+    MultiExpertModelConfig,
+)
+from mttl.models.modifiers.lora import LoRAConfig
+from mttl.models.utils import iter_merged_tensors, merged_layer_weight
+from mttl.vllm_engines.engines import WeightHandoff
+
+
+class StandInEngine:
+    """Receives the weights like a vLLM model, by name, into its own copy of the model."""
+
+    def __init__(self, config):
+        self.model = LlamaForCausalLM(config)
+        self.state_dict = self.model.state_dict()
+
+    def load_weights(self, weights):
+        with torch.no_grad():
+            for name, tensor in weights:
+                self.state_dict[name].copy_(tensor)
+
+
+def merged_state_dict(model, expert_name=None):
+    return {
+        name: (merged_layer_weight(modifier, "cpu") if modifier is not None else tensor)
+        for name, tensor, modifier in iter_merged_tensors(
+            model, expert_name=expert_name, strict=False
+        )
+    }
+
+
+def check(engine, model, expert_name=None):
+    for name, tensor in merged_state_dict(model, expert_name).items():
+        assert torch.allclose(engine.state_dict[name], tensor), name
+
+
+@pytest.fixture
+def lora_config():
+    return LoRAConfig(
+        modify_layers="k_proj|v_proj|q_proj|o_proj",
+        lora_rank=4,
+        lora_init_b_random=True,
+    )
+
+
+def test_weight_handoff(make_tiny_llama, lora_config):
+    seed_everything(0)
+    model = ExpertModel(
+        ExpertModelConfig(modifier_config=lora_config),
+        model_object=make_tiny_llama(),
+        device_map="cpu",
+    )
+    engine = StandInEngine(model.model.config)
+    handoff = WeightHandoff(engine.load_weights)
+
+    updated = handoff.push(model.model)
+    assert len(updated) == len(engine.state_dict)
+    check(engine, model.model)
+
+    # nothing changed, nothing is handed over
+    assert handoff.push(model.model) == []
+
+    # only the layer whose adapter changed is handed over
+    lora = model.model.model.layers[2].self_attn.q_proj
+    with torch.no_grad():
+        lora.lora_b.add_(1.0)
+    assert handoff.push(model.model) == ["model.layers.2.self_attn.q_proj.weight"]
+    check(engine, model.model)
+
+    # as is the layer whose base weight changed
+    with torch.no_grad():
+        model.model.model.layers[1].self_attn.v_proj.layer.weight.add_(1.0)
+    assert handoff.push(model.model) == ["model.layers.1.self_attn.v_proj.weight"]
+    check(engine, model.model)
+
+    # a weight reloaded in the memory of the previous one, without a new version
+    weight = model.model.model.layers[0].mlp.down_proj.weight
+    fingerprint = (id(weight), weight.data_ptr(), weight._version)
+    weight.data.copy_(torch.randn_like(weight))
+    assert (id(weight), weight.data_ptr(), weight._version) == fingerprint
+    assert handoff.push(model.model) == ["model.layers.0.mlp.down_proj.weight"]
+    check(engine, model.model)
+
+
+def test_weight_handoff_expert_mixes(make_tiny_llama, lora_config):
+    seed_everything(0)
+    model = MultiExpertModel(
+        MultiExpertModelConfig(),
+        model_object=make_tiny_llama(),
+        device_map="cpu",
+    )
+    model.add_empty_expert("a", lora_config)
+    model.add_empty_expert(
+        "b", LoRAConfig(modify_layers="q_proj", lora_rank=4, lora_init_b_random=True)
+    )
+    engine = StandInEngine(model.model.config)
+    handoff = WeightHandoff(engine.load_weights)
+
+    handoff.push(model.model, expert_name="a")
+    check(engine, model.model, expert_name="a")
+
+    # switching experts only hands over the layers adapted by either of them
+    updated = handoff.push(model.model, expert_name="b")
+    assert updated and all(
+        any(p in name for p in ["k_proj", "v_proj", "q_proj", "o_proj"])
+        for name in updated
+    )
+    check(engine, model.model, expert_name="b")
+    assert handoff.push(model.model, expert_name="b") == []
+
+    # the base weight of a layer holding experts changed
+    container = model.model.model.layers[1].self_attn.q_proj
+    with torch.no_grad():
+        container.layer.weight.add_(1.0)
+    assert handoff.push(model.model, expert_name="b") == [
+        "model.layers.1.self_attn.q_proj.weight"
+    ]
+    check(engine, model.model, expert_name="b")